@@ -31,6 +31,7 @@ import argparse
 import datetime
 import os
 import sys
+import time
 import libtodotxt
 
 # Name of the plugin (shell wrapper script)
@@ -41,10 +42,58 @@ def usage(args):
     print("    " + PLUGIN_NAME + ": " +
             "Adds tasks from future.txt to todo.txt for next 10 days")
     print("      Non-scheduled tasks will be added as is.")
+    print("      --shard moves future.txt to month shards in future.d")
+    print("      --source DIR|GLOB reads the tasks from other files")
+    print("      --metrics FILE writes the run metrics for Prometheus")
+
+
+def read_future_tasks(task):
+    '''Reads the tasks for the next 10 days from a future file, task is the
+    tuple (todo_dir, future_name, now, jobs) with the number of processes
+    parsing the file. Runs in a process of libtodotxt.map_sources() and
+    changes no files. Returns the tuple (entries, line_nrs, metrics) with the
+    list of tuples (line_nr, threshold, line) of the tasks, their line
+    numbers for move_lines() and the parse metrics.'''
+    (todo_dir, future_name, now, jobs) = task
+    future_filename = os.path.join(todo_dir, future_name)
+    metrics = {}
+    phase_start = time.time()
+    if jobs > 1:
+        agenda_data = libtodotxt.readtodotxt_parallel(
+                future_filename, jobs, metrics=metrics)
+    else:
+        agenda_data = libtodotxt.readtodotxt(future_filename, metrics=metrics)
+    libtodotxt.add_phase_duration(metrics, "parse", phase_start)
+
+    # Non-scheduled tasks are added as is
+    libtodotxt.add_threshold_to_empty(agenda_data, now)
+    lines_to_copy = libtodotxt.get_threshold_line_nr(agenda_data, now, 10)
+    lines_to_copy_set = set(lines_to_copy)
+
+    entries = []
+    if len(lines_to_copy) > 0:
+        for date in agenda_data:
+            for entry in agenda_data[date]:
+                if entry["nr"] in lines_to_copy_set:
+                    entries.append((entry["nr"], date, entry["line"]))
+    return (entries, lines_to_copy, metrics)
 
 
 def plugin(args):
     '''Plugin main logic'''
+    start_time = time.time()
+    metrics = None
+    if args.metrics is not None:
+        metrics = {}
+    run(args, metrics)
+    if metrics is not None:
+        libtodotxt.write_metrics(args.metrics, metrics,
+                [("plugin", PLUGIN_NAME)], start_time)
+
+
+def run(args, metrics):
+    '''Moves the future tasks, the counters and phase durations are added
+    to the dict metrics if it is not None'''
 
     todo_dir = os.environ.get("TODO_DIR")
     if todo_dir == None:
@@ -62,29 +111,116 @@ def plugin(args):
         print("todo.txt not found in TODO_DIR! Exit.", file=sys.stderr)
         sys.exit(1)
 
+    journal_filename = os.path.join(todo_dir, libtodotxt.JOURNAL_FILENAME)
+    if libtodotxt.recover_journal(journal_filename):
+        print("Completed the changes of an interrupted run.", file=sys.stderr)
+
     future_filename = os.path.join(todo_dir, "future.txt")
+    shard_dir = os.path.join(todo_dir, libtodotxt.FUTURE_SHARD_DIR)
+
+    if args.shard:
+        if not os.path.isfile(future_filename):
+            print("future.txt not found in TODO_DIR! Exit.", file=sys.stderr)
+            sys.exit(1)
+        shards = libtodotxt.shard_todotxt(future_filename, shard_dir,
+                args.dryrun)
+        print("Move the tasks from future.txt to " +
+                libtodotxt.FUTURE_SHARD_DIR + ":")
+        for shard_name in sorted(shards):
+            print("  %s: %d" % (shard_name, shards[shard_name]))
+        if args.dryrun:
+            print("Dry run. Not changing files.")
+        return
 
-    if not os.path.isfile(future_filename):
+    now = datetime.date.today()
+    future_names = []
+    if args.source is not None:
+        for source in args.source:
+            for filename in libtodotxt.get_source_filenames(todo_dir, source):
+                future_names.append(os.path.relpath(filename, todo_dir))
+        if len(future_names) == 0:
+            print("No source files found! Exit.", file=sys.stderr)
+            sys.exit(1)
+    elif os.path.isfile(future_filename):
+        future_names.append("future.txt")
+    if args.source is None and os.path.isdir(shard_dir):
+        # Only the shards up to the end of the time frame are read
+        for shard_filename in libtodotxt.get_shard_filenames(shard_dir, None,
+                now + datetime.timedelta(days=10)):
+            if libtodotxt.is_compressed(shard_filename):
+                # Compressed archives are read only
+                continue
+            future_names.append(os.path.join(libtodotxt.FUTURE_SHARD_DIR,
+                os.path.basename(shard_filename)))
+    elif len(future_names) == 0:
         print("future.txt not found in TODO_DIR! Exit.", file=sys.stderr)
         sys.exit(1)
 
-    now = datetime.date.today()
-    agenda_data = libtodotxt.readtodotxt(future_filename)
+    write_record = None
+    if args.format != "text":
+        write_record = libtodotxt.get_record_writer(args.format, sys.stdout)
 
-    lines_to_copy = libtodotxt.get_threshold_line_nr(agenda_data, now, 10)
-    if len(lines_to_copy) > 0:
-        print("Move the following entries from future.txt to todo.txt:")
-        for date in agenda_data:
-            for entry in agenda_data[date]:
-                if entry["nr"] in lines_to_copy:
-                    print("  %02d %s" % (entry["nr"], entry["line"]))
-        if args.dryrun:
+    if os.environ.get("TODOTXT_TASK_IDS") == "1" and not args.dryrun:
+        # Create the missing id maps, move_lines() keeps them up to date
+        for name in ["todo.txt"] + future_names:
+            filename = os.path.join(todo_dir, name)
+            if not os.path.isfile(filename + libtodotxt.ID_MAP_SUFFIX):
+                libtodotxt.create_id_map(filename)
+
+    # The sources are parsed in a pool of processes, -j sets its size. A
+    # single source is parsed with -j processes instead. Only this process
+    # changes the files, all together by the journal.
+    processes = None
+    jobs = 1
+    if args.jobs > 1:
+        processes = args.jobs
+        if len(future_names) == 1:
+            jobs = args.jobs
+    tasks = [(todo_dir, future_name, now, jobs)
+            for future_name in future_names]
+    nr_of_moved_tasks = 0
+    moved_lines = []
+    store = libtodotxt.JournalStore(journal_filename)
+    try:
+        results = libtodotxt.map_sources(read_future_tasks, tasks, processes)
+        # The tasks of a source are printed as soon as it and all sources
+        # before it are parsed
+        for (future_name, (entries, line_nrs, source_metrics)) in zip(
+                future_names, results):
+            libtodotxt.add_metrics(metrics, source_metrics)
+            if len(entries) > 0 and write_record is None:
+                print("Move the following entries from " + future_name +
+                        " to todo.txt:")
+            for (line_nr, date, line) in entries:
+                if write_record is None:
+                    print("  %02d %s" % (line_nr, line))
+                else:
+                    write_record(libtodotxt.make_record("move", future_name,
+                        line_nr, date, line))
+            nr_of_moved_tasks = nr_of_moved_tasks + len(entries)
+            if not args.dryrun and len(line_nrs) > 0:
+                phase_start = time.time()
+                moved_lines.extend(libtodotxt.move_lines(
+                    os.path.join(todo_dir, future_name), None, line_nrs,
+                    preserve_line_nrs, store, metrics))
+                libtodotxt.add_phase_duration(metrics, "move", phase_start)
+
+        # All moved tasks are appended to todo.txt at once in source order
+        phase_start = time.time()
+        if len(moved_lines) > 0:
+            libtodotxt.append_lines(todo_filename, moved_lines, store,
+                    metrics)
+    except Exception:
+        store.discard()
+        raise
+    store.commit()
+    libtodotxt.add_phase_duration(metrics, "append", phase_start)
+
+    if write_record is None:
+        if nr_of_moved_tasks == 0:
+            print("No future tasks found")
+        elif args.dryrun:
             print("Dry run. Not changing files.")
-        else:
-            libtodotxt.move_lines(future_filename, todo_filename,
-                    lines_to_copy, preserve_line_nrs)
-    else:
-        print("No future tasks found")
 
 
 def main():
@@ -98,6 +234,25 @@ def main():
             help='plugin main command')
     parser_plugin.add_argument("-n", "--dryrun", action="store_true",
             help="Dry run. Do not change files.")
+    parser_plugin.add_argument("--shard", action="store_true",
+            help="Move the tasks of future.txt to month shards in future.d.")
+    parser_plugin.add_argument("-j", "--jobs", type=int, default=1,
+            help="Number of processes parsing the sources, or parsing "
+            "future.txt if it is the only source (default: one per CPU for "
+            "several sources, 1 for a single one). Several processes for a "
+            "single file are slower on small files and single-CPU machines.")
+    parser_plugin.add_argument("--format", default="text",
+            choices=["text", "jsonl", "csv"],
+            help="Output format, jsonl and csv write one record per line.")
+    parser_plugin.add_argument("--source", action="append",
+            metavar="DIR|GLOB",
+            help="Read the tasks from the *.txt files of DIR or the files "
+            "matching GLOB (relative to TODO_DIR) instead of future.txt and "
+            "future.d. May be given several times.")
+    parser_plugin.add_argument("--metrics", metavar="FILE",
+            default=os.environ.get("TODOTXT_METRICS_FILE"),
+            help="Write the metrics of the run in the Prometheus text format "
+            "to FILE (default: $TODOTXT_METRICS_FILE).")
     parser_plugin.set_defaults(func=plugin)
     args = parser.parse_args()
     args.func(args)
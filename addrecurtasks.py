@@ -29,8 +29,10 @@
 from __future__ import print_function
 import argparse
 import datetime
+import heapq
 import os
 import sys
+import time
 import libtodotxt
 
 # Name of the plugin (shell wrapper script)
@@ -41,10 +43,79 @@ def usage(args):
     print("    " + PLUGIN_NAME + ": " +
             "Adds tasks from recur.txt to todo.txt for next 10 days")
     print("      Non-scheduled tasks will be added as is.")
+    print("      --forecast INTERVAL lists the occurrences without adding them")
+    print("      --dedup skips tasks which are already in todo.txt")
+    print("      --catchup all|latest|N limits the missed occurrences")
+    print("      --source DIR|GLOB reads the tasks from other files")
+    print("      --metrics FILE writes the run metrics for Prometheus")
+
+
+def print_forecast(args, todo_dir, recur_names, now):
+    '''Prints the occurrences of the recurring tasks up to the interval
+    args.forecast from now, no file is changed.'''
+    rule = libtodotxt.parse_recurrence(args.forecast)
+    if rule is None or rule[2]:
+        print("Invalid forecast interval " + args.forecast + "! Exit.",
+                file=sys.stderr)
+        sys.exit(1)
+    max_threshold = libtodotxt.next_recurrence(now, rule, args.calendar_months)
+    occurrences = heapq.merge(*[
+        ((date, recur_name, line_nr, line) for (date, line_nr, line)
+            in libtodotxt.forecast_recur(os.path.join(todo_dir, recur_name),
+                max_threshold, args.calendar_months))
+        for recur_name in recur_names])
+
+    if args.format != "text":
+        write_record = libtodotxt.get_record_writer(args.format, sys.stdout)
+        for (date, recur_name, line_nr, line) in occurrences:
+            write_record(libtodotxt.make_record(
+                "forecast", recur_name, line_nr, date, line))
+        return
+
+    print("Forecast of recurring tasks until " +
+            max_threshold.strftime("%Y-%m-%d") + ":")
+    for (date, recur_name, line_nr, line) in occurrences:
+        print("  " + line)
+
+
+def add_recur_source(task):
+    '''Adds the recurring tasks of a source file, task is the tuple
+    (todo_dir, recur_name, now, max_threshold, dryrun, calendar_months,
+    catchup). Runs in a process of libtodotxt.map_sources(), so the changes
+    are captured by a libtodotxt.CaptureStore instead of being written.
+    Returns the tuple (records, result, store, metrics) with the list of
+    tuples (key, line_nr, threshold, line) of the new and updated lines (see
+    libtodotxt.add_recur()), the result of add_recur() with the new lines
+    under the key "append", the store and the metrics.'''
+    (todo_dir, recur_name, now, max_threshold, dryrun, calendar_months,
+            catchup) = task
+    records = []
+    def record_callback(key, line_nr, threshold, line):
+        '''Collects a new/updated line'''
+        records.append((key, line_nr, threshold, line))
+    store = libtodotxt.CaptureStore()
+    metrics = {}
+    result = libtodotxt.add_recur(os.path.join(todo_dir, recur_name), None,
+            max_threshold, dryrun, record_callback, calendar_months, False,
+            store, metrics, catchup, now)
+    return (records, result, store, metrics)
 
 
 def plugin(args):
     '''Plugin main logic'''
+    start_time = time.time()
+    metrics = None
+    if args.metrics is not None:
+        metrics = {}
+    run(args, metrics)
+    if metrics is not None:
+        libtodotxt.write_metrics(args.metrics, metrics,
+                [("plugin", PLUGIN_NAME)], start_time)
+
+
+def run(args, metrics):
+    '''Adds the recurring tasks, the counters and phase durations are added
+    to the dict metrics if it is not None'''
 
     todo_dir = os.environ.get("TODO_DIR")
     if todo_dir == None:
@@ -56,28 +127,138 @@ def plugin(args):
         print("todo.txt not found in TODO_DIR! Exit.", file=sys.stderr)
         sys.exit(1)
 
-    recur_filename = os.path.join(todo_dir, "recur.txt")
+    journal_filename = os.path.join(todo_dir, libtodotxt.JOURNAL_FILENAME)
+    if libtodotxt.recover_journal(journal_filename):
+        print("Completed the changes of an interrupted run.", file=sys.stderr)
 
-    if not os.path.isfile(recur_filename):
+    recur_names = []
+    if args.source is not None:
+        for source in args.source:
+            for filename in libtodotxt.get_source_filenames(todo_dir, source):
+                recur_names.append(os.path.relpath(filename, todo_dir))
+        if len(recur_names) == 0:
+            print("No source files found! Exit.", file=sys.stderr)
+            sys.exit(1)
+    elif os.path.isfile(os.path.join(todo_dir, "recur.txt")):
+        recur_names.append("recur.txt")
+    else:
         print("recur.txt not found in TODO_DIR! Exit.", file=sys.stderr)
         sys.exit(1)
 
     now = datetime.date.today()
+    if args.forecast is not None:
+        print_forecast(args, todo_dir, recur_names, now)
+        return
+
     max_threshold = (now + datetime.timedelta(days=10)).strftime("%Y-%m-%d")
-    new_lines = libtodotxt.add_recur(
-            recur_filename, todo_filename, max_threshold, args.dryrun)
 
-    if len(new_lines["to"]) > 0:
+    if os.environ.get("TODOTXT_TASK_IDS") == "1" and not args.dryrun:
+        # Create the missing id maps, add_recur() keeps them up to date
+        for name in ["todo.txt"] + recur_names:
+            filename = os.path.join(todo_dir, name)
+            if not os.path.isfile(filename + libtodotxt.ID_MAP_SUFFIX):
+                libtodotxt.create_id_map(filename)
+
+    # The line hashes are checked in source order, so the first source
+    # adds a duplicate task no matter how the threads are scheduled
+    hashes = None
+    if args.dedup:
+        phase_start = time.time()
+        hashes = libtodotxt.read_line_hashes(todo_filename)
+        libtodotxt.add_phase_duration(metrics, "hashes", phase_start)
+
+    write_record = None
+    if args.format != "text":
+        write_record = libtodotxt.get_record_writer(args.format, sys.stdout)
+    actions = {"to": "add", "from": "update", "skipped": "skip"}
+    # Whether the lines added by each source are new (see --dedup)
+    is_new = [[] for _ in recur_names]
+    to_lines = []
+    skipped_lines = []
+    from_lines = [[] for _ in recur_names]
+
+    def handle_line(index, item):
+        '''Checks a new line of the source index for duplicates and writes
+        its record, called in source order'''
+        (key, line_nr, threshold, line) = item
+        if key == "to" and hashes is not None:
+            is_new[index].append(libtodotxt.add_line_hash(hashes, line))
+            if not is_new[index][-1]:
+                key = "skipped"
+        if write_record is not None:
+            write_record(libtodotxt.make_record(actions[key],
+                recur_names[index], line_nr, threshold, line))
+        elif key == "to":
+            to_lines.append(line)
+        elif key == "skipped":
+            skipped_lines.append(line)
+        else:
+            from_lines[index].append(line)
+
+    # The sources are processed in a pool of processes, only this process
+    # changes the files: The captured changes of each source are done by
+    # the journal, which changes todo.txt and the sources together.
+    phase_start = time.time()
+    tasks = [(todo_dir, recur_name, now, max_threshold, args.dryrun,
+        args.calendar_months, args.catchup) for recur_name in recur_names]
+    results = []
+    store = libtodotxt.JournalStore(journal_filename)
+    try:
+        for (index, (records, result, source_store, source_metrics)) in \
+                enumerate(libtodotxt.map_sources(add_recur_source, tasks)):
+            libtodotxt.add_metrics(metrics, source_metrics)
+            for item in records:
+                handle_line(index, item)
+            source_store.apply(store)
+            results.append(result)
+    except Exception:
+        store.discard()
+        raise
+    libtodotxt.add_phase_duration(metrics, "recur", phase_start)
+
+    # All new tasks are appended to todo.txt at once in source order, the
+    # journal changes todo.txt and the sources together
+    phase_start = time.time()
+    lines = []
+    for (index, result) in enumerate(results):
+        new_lines = result.get("append", [])
+        if hashes is not None:
+            new_lines = [line for (line, is_new_line)
+                    in zip(new_lines, is_new[index]) if is_new_line]
+        lines.extend(new_lines)
+    if hashes is not None:
+        # add_recur() counted the skipped lines as added ones
+        nr_of_skipped_lines = sum([source_is_new.count(False)
+            for source_is_new in is_new])
+        libtodotxt.add_metrics(metrics, {"lines_skipped": nr_of_skipped_lines,
+            "lines_added": -nr_of_skipped_lines})
+    if len(lines) > 0:
+        libtodotxt.append_lines(todo_filename, lines, store, metrics)
+    store.commit()
+    if hashes is not None and not args.dryrun:
+        libtodotxt.write_line_hashes(todo_filename, hashes)
+    libtodotxt.add_phase_duration(metrics, "append", phase_start)
+
+    if write_record is not None:
+        return
+
+    if len(to_lines) > 0:
         print("Add the following new lines to todo.txt:")
-        for line in new_lines["to"]:
-            print("  " + line)
+        for line in to_lines:
+            print("  " + libtodotxt.decode_line(line))
     else:
         print("No new entries to add to todo.txt")
 
-    if len(new_lines["from"]) > 0:
-        print("Change the following lines in recur.txt:")
-        for line in new_lines["from"]:
-            print("  " + line)
+    if len(skipped_lines) > 0:
+        print("Skip the following lines already in todo.txt:")
+        for line in skipped_lines:
+            print("  " + libtodotxt.decode_line(line))
+
+    for (recur_name, lines) in zip(recur_names, from_lines):
+        if len(lines) > 0:
+            print("Change the following lines in " + recur_name + ":")
+            for line in lines:
+                print("  " + libtodotxt.decode_line(line))
 
     if args.dryrun:
         print("Dryrun: Do not change files.")
@@ -94,6 +275,31 @@ def main():
             help='plugin main command')
     parser_plugin.add_argument("-n", "--dryrun", action="store_true",
             help="Dry run. Do not change files.")
+    parser_plugin.add_argument("--format", default="text",
+            choices=["text", "jsonl", "csv"],
+            help="Output format, jsonl and csv write one record per line.")
+    parser_plugin.add_argument("--forecast", metavar="INTERVAL",
+            help="List the occurrences up to INTERVAL (e.g. 6m) from today "
+            "without changing files.")
+    parser_plugin.add_argument("--calendar-months", action="store_true",
+            help="Use calendar months and years for the m and y rules "
+            "instead of 30 and 365 days.")
+    parser_plugin.add_argument("--dedup", action="store_true",
+            help="Do not add tasks which are already in todo.txt.")
+    parser_plugin.add_argument("--catchup", metavar="all|latest|N",
+            type=libtodotxt.parse_catchup,
+            help="Add only the latest N (latest: 1) occurrences which were "
+            "missed before today, e.g. after the machine was off. Tasks with "
+            "a catchup: tag use their own policy. Default: all")
+    parser_plugin.add_argument("--source", action="append",
+            metavar="DIR|GLOB",
+            help="Read the recurring tasks from the *.txt files of DIR or the "
+            "files matching GLOB (relative to TODO_DIR) instead of recur.txt. "
+            "May be given several times.")
+    parser_plugin.add_argument("--metrics", metavar="FILE",
+            default=os.environ.get("TODOTXT_METRICS_FILE"),
+            help="Write the metrics of the run in the Prometheus text format "
+            "to FILE (default: $TODOTXT_METRICS_FILE).")
     parser_plugin.set_defaults(func=plugin)
     args = parser.parse_args()
     args.func(args)
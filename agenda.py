@@ -29,10 +29,15 @@
 from __future__ import print_function
 import argparse
 import datetime
+import heapq
 import operator
 import os
 import re
 import sys
+try:
+    from StringIO import StringIO
+except ImportError:
+    from io import StringIO
 
 import libtodotxt
 
@@ -44,6 +49,9 @@ def usage(args):
     print("    " + PLUGIN_NAME + ": " +
             "Prints overview of scheduled ('t:') task for next 10 days")
     print("      Non-scheduled tasks are printed under the current date")
+    print("      --all includes future.txt and recur.txt tasks")
+    print("      --file reads another file, e.g. a compressed archive")
+    print("      --cache reuses the output while the files are unchanged")
 
 
 def print_long(agenda_data):
@@ -72,6 +80,136 @@ def print_short(agenda_data):
         print()
 
 
+def print_records(agenda_data, output_format, todo_name):
+    '''Prints one record per entry of the file todo_name in the format
+    "jsonl" or "csv"'''
+    write_record = libtodotxt.get_record_writer(output_format, sys.stdout)
+    for key in sorted(agenda_data):
+        item_list = sorted(agenda_data[key], key=operator.itemgetter('line'))
+        for entry in item_list:
+            write_record(libtodotxt.make_record(
+                "show", todo_name, entry["nr"], key, entry["line"]))
+
+
+def print_merged(entries, output_format, limit, max_days):
+    '''Prints the date ordered tuples (date, line, source, line_nr) of
+    libtodotxt.iter_sorted_agenda() in the short format or as records. The
+    source is printed in front of the line number.'''
+    write_record = None
+    if output_format != "text":
+        write_record = libtodotxt.get_record_writer(output_format, sys.stdout)
+    current_date = None
+    nr_of_days = 0
+    for (nr_of_entries, (date, line, source, line_nr)) in enumerate(entries):
+        if limit is not None and nr_of_entries >= limit:
+            break
+        if date != current_date:
+            nr_of_days = nr_of_days + 1
+            if max_days is not None and nr_of_days > max_days:
+                break
+            if write_record is None:
+                if current_date is not None:
+                    print()
+                print(date.strftime("%a, %Y-%m-%d") + ":")
+            current_date = date
+        if write_record is None:
+            print("  %s:%02d %s" % (source, line_nr, line))
+        else:
+            write_record(libtodotxt.make_record(
+                "show", source, line_nr, date, line))
+    if write_record is None and current_date is not None:
+        print()
+
+
+def get_future_names(todo_dir, last_date):
+    '''Returns the names of future.txt and its shards up to last_date
+    relative to todo_dir'''
+    future_names = ["future.txt"]
+    shard_dir = os.path.join(todo_dir, libtodotxt.FUTURE_SHARD_DIR)
+    if os.path.isdir(shard_dir):
+        for shard_filename in libtodotxt.get_shard_filenames(
+                shard_dir, None, last_date):
+            future_names.append(os.path.join(libtodotxt.FUTURE_SHARD_DIR,
+                os.path.basename(shard_filename)))
+    return future_names
+
+
+def get_merged_entries(todo_dir, todo_name, now, last_date):
+    '''Returns the date ordered entries of todo_name (todo.txt), future.txt
+    (or its shards) and the occurrences of recur.txt, see print_merged().
+    future and recur tasks are limited to last_date.'''
+    streams = [libtodotxt.iter_sorted_agenda(libtodotxt.itertodotxt(
+        os.path.join(todo_dir, todo_name)), todo_name, now)]
+
+    for future_name in get_future_names(todo_dir, last_date):
+        future_filename = os.path.join(todo_dir, future_name)
+        if os.path.isfile(future_filename):
+            streams.append(libtodotxt.iter_sorted_agenda(
+                libtodotxt.itertodotxt(future_filename), future_name, now,
+                last_date))
+
+    recur_filename = os.path.join(todo_dir, "recur.txt")
+    if os.path.isfile(recur_filename):
+        streams.append(libtodotxt.iter_sorted_agenda(
+            libtodotxt.iter_recur(recur_filename, last_date), "recur.txt",
+            now, last_date))
+
+    return heapq.merge(*streams)
+
+
+def print_agenda(args, todo_dir, now):
+    '''Prints the agenda of the file args.file in todo_dir'''
+    todo_filename = os.path.join(todo_dir, args.file)
+    if args.all:
+        last_date = now + datetime.timedelta(days=args.days)
+        print_merged(get_merged_entries(todo_dir, args.file, now, last_date),
+                args.format, args.limit, args.max_days)
+        return
+
+    if args.limit is not None or args.max_days is not None:
+        # Only the selected entries are kept in memory
+        agenda_data = libtodotxt.select_agenda(
+                libtodotxt.itertodotxt(todo_filename), now,
+                args.limit, args.max_days)
+    else:
+        if args.jobs > 1:
+            agenda_data = libtodotxt.readtodotxt_parallel(
+                    todo_filename, args.jobs)
+        else:
+            agenda_data = libtodotxt.readtodotxt(todo_filename)
+
+        # Handle items with no threshold date as due now
+        libtodotxt.add_threshold_to_empty(agenda_data, now)
+    if args.format == "text":
+        print_short(agenda_data)
+    else:
+        print_records(agenda_data, args.format, args.file)
+
+
+def get_cache_key(args, todo_dir, now):
+    '''Returns the key of the output cache (see
+    libtodotxt.get_output_cache_key()) for the files read and the options
+    changing the output'''
+    filenames = [os.path.join(todo_dir, args.file)]
+    last_date = now + datetime.timedelta(days=args.days)
+    if args.all:
+        # The directory changes if a shard is added or removed
+        filenames.append(os.path.join(todo_dir, libtodotxt.FUTURE_SHARD_DIR))
+        filenames.extend([os.path.join(todo_dir, name) for name
+            in get_future_names(todo_dir, last_date) + ["recur.txt"]])
+    options = [PLUGIN_NAME, now.strftime("%Y-%m-%d"), args.file,
+            str(args.all), str(args.days), str(args.limit),
+            str(args.max_days), args.format, str(sys.stdout.encoding)]
+    return (filenames, libtodotxt.get_output_cache_key(filenames, options))
+
+
+def write_output(data):
+    '''Writes the bytes data to stdout'''
+    sys.stdout.flush()
+    getattr(sys.stdout, "buffer", sys.stdout).write(data)
+    sys.stdout.flush()
+
+
 def plugin(args):
     '''Plugin main logic'''
 
@@ -80,18 +218,37 @@ def plugin(args):
         print("Env variable TODO_DIR not set! Exit.", file=sys.stderr)
         sys.exit(1)
 
-    todo_filename = os.path.join(todo_dir, "todo.txt")
+    todo_filename = os.path.join(todo_dir, args.file)
 
     if not os.path.isfile(todo_filename):
-        print("todo.txt not found in TODO_DIR! Exit.", file=sys.stderr)
+        print(args.file + " not found in TODO_DIR! Exit.", file=sys.stderr)
         sys.exit(1)
 
     now = datetime.date.today()
-    agenda_data = libtodotxt.readtodotxt(todo_filename)
+    if not args.cache:
+        print_agenda(args, todo_dir, now)
+        return
+
+    # A cache hit costs a stat of the files and a read of the cache entry
+    cache_dir = os.path.join(todo_dir, libtodotxt.OUTPUT_CACHE_DIR)
+    (filenames, key) = get_cache_key(args, todo_dir, now)
+    data = libtodotxt.read_output_cache(cache_dir, key, filenames)
+    if data is not None:
+        write_output(data)
+        return
 
-    # Handle items with no threshold date as due now
-    libtodotxt.add_threshold_to_empty(agenda_data, now)
-    print_short(agenda_data)
+    stdout = sys.stdout
+    sys.stdout = StringIO()
+    try:
+        print_agenda(args, todo_dir, now)
+        data = sys.stdout.getvalue()
+    finally:
+        sys.stdout = stdout
+    if not isinstance(data, bytes):
+        data = data.encode(sys.stdout.encoding or "utf-8",
+                getattr(sys.stdout, "errors", None) or "strict")
+    write_output(data)
+    libtodotxt.write_output_cache(cache_dir, key, data)
 
 
 def main():
@@ -103,6 +260,31 @@ def main():
     parser_usage.set_defaults(func=usage)
     parser_plugin = subparsers.add_parser(PLUGIN_NAME,
             help='plugin main command')
+    parser_plugin.add_argument("-j", "--jobs", type=int, default=1,
+            help="Number of processes used to parse todo.txt. Only files "
+            "of several MiB are split, the extra processes make small files "
+            "and single-CPU machines slower.")
+    parser_plugin.add_argument("-f", "--file", default="todo.txt",
+            help="File relative to TODO_DIR to read instead of todo.txt, "
+            "compressed files (.gz, .bz2, .xz) are decompressed while "
+            "reading.")
+    parser_plugin.add_argument("--cache", action="store_true",
+            default=os.environ.get("TODOTXT_AGENDA_CACHE") == "1",
+            help="Cache the output in TODO_DIR/" +
+            libtodotxt.OUTPUT_CACHE_DIR + " and print it again while the "
+            "files, the date and the options are unchanged "
+            "(default: $TODOTXT_AGENDA_CACHE=1).")
+    parser_plugin.add_argument("-a", "--all", action="store_true",
+            help="Include future.txt and recur.txt tasks of the next days.")
+    parser_plugin.add_argument("--days", type=int, default=10,
+            help="Number of days for future.txt and recur.txt with --all.")
+    parser_plugin.add_argument("--limit", type=int, metavar="N",
+            help="Only print the first N entries.")
+    parser_plugin.add_argument("--max-days", type=int, metavar="K",
+            help="Only print the first K days having entries.")
+    parser_plugin.add_argument("--format", default="text",
+            choices=["text", "jsonl", "csv"],
+            help="Output format, jsonl and csv write one record per line.")
     parser_plugin.set_defaults(func=plugin)
     args = parser.parse_args()
     args.func(args)
@@ -0,0 +1,166 @@
+#!/usr/bin/env python
+# vim: set fileencoding=utf-8 :
+"""
+    bulkedit.py
+
+    Changes keys of selected tasks in a single pass (plugin for todo.sh)
+"""
+# The MIT License (MIT)
+#
+# Copyright (c) 2015 Georg Lutz <georg@georglutz.de>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+from __future__ import print_function
+import argparse
+import os
+import re
+import sys
+import libtodotxt
+
+# Name of the plugin (shell wrapper script)
+PLUGIN_NAME = "bulkedit"
+
+def usage(args):
+    '''Usage message for todo.sh plugin system'''
+    print("    " + PLUGIN_NAME + " [-n] [--project P] [--context C] " +
+            "[--contains TEXT] EDIT...")
+    print("      Changes keys of all selected tasks in todo.txt. EDIT is")
+    print("      key=value (set), key= (delete) or key+=3d (shift date)")
+
+
+def to_bytes(text):
+    '''Returns command line argument as bytes, the files are processed as
+    bytes'''
+    if isinstance(text, bytes):
+        return text
+    return text.encode("utf-8")
+
+
+def get_shift_function(interval):
+    '''Returns function which adds interval to a date value, see
+    libtodotxt.add_interval(). Values which are no date are kept.'''
+    def shift(value):
+        '''Shifts date value by interval'''
+        if value is None:
+            return None
+        try:
+            new_value = libtodotxt.add_interval(
+                    value.decode("latin-1"), interval)
+        except ValueError:
+            return value
+        if new_value is None:
+            return value
+        return new_value
+    return shift
+
+
+def parse_edit(edit):
+    '''Parses an EDIT argument and returns a (key, value) tuple for
+    libtodotxt.bulk_edit()'''
+    match = re.match("^(?P<key>[^=+\\s]+)(?P<op>\\+?=)(?P<value>\\S*)$", edit)
+    if match is None:
+        raise argparse.ArgumentTypeError("Invalid edit: " + edit)
+    if re.match("^[A-Za-z0-9_-]+$", match.group("key")) is None:
+        raise argparse.ArgumentTypeError("Invalid key in edit " + edit +
+                ", only letters, digits, \"_\" and \"-\" are allowed")
+    key = match.group("key")
+    value = match.group("value")
+    if match.group("op") == "+=":
+        return (key, get_shift_function(value))
+    if len(value) == 0:
+        return (key, None)
+    return (key, to_bytes(value))
+
+
+def plugin(args):
+    '''Plugin main logic'''
+
+    todo_dir = os.environ.get("TODO_DIR")
+    if todo_dir == None:
+        print("Env variable TODO_DIR not set! Exit.", file=sys.stderr)
+        sys.exit(1)
+
+    todo_filename = os.path.join(todo_dir, args.file)
+    if not os.path.isfile(todo_filename):
+        print(args.file + " not found in TODO_DIR! Exit.", file=sys.stderr)
+        sys.exit(1)
+
+    project = None
+    if args.project is not None:
+        project = to_bytes(args.project.lstrip("+"))
+    context = None
+    if args.context is not None:
+        context = to_bytes(args.context.lstrip("@"))
+    contains = None
+    if args.contains is not None:
+        contains = to_bytes(args.contains)
+
+    def line_filter(line):
+        '''Selects the lines to change'''
+        if project is not None and \
+                project not in libtodotxt.get_projects(line):
+            return False
+        if context is not None and \
+                context not in libtodotxt.get_contexts(line):
+            return False
+        if contains is not None and contains not in line:
+            return False
+        return True
+
+    def record_callback(line_nr, line):
+        '''Prints changed line'''
+        print("  %02d %s" % (line_nr, libtodotxt.decode_line(line).strip()))
+
+    print("Change the following lines in " + args.file + ":")
+    nr_of_changed_lines = libtodotxt.bulk_edit(todo_filename, line_filter,
+            args.edits, args.dryrun, record_callback)
+    if nr_of_changed_lines == 0:
+        print("  None")
+    if args.dryrun:
+        print("Dry run. Not changing files.")
+
+
+def main():
+    '''main function'''
+    parser = argparse.ArgumentParser(prog=PLUGIN_NAME)
+    subparsers = parser.add_subparsers()
+    parser_usage = subparsers.add_parser('usage',
+            help='show usage message')
+    parser_usage.set_defaults(func=usage)
+    parser_plugin = subparsers.add_parser(PLUGIN_NAME,
+            help='plugin main command')
+    parser_plugin.add_argument("-n", "--dryrun", action="store_true",
+            help="Dry run. Do not change files.")
+    parser_plugin.add_argument("--file", default="todo.txt",
+            help="File in TODO_DIR to change, e.g. future.txt")
+    parser_plugin.add_argument("--project",
+            help="Only change tasks with this +project")
+    parser_plugin.add_argument("--context",
+            help="Only change tasks with this @context")
+    parser_plugin.add_argument("--contains",
+            help="Only change tasks containing this text")
+    parser_plugin.add_argument("edits", metavar="EDIT", nargs="+",
+            type=parse_edit,
+            help="key=value, key= (delete key) or key+=INTERVAL")
+    parser_plugin.set_defaults(func=plugin)
+    args = parser.parse_args()
+    args.func(args)
+
+if __name__ == "__main__":
+    main()
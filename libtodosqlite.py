@@ -0,0 +1,253 @@
+# vim: set fileencoding=utf-8 :
+"""
+    libtodosqlite.py
+
+    Optional SQLite mirror of todo.txt files for fast queries. The text files
+    stay the source of truth, the mirror is synchronized incrementally.
+"""
+# The MIT License (MIT)
+#
+# Copyright (c) 2015 Georg Lutz <georg@georglutz.de>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+import datetime
+import hashlib
+import os
+import sqlite3
+
+import libtodotxt
+
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS files (
+    id INTEGER PRIMARY KEY,
+    name TEXT UNIQUE NOT NULL,
+    size INTEGER NOT NULL,
+    mtime_ns INTEGER NOT NULL,
+    hash TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS tasks (
+    id INTEGER PRIMARY KEY,
+    file_id INTEGER NOT NULL REFERENCES files(id),
+    nr INTEGER NOT NULL,
+    line TEXT NOT NULL,
+    threshold INTEGER,
+    priority TEXT
+);
+CREATE TABLE IF NOT EXISTS tags (
+    task_id INTEGER NOT NULL REFERENCES tasks(id),
+    kind TEXT NOT NULL,
+    value TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS tasks_file_nr ON tasks (file_id, nr);
+CREATE INDEX IF NOT EXISTS tasks_threshold ON tasks (threshold);
+CREATE INDEX IF NOT EXISTS tasks_priority ON tasks (priority);
+CREATE INDEX IF NOT EXISTS tags_kind_value ON tags (kind, value);
+CREATE INDEX IF NOT EXISTS tags_task ON tags (task_id);
+"""
+
+# Values of the column tags.kind
+PROJECT = "+"
+CONTEXT = "@"
+
+
+def open_mirror(db_filename):
+    '''Opens (and creates if not existent) the mirror database and returns
+    the sqlite3 connection.'''
+    conn = sqlite3.connect(db_filename)
+    conn.executescript(SCHEMA)
+    return conn
+
+
+def get_file_hash(filename):
+    '''Returns the SHA-1 hex digest of the content of a file'''
+    file_hash = hashlib.sha1()
+    file_ = open(filename, "rb")
+    while True:
+        data = file_.read(libtodotxt.IO_BUFFER_SIZE)
+        if len(data) == 0:
+            break
+        file_hash.update(data)
+    file_.close()
+    return file_hash.hexdigest()
+
+
+def _insert_tasks(conn, file_id, filename):
+    '''Parses filename and inserts its tasks'''
+    todo_file = open(filename, "rb", libtodotxt.IO_BUFFER_SIZE)
+    for line_nr, line in enumerate(todo_file, start=1):
+        line = line.decode("utf-8", "replace").rstrip()
+        if len(line) == 0:
+            continue
+        try:
+            threshold = libtodotxt.getthreshold(line)
+        except ValueError:
+            # Invalid date like t:2015-13-01
+            threshold = None
+        if threshold is not None:
+            threshold = threshold.toordinal()
+        cursor = conn.execute("INSERT INTO tasks "
+                "(file_id, nr, line, threshold, priority) "
+                "VALUES (?, ?, ?, ?, ?)",
+                (file_id, line_nr, line, threshold,
+                    libtodotxt.get_priority(line)))
+        task_id = cursor.lastrowid
+        tags = [(task_id, PROJECT, project) for project in
+                set(libtodotxt.get_projects(line))]
+        tags.extend([(task_id, CONTEXT, context) for context in
+                set(libtodotxt.get_contexts(line))])
+        if len(tags) > 0:
+            conn.executemany(
+                    "INSERT INTO tags (task_id, kind, value) VALUES (?, ?, ?)",
+                    tags)
+    todo_file.close()
+
+
+def _delete_tasks(conn, file_id):
+    '''Deletes all tasks of a file from the mirror'''
+    conn.execute("DELETE FROM tags WHERE task_id IN "
+            "(SELECT id FROM tasks WHERE file_id = ?)", (file_id,))
+    conn.execute("DELETE FROM tasks WHERE file_id = ?", (file_id,))
+
+
+def sync_file(conn, filename, name):
+    '''
+    Synchronizes the tasks of filename into the mirror under the given name
+    (e.g. "todo.txt"). Files with unchanged size and modification time are
+    skipped, files with unchanged content hash are not parsed again.
+    Returns True if the tasks of the file were (re)inserted.
+    '''
+    stat_result = os.stat(filename)
+    mtime_ns = libtodotxt.get_mtime_ns(stat_result)
+    row = conn.execute("SELECT id, size, mtime_ns, hash FROM files "
+            "WHERE name = ?", (name,)).fetchone()
+    if row is not None and row[1] == stat_result.st_size and \
+            row[2] == mtime_ns:
+        return False
+
+    file_hash = get_file_hash(filename)
+    if row is not None and row[3] == file_hash:
+        conn.execute("UPDATE files SET size = ?, mtime_ns = ? WHERE id = ?",
+                (stat_result.st_size, mtime_ns, row[0]))
+        conn.commit()
+        return False
+
+    if row is None:
+        file_id = conn.execute("INSERT INTO files "
+                "(name, size, mtime_ns, hash) VALUES (?, ?, ?, ?)",
+                (name, stat_result.st_size, mtime_ns, file_hash)).lastrowid
+    else:
+        file_id = row[0]
+        _delete_tasks(conn, file_id)
+        conn.execute("UPDATE files SET size = ?, mtime_ns = ?, hash = ? "
+                "WHERE id = ?",
+                (stat_result.st_size, mtime_ns, file_hash, file_id))
+    _insert_tasks(conn, file_id, filename)
+    conn.commit()
+    return True
+
+
+def sync_dir(conn, todo_dir, names):
+    '''
+    Synchronizes the files names (relative to todo_dir, e.g. "todo.txt" or
+    "future.d/2015-01.txt") into the mirror, see sync_file(). Not existing
+    files and files not part of names are removed from the mirror.
+    Returns the list of names of the (re)inserted files.
+    '''
+    result = []
+    existing_names = set()
+    for name in names:
+        filename = os.path.join(todo_dir, name)
+        if os.path.isfile(filename):
+            existing_names.add(name)
+            if sync_file(conn, filename, name):
+                result.append(name)
+    for (file_id, name) in conn.execute(
+            "SELECT id, name FROM files").fetchall():
+        if name not in existing_names:
+            _delete_tasks(conn, file_id)
+            conn.execute("DELETE FROM files WHERE id = ?", (file_id,))
+    conn.commit()
+    return result
+
+
+def _to_entries(rows):
+    '''Converts rows (name, nr, threshold, line) to entries with
+    datetime.date thresholds'''
+    result = []
+    for (name, line_nr, threshold, line) in rows:
+        if threshold is not None:
+            threshold = datetime.date.fromordinal(threshold)
+        result.append({"file": name, "nr": line_nr, "threshold": threshold,
+            "line": line})
+    return result
+
+
+def query_agenda(conn, first_date, last_date, names=None):
+    '''
+    Returns the tasks with a threshold date between first_date and last_date
+    (datetime.date objects, both inclusive, None for an open end) ordered by
+    date and line, e.g.:
+
+        [ { "file": "todo.txt", "nr": 3, "threshold": 2015-01-01,
+            "line": "Task t:2015-01-01" } ]
+
+    Parameters:
+        - names: Optional list of file names to restrict the query to
+    '''
+    sql = "SELECT files.name, tasks.nr, tasks.threshold, tasks.line " \
+            "FROM tasks JOIN files ON files.id = tasks.file_id " \
+            "WHERE tasks.threshold IS NOT NULL"
+    params = []
+    if first_date is not None:
+        sql = sql + " AND tasks.threshold >= ?"
+        params.append(first_date.toordinal())
+    if last_date is not None:
+        sql = sql + " AND tasks.threshold <= ?"
+        params.append(last_date.toordinal())
+    if names is not None:
+        sql = sql + " AND files.name IN (%s)" % ",".join("?" * len(names))
+        params.extend(names)
+    sql = sql + " ORDER BY tasks.threshold, tasks.line"
+    return _to_entries(conn.execute(sql, params))
+
+
+def query_tasks(conn, project=None, context=None, priority=None, names=None):
+    '''
+    Returns the tasks matching all given filters (project and context without
+    "+"/"@"), ordered by file and line number. The entries are the same as for
+    query_agenda().
+    '''
+    sql = "SELECT files.name, tasks.nr, tasks.threshold, tasks.line " \
+            "FROM tasks JOIN files ON files.id = tasks.file_id WHERE 1"
+    params = []
+    for (kind, value) in [(PROJECT, project), (CONTEXT, context)]:
+        if value is not None:
+            sql = sql + " AND tasks.id IN (SELECT task_id FROM tags " \
+                    "WHERE kind = ? AND value = ?)"
+            params.extend([kind, value])
+    if priority is not None:
+        sql = sql + " AND tasks.priority = ?"
+        params.append(priority)
+    if names is not None:
+        sql = sql + " AND files.name IN (%s)" % ",".join("?" * len(names))
+        params.extend(names)
+    sql = sql + " ORDER BY files.name, tasks.nr"
+    return _to_entries(conn.execute(sql, params))
@@ -28,23 +28,796 @@
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 # SOFTWARE.
 
+import array
+import bisect
+import bz2
+import calendar
+import collections
+import csv
 import datetime
+import errno
+import glob
+import gzip
+import hashlib
+import heapq
+import io
+import json
+import mmap
+import multiprocessing
 import os
 import re
+import shutil
+import sys
 import tempfile
+import threading
+import time
+
+try:
+    import lzma
+except ImportError:
+    # Python 2 has no lzma module, xz files cannot be read there
+    lzma = None
+
+
+# Buffer size (bytes) for reading and writing files
+IO_BUFFER_SIZE = 1024 * 1024
+
+# Directory in TODO_DIR with future tasks sharded by month
+FUTURE_SHARD_DIR = "future.d"
+
+# Name of the shard for tasks without threshold date, see get_shard_name()
+UNSCHEDULED_SHARD = "unscheduled.txt"
+
+# Fields of the records written by get_record_writer()
+RECORD_FIELDS = ["date", "nr", "line", "file", "action"]
+
+# Name of the index file in the directory of done segments
+DONE_INDEX_FILENAME = "index.txt"
+
+# Files are split into chunks of at least this size (bytes) for parallel parsing
+PARALLEL_MIN_CHUNK_SIZE = 4 * 1024 * 1024
+
+# Suffix of the sidecar file with the task ids of a todo.txt file
+ID_MAP_SUFFIX = ".ids"
+
+# Suffix of the sidecar file with the line hashes of a todo.txt file
+LINE_HASHES_SUFFIX = ".hashes"
+
+# Length of the line hashes in bytes
+LINE_HASH_SIZE = 8
+
+# Suffixes of compressed files, they are decompressed while reading
+COMPRESSED_SUFFIXES = (".gz", ".bz2", ".xz")
+
+# Name of the write-ahead journal in TODO_DIR, see JournalStore
+JOURNAL_FILENAME = ".journal"
+
+# Guards the line hashes shared by concurrent add_recur() calls
+_LINE_HASHES_LOCK = threading.Lock()
+
+# Run metrics written by write_metrics(): (name, help text)
+METRICS = [
+    ("lines_scanned", "Number of lines read from the task files"),
+    ("lines_added", "Number of recurring tasks added"),
+    ("lines_skipped", "Number of recurring tasks skipped as duplicates"),
+    ("lines_moved", "Number of tasks moved between files"),
+    ("recurrence_steps", "Number of recurrence steps computed"),
+    ("bytes_read", "Number of bytes read from the task files"),
+    ("bytes_written", "Number of bytes written to the task files"),
+]
+
+# Prefix of the names of the metrics in the Prometheus text format
+METRICS_PREFIX = "todotxt_"
+
+# Guards the metrics updated by concurrent source threads
+_METRICS_LOCK = threading.Lock()
+
+# Directory in TODO_DIR with the cached output of the agenda
+OUTPUT_CACHE_DIR = ".agenda-cache"
+
+# Maximum number and age (seconds) of the output cache entries
+OUTPUT_CACHE_MAX_ENTRIES = 32
+OUTPUT_CACHE_MAX_AGE = 24 * 60 * 60
+
+# Files changed in the last seconds are identified by content, too, as a
+# change within the same mtime tick keeps size and mtime
+OUTPUT_CACHE_RACY_SECONDS = 2
+
+# Default bounds of the ParseCache: number of files and estimated bytes
+PARSE_CACHE_MAX_ENTRIES = 128
+PARSE_CACHE_MAX_BYTES = 256 * 1024 * 1024
+
+
+def _as_line_type(line, text):
+    '''Returns text as bytes if line is bytes, otherwise text is returned
+    unchanged. Allows the key functions to work on raw bytes lines.'''
+    if isinstance(line, bytes) and not isinstance(text, bytes):
+        return text.encode("utf-8")
+    return text
+
+
+def decode_line(line):
+    '''Returns a line as str for displaying it. Lines read as bytes are
+    decoded as UTF-8, undecodable bytes are replaced.'''
+    if isinstance(line, str):
+        return line
+    return line.decode("utf-8", "replace")
+
+
+def is_compressed(filename):
+    '''Returns True if filename has one of the COMPRESSED_SUFFIXES'''
+    return filename.endswith(COMPRESSED_SUFFIXES)
+
+
+def open_compressed(filename, text=False):
+    '''
+    Opens the compressed file filename (see COMPRESSED_SUFFIXES) for reading.
+    The data is decompressed chunk by chunk while reading, there is never a
+    decompressed copy of the whole file. With text set the lines are the
+    same as with open(filename, "r") for the uncompressed file, otherwise
+    bytes.
+    '''
+    mode = "rb"
+    if text and sys.version_info[0] >= 3:
+        mode = "rt"
+    if filename.endswith(".gz"):
+        return gzip.open(filename, mode)
+    if filename.endswith(".bz2"):
+        if sys.version_info[0] < 3:
+            return bz2.BZ2File(filename, "r")
+        return bz2.open(filename, mode)
+    if lzma is None:
+        raise IOError("Reading " + filename + " needs the lzma module")
+    return lzma.open(filename, mode)
+
+
+class TodoStore(object):
+    '''
+    Interface for the file access of the library functions taking a store
+    argument. Filenames are only used as keys, so a store may keep the files
+    anywhere. All files are opened in binary mode.
+
+        - open_read(filename): Returns a file object for reading, iterating
+          over it yields the lines
+        - open_text(filename): Same lines as open(filename, "r")
+        - open_append(filename): Returns a file object, the data written to
+          it is appended to filename
+        - open_replace(filename): Returns a file object, filename is
+          replaced by the data written to it on close(). discard() drops it,
+          in a with statement it is dropped if an exception is raised.
+        - exists(filename)
+
+    The attribute local is True if filename is a path in the local file
+    system, only then the sidecar files (id maps, line hashes) are used. The
+    id maps are read and saved through the store:
+
+        - read_id_map_for_update(filename): Returns (has_sidecar, id_map),
+          see _read_id_map_for_update()
+        - save_id_map(filename, has_sidecar, id_map): Saves the id map after
+          filename was changed, see _save_id_map()
+        - get_append_offset(filename): Size of filename including the data
+          appended through the store, the offset of the next appended line
+        - ends_with_newline(filename): False if the next appended line is
+          joined with the last line of filename
+    '''
+    local = False
+
+    def open_read(self, filename):
+        '''Returns a file object for reading filename'''
+        raise NotImplementedError()
+
+    def open_text(self, filename):
+        '''Returns a file object for reading the lines of filename as text'''
+        todo_file = self.open_read(filename)
+        if sys.version_info[0] < 3:
+            return todo_file
+        # Same decoding and newline handling as open(filename, "r")
+        return io.TextIOWrapper(todo_file)
+
+    def open_append(self, filename):
+        '''Returns a file object for appending to filename'''
+        raise NotImplementedError()
+
+    def open_replace(self, filename):
+        '''Returns a file object replacing filename on close()'''
+        raise NotImplementedError()
+
+    def exists(self, filename):
+        '''Returns True if filename exists'''
+        raise NotImplementedError()
+
+    def read_id_map_for_update(self, filename):
+        '''Returns (has_sidecar, id_map) of filename for changing it'''
+        if not self.local:
+            return (False, None)
+        return _read_id_map_for_update(filename)
+
+    def save_id_map(self, filename, has_sidecar, id_map):
+        '''Saves id_map after filename was changed'''
+        if self.local:
+            _save_id_map(filename, has_sidecar, id_map)
+
+    def get_append_offset(self, filename):
+        '''Returns the offset of the next line appended to filename'''
+        if not os.path.exists(filename):
+            return 0
+        return os.path.getsize(filename)
+
+    def ends_with_newline(self, filename):
+        '''Returns True if filename is empty or ends with a newline'''
+        if self.get_append_offset(filename) == 0:
+            return True
+        with open(filename, "rb") as todo_file:
+            todo_file.seek(-1, os.SEEK_END)
+            return todo_file.read(1) == b"\n"
+
+
+class _ReplaceFile(object):
+    '''File object of LocalFileStore.open_replace(): A temporary file in the
+    directory of filename, renamed to filename on close().'''
+
+    def __init__(self, filename, buffer_size):
+        self.filename = filename
+        (new_fd, self.new_filename) = tempfile.mkstemp(
+                dir=os.path.dirname(filename))
+        self.file = os.fdopen(new_fd, "wb", buffer_size)
+        self.write = self.file.write
+
+    def fileno(self):
+        '''Returns the file descriptor of the temporary file, e.g. for
+        copying data inside the kernel (see _copy_file_range())'''
+        return self.file.fileno()
+
+    def close(self):
+        '''Replaces filename with the written data'''
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        self.file.close()
+        if os.path.exists(self.filename):
+            shutil.copymode(self.filename, self.new_filename)
+        # Atomic on POSIX, the file is never missing or incomplete
+        os.rename(self.new_filename, self.filename)
+
+    def discard(self):
+        '''Drops the written data, filename is not changed'''
+        self.file.close()
+        os.remove(self.new_filename)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        '''close() or discard() if an exception was raised'''
+        if exc_type is None:
+            self.close()
+        else:
+            self.discard()
+
+
+class LocalFileStore(TodoStore):
+    '''Files in the local file system, read and written with buffers of
+    buffer_size bytes. Replaced files are written to a temporary file first
+    and renamed, so they are never missing or incomplete. Compressed files
+    are decompressed while reading (see open_compressed()).'''
+    local = True
+
+    def __init__(self, buffer_size=IO_BUFFER_SIZE):
+        self.buffer_size = buffer_size
+
+    def open_read(self, filename):
+        if is_compressed(filename):
+            return open_compressed(filename)
+        return open(filename, "rb", self.buffer_size)
+
+    def open_text(self, filename):
+        if is_compressed(filename):
+            return open_compressed(filename, True)
+        return open(filename, "r")
+
+    def open_append(self, filename):
+        return open(filename, "ab", self.buffer_size)
+
+    def open_replace(self, filename):
+        return _ReplaceFile(filename, self.buffer_size)
+
+    def exists(self, filename):
+        return os.path.isfile(filename)
+
+
+class _MmapFile(io.RawIOBase):
+    '''File object of MmapStore.open_read(), reads from the mapping'''
+
+    def __init__(self, mapped):
+        io.RawIOBase.__init__(self)
+        self.mapped = mapped
+        self.read = mapped.read
+        self.readline = mapped.readline
+        self.seek = mapped.seek
+        self.tell = mapped.tell
+
+    def __iter__(self):
+        return iter(self.mapped.readline, b"")
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer_):
+        '''Copies the next bytes of the mapping into buffer_, used by the
+        io.TextIOWrapper of MmapStore.open_text()'''
+        data = self.mapped.read(len(buffer_))
+        buffer_[:len(data)] = data
+        return len(data)
+
+    def close(self):
+        '''Unmaps the file'''
+        if not self.closed:
+            self.mapped.close()
+        io.RawIOBase.close(self)
+
+
+class MmapStore(LocalFileStore):
+    '''Same as LocalFileStore, but the files are read through mmap. Their
+    pages are mapped instead of being copied into read buffers, the text
+    lines of open_text() are decoded from the mapping, too.'''
+
+    def open_read(self, filename):
+        if is_compressed(filename):
+            return LocalFileStore.open_read(self, filename)
+        todo_file = open(filename, "rb")
+        if os.fstat(todo_file.fileno()).st_size == 0:
+            # Empty files cannot be mapped
+            todo_file.close()
+            return io.BytesIO(b"")
+        mapped = mmap.mmap(todo_file.fileno(), 0, access=mmap.ACCESS_READ)
+        todo_file.close()
+        return _MmapFile(mapped)
+
+    def open_text(self, filename):
+        if is_compressed(filename):
+            return LocalFileStore.open_text(self, filename)
+        todo_file = self.open_read(filename)
+        if sys.version_info[0] < 3:
+            # The lines of the mapping are the same as the ones of a file
+            # opened with "r"
+            return todo_file
+        if isinstance(todo_file, _MmapFile):
+            todo_file = io.BufferedReader(todo_file)
+        # Same decoding and newline handling as open(filename, "r")
+        return io.TextIOWrapper(todo_file)
+
+
+class _MemoryFile(io.BytesIO):
+    '''File object of MemoryStore.open_append() and open_replace()'''
+
+    def __init__(self, store, filename, append):
+        io.BytesIO.__init__(self)
+        self.store = store
+        self.filename = filename
+        self.append = append
+
+    def close(self):
+        '''Stores the written data'''
+        if not self.closed:
+            data = self.getvalue()
+            if self.append:
+                data = self.store.files.get(self.filename, b"") + data
+            self.store.files[self.filename] = data
+        io.BytesIO.close(self)
+
+    def discard(self):
+        '''Drops the written data'''
+        io.BytesIO.close(self)
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        '''close() or discard() if an exception was raised'''
+        if exc_type is None:
+            self.close()
+        else:
+            self.discard()
+
+
+class MemoryStore(TodoStore):
+    '''Keeps the files as bytes in the dict files (filename: content), e.g.
+    for tests and for benchmarks without disk I/O.'''
+
+    def __init__(self, files=None):
+        self.files = dict(files or {})
+
+    def open_read(self, filename):
+        if filename not in self.files:
+            raise IOError(errno.ENOENT, os.strerror(errno.ENOENT), filename)
+        return io.BytesIO(self.files[filename])
+
+    def open_append(self, filename):
+        return _MemoryFile(self, filename, True)
+
+    def open_replace(self, filename):
+        return _MemoryFile(self, filename, False)
+
+    def exists(self, filename):
+        return filename in self.files
+
+
+def _fsync_dir(dirname):
+    '''Makes the renames and new files in dirname durable'''
+    try:
+        dir_fd = os.open(dirname, os.O_RDONLY)
+    except OSError:
+        # Directories cannot be opened on all platforms
+        return
+    try:
+        os.fsync(dir_fd)
+    except OSError:
+        pass
+    os.close(dir_fd)
+
+
+class _CaptureFile(object):
+    '''File object of CaptureStore.open_append() and open_replace(): The
+    data is kept in a spooled temporary file, which has a fileno() for
+    _copy_file_range(), and passed to the store on close().'''
+
+    def __init__(self, store, action, filename):
+        self.store = store
+        self.action = action
+        self.filename = filename
+        self.file = tempfile.SpooledTemporaryFile(store.buffer_size)
+        self.write = self.file.write
+
+    def fileno(self):
+        '''Returns the file descriptor of the temporary file'''
+        return self.file.fileno()
+
+    def close(self):
+        '''Adds the written data to the changes of the store'''
+        if self.file.closed:
+            return
+        self.file.seek(0)
+        self.store.changes.append((self.action, self.filename,
+            self.file.read()))
+        self.file.close()
+
+    def discard(self):
+        '''Drops the written data'''
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        '''close() or discard() if an exception was raised'''
+        if exc_type is None:
+            self.close()
+        else:
+            self.discard()
+
+
+class CaptureStore(LocalFileStore):
+    '''
+    Reads the local files like LocalFileStore, but keeps the changes in
+    memory instead of changing the files, e.g. in the worker processes of
+    map_sources(): The replaced and appended data in changes, a list of
+    tuples (action, filename, data) with action "replace" or "append", and
+    the updated id maps. The store is picklable, so a worker can return it
+    and the calling process does the changes with apply(). Until then the
+    files are read unchanged.
+    '''
+
+    def __init__(self, buffer_size=IO_BUFFER_SIZE):
+        LocalFileStore.__init__(self, buffer_size)
+        self.changes = []
+        # filename: (has_sidecar, id_map)
+        self.id_maps = {}
+
+    def open_append(self, filename):
+        return _CaptureFile(self, "append", filename)
+
+    def open_replace(self, filename):
+        return _CaptureFile(self, "replace", filename)
+
+    def read_id_map_for_update(self, filename):
+        if filename in self.id_maps:
+            return self.id_maps[filename]
+        return LocalFileStore.read_id_map_for_update(self, filename)
+
+    def save_id_map(self, filename, has_sidecar, id_map):
+        if has_sidecar:
+            self.id_maps[filename] = (has_sidecar, id_map)
+
+    def get_append_offset(self, filename):
+        offset = LocalFileStore.get_append_offset(self, filename)
+        for (action, change_filename, data) in self.changes:
+            if action == "append" and change_filename == filename:
+                offset = offset + len(data)
+        return offset
+
+    def ends_with_newline(self, filename):
+        for (action, change_filename, data) in reversed(self.changes):
+            if action == "append" and change_filename == filename and \
+                    len(data) > 0:
+                return data.endswith(b"\n")
+        return LocalFileStore.ends_with_newline(self, filename)
+
+    def apply(self, store):
+        '''Does the changes through store, e.g. a JournalStore'''
+        for (action, filename, data) in self.changes:
+            if action == "replace":
+                new_file = store.open_replace(filename)
+            else:
+                new_file = store.open_append(filename)
+            new_file.write(data)
+            new_file.close()
+        for filename in sorted(self.id_maps):
+            (has_sidecar, id_map) = self.id_maps[filename]
+            store.save_id_map(filename, has_sidecar, id_map)
+
+
+class _JournalReplaceFile(_ReplaceFile):
+    '''File object of JournalStore.open_replace(): The temporary file is
+    renamed by JournalStore.commit().'''
+
+    def __init__(self, store, filename, buffer_size):
+        _ReplaceFile.__init__(self, filename, buffer_size)
+        self.store = store
+        # Removed by JournalStore.discard() even if close() is never called
+        store.open_replaces.append(self)
+
+    def close(self):
+        '''Adds the replacement to the journal'''
+        if self.file.closed:
+            return
+        # The fsync is done by JournalStore.commit() for all files at once
+        self.file.close()
+        if os.path.exists(self.filename):
+            shutil.copymode(self.filename, self.new_filename)
+        self.store.open_replaces.remove(self)
+        self.store.replaces.append((self.filename, self.new_filename))
+
+    def discard(self):
+        '''Drops the written data, filename is not changed'''
+        if self.file.closed:
+            return
+        _ReplaceFile.discard(self)
+        self.store.open_replaces.remove(self)
+
+
+class _JournalAppendFile(io.BytesIO):
+    '''File object of JournalStore.open_append()'''
+
+    def __init__(self, store, filename):
+        io.BytesIO.__init__(self)
+        self.store = store
+        self.filename = filename
+
+    def close(self):
+        '''Adds the appended data to the journal'''
+        if not self.closed:
+            self.store.appends.append((self.filename, self.getvalue()))
+        io.BytesIO.close(self)
+
+    def discard(self):
+        '''Drops the written data'''
+        io.BytesIO.close(self)
+
+
+def _redo_append(filename, size, data):
+    '''Appends data to filename which had size bytes before, unless it was
+    already (partly) appended. Idempotent, see recover_journal().'''
+    with open(filename, "ab+") as to_file:
+        to_file.seek(0, os.SEEK_END)
+        current_size = to_file.tell()
+        if current_size >= size:
+            to_file.seek(size)
+            written = to_file.read(len(data))
+            if written == data:
+                return
+            if size + len(written) == current_size and \
+                    data.startswith(written):
+                # Interrupted while appending
+                data = data[len(written):]
+        to_file.write(data)
+        to_file.flush()
+        os.fsync(to_file.fileno())
+
+
+def _apply_journal(replaces, appends):
+    '''Applies the changes of a journal: the list of (filename,
+    new_filename) is renamed and the list of (filename, size, data) is
+    appended. Already applied changes are skipped.'''
+    dirnames = set()
+    for (filename, new_filename) in replaces:
+        if os.path.exists(new_filename):
+            os.rename(new_filename, filename)
+        dirnames.add(os.path.dirname(filename))
+    for (filename, size, data) in appends:
+        _redo_append(filename, size, data)
+        dirnames.add(os.path.dirname(filename))
+    for dirname in dirnames:
+        _fsync_dir(dirname)
+
+
+class JournalStore(LocalFileStore):
+    '''
+    Same as LocalFileStore, but the replaced and appended files of several
+    calls (e.g. add_recur() and append_lines()) are changed together by
+    commit() through a write-ahead journal in journal_filename: The new data
+    is written to the journal first, then the files are changed. A crash in
+    between is repaired by recover_journal(), so either all or no changes are
+    done. Until commit() the files are read unchanged, discard() drops the
+    changes.
+
+    Group commit: All new files and the journal are synced once per
+    commit(), not once per call. The new files are written by the same code
+    as with LocalFileStore (e.g. copied inside the kernel by move_lines()),
+    only their rename is deferred. The updated id maps are kept until the
+    files are changed and saved by commit().
+    '''
+
+    def __init__(self, journal_filename, buffer_size=IO_BUFFER_SIZE):
+        LocalFileStore.__init__(self, buffer_size)
+        self.journal_filename = journal_filename
+        self.replaces = []
+        # Replace files which are not closed yet
+        self.open_replaces = []
+        self.appends = []
+        self.journal_appends = None
+        # filename: (has_sidecar, id_map), saved by commit()
+        self.id_maps = {}
+        self.lock = threading.Lock()
+
+    def open_append(self, filename):
+        return _JournalAppendFile(self, filename)
+
+    def open_replace(self, filename):
+        return _JournalReplaceFile(self, filename, self.buffer_size)
+
+    def read_id_map_for_update(self, filename):
+        with self.lock:
+            if filename in self.id_maps:
+                return self.id_maps[filename]
+        return LocalFileStore.read_id_map_for_update(self, filename)
+
+    def save_id_map(self, filename, has_sidecar, id_map):
+        if not has_sidecar:
+            return
+        with self.lock:
+            self.id_maps[filename] = (has_sidecar, id_map)
+
+    def get_append_offset(self, filename):
+        offset = LocalFileStore.get_append_offset(self, filename)
+        for (append_filename, data) in list(self.appends):
+            if append_filename == filename:
+                offset = offset + len(data)
+        return offset
+
+    def ends_with_newline(self, filename):
+        for (append_filename, data) in reversed(list(self.appends)):
+            if append_filename == filename and len(data) > 0:
+                return data.endswith(b"\n")
+        return LocalFileStore.ends_with_newline(self, filename)
+
+    def write_journal(self):
+        '''Makes the new files durable and writes the journal, the first
+        step of commit(). From here on the changes survive a crash.'''
+        for (_, new_filename) in self.replaces:
+            with open(new_filename, "rb") as new_file:
+                os.fsync(new_file.fileno())
+        # The appends to one file are joined, the size before is recorded
+        # to skip them if they are already done when recovering
+        datas = collections.OrderedDict()
+        for (filename, data) in self.appends:
+            datas[filename] = datas.get(filename, b"") + data
+        self.journal_appends = []
+        for (filename, data) in datas.items():
+            size = 0
+            if os.path.exists(filename):
+                size = os.path.getsize(filename)
+            if len(data) > 0:
+                self.journal_appends.append((filename, size, data))
+        header = json.dumps({"replace": self.replaces,
+            "append": [(filename, size, len(data))
+                for (filename, size, data) in self.journal_appends]})
+        content = b"todotxt-journal 1\n" + header.encode("utf-8") + b"\n" + \
+                b"".join([data for (_, _, data) in self.journal_appends])
+        content = content + hashlib.sha1(content).hexdigest().encode(
+                "ascii") + b"\n"
+        journal_fd = os.open(self.journal_filename,
+                os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+        _write_all(journal_fd, content)
+        os.fsync(journal_fd)
+        os.close(journal_fd)
+        _fsync_dir(os.path.dirname(os.path.abspath(self.journal_filename)))
+
+    def commit(self):
+        '''Changes the files and saves their id maps, see JournalStore'''
+        if len(self.replaces) > 0 or len(self.appends) > 0:
+            self.write_journal()
+            _apply_journal(self.replaces, self.journal_appends)
+            os.remove(self.journal_filename)
+        # After a crash before this point the sidecars are out of date and
+        # are rebuilt by the next change
+        for filename in sorted(self.id_maps):
+            (has_sidecar, id_map) = self.id_maps[filename]
+            _save_id_map(filename, has_sidecar, id_map)
+        self.replaces = []
+        self.appends = []
+        self.id_maps = {}
+
+    def discard(self):
+        '''Drops the changes, no file is changed. The temporary files of
+        unclosed replace files are removed, too.'''
+        for replace_file in list(self.open_replaces):
+            replace_file.discard()
+        for (_, new_filename) in self.replaces:
+            os.remove(new_filename)
+        self.replaces = []
+        self.appends = []
+        self.id_maps = {}
+
+
+def recover_journal(journal_filename):
+    '''
+    Completes the changes of a JournalStore.commit() interrupted by a crash.
+    A journal which was not written completely is removed together with the
+    new files, the files were not changed then. Call it before changing the
+    files again. Returns True if a journal was found.
+    '''
+    try:
+        journal_file = open(journal_filename, "rb")
+    except IOError as error:
+        if error.errno != errno.ENOENT:
+            raise
+        return False
+    with journal_file:
+        content = journal_file.read()
+    lines = content.split(b"\n", 2)
+    header = None
+    if len(lines) == 3 and lines[0] == b"todotxt-journal 1":
+        try:
+            header = json.loads(lines[1].decode("utf-8"))
+        except ValueError:
+            header = None
+    is_complete = header is not None and len(content) > 41 and \
+            hashlib.sha1(content[:-41]).hexdigest().encode("ascii") == \
+            content[-41:-1]
+    if is_complete:
+        offset = len(lines[0]) + len(lines[1]) + 2
+        appends = []
+        for (filename, size, length) in header["append"]:
+            appends.append((filename, size, content[offset:offset + length]))
+            offset = offset + length
+        _apply_journal(header["replace"], appends)
+    elif header is not None:
+        for (_, new_filename) in header["replace"]:
+            if os.path.exists(new_filename):
+                os.remove(new_filename)
+    os.remove(journal_filename)
+    return True
+
+
+# Store used by the library functions if none is given
+_LOCAL_FILE_STORE = LocalFileStore()
+
+
+def _get_store(store):
+    '''Returns store or the default LocalFileStore if it is None'''
+    if store is None:
+        return _LOCAL_FILE_STORE
+    return store
 
 
 def get_key_search_pattern(key):
     '''Returns the re search pattern for a given key'''
-    return "(^|(?P<spaces>\s))" + key + ":" + "(?P<value>\\S+)"
+    return "(^|(?P<spaces>\s))" + re.escape(key) + ":" + "(?P<value>\\S+)"
 
 
 def get_key(line, key):
     '''
     Returns a value referenced by key from a todo line (first occurence).
-    Returns None if key is not found
+    Returns None if key is not found. line may be str or bytes, the value is
+    of the same type.
     '''
-    pattern = get_key_search_pattern(key)
+    pattern = _as_line_type(line, get_key_search_pattern(key))
     result = re.search(pattern, line)
     if result != None:
         return result.group("value")
@@ -54,85 +827,459 @@ def get_key(line, key):
 def set_key(line, key, value):
     '''
     Sets or adds (if not existent) a key inside the line to a value. If value
-    is None, the key is deleted completely.
+    is None, the key is deleted completely. line may be str or bytes.
     Returns the changed line.
     '''
-    search_pattern = get_key_search_pattern(key)
-    replace_pattern = ""
+    search_pattern = _as_line_type(line, get_key_search_pattern(key))
+    empty = _as_line_type(line, "")
+    key = _as_line_type(line, key)
     if value is not None:
-        replace_pattern = "\\g<spaces>" + key + ":" + value
+        value = _as_line_type(line, value)
+
+    def replace(match):
+        '''Returns the replacement for a key:value. A key at the start of
+        the line has no spaces, Python 2 rejects the unmatched group in a
+        replacement template.'''
+        if value is None:
+            return empty
+        return (match.group("spaces") or empty) + key + \
+                _as_line_type(line, ":") + value
 
-    (new_line, number_of_subs_made) = re.subn(
-            search_pattern, replace_pattern, line)
+    (new_line, number_of_subs_made) = re.subn(search_pattern, replace, line)
     if number_of_subs_made == 0 and value is not None:
         if len(line) > 0:
-            new_line = line + " "
-        new_line = new_line + key + ":" + value
+            new_line = line + _as_line_type(line, " ")
+        new_line = new_line + key + _as_line_type(line, ":") + value
     return new_line
 
 
-def add_interval(date_str, interval):
+def set_keys(line, edits):
     '''
-    Adds an interval to an iso8601 date and returns the result
+    Same as calling set_key() for each (key, value) in edits, but all keys are
+    changed in a single pass over the line. edits is a list of (key, value)
+    tuples or a dict. Keys which are not found are added in the order of
+    edits. An edit list which repeats a key is applied edit by edit with
+    set_key(). line may be str or bytes.
+    Returns the changed line.
+    '''
+    if hasattr(edits, "items"):
+        edits = list(edits.items())
+    keys = []
+    values = {}
+    for (key, value) in edits:
+        key = _as_line_type(line, key)
+        if value is not None:
+            value = _as_line_type(line, value)
+        if key in values:
+            for (key, value) in edits:
+                line = set_key(line, key, value)
+            return line
+        keys.append(key)
+        values[key] = value
+    if len(keys) == 0:
+        return line
 
-    Parameters:
+    empty = _as_line_type(line, "")
+    colon = _as_line_type(line, ":")
+    # Keys are literal text, e.g. "due.x" must not match "duetx"
+    search_pattern = _as_line_type(line, "(^|(?P<spaces>\\s))(?P<key>") + \
+            _as_line_type(line, "|").join(
+                [re.escape(key) for key in keys]) + \
+            _as_line_type(line, "):(?P<value>\\S+)")
+    found_keys = set()
 
-    - date: date string in ISO8601 format: "2015-01-01"
-    - interval: textual representation of an time interval: number + qualifier,
-    e.g. "1y". Valid qualifiers are
+    def replace(match):
+        '''Returns the replacement for a single key:value'''
+        key = match.group("key")
+        found_keys.add(key)
+        if values[key] is None:
+            return empty
+        return (match.group("spaces") or empty) + key + colon + values[key]
+
+    new_line = re.sub(search_pattern, replace, line)
+    added_keys = [key for key in keys
+            if key not in found_keys and values[key] is not None]
+    if len(added_keys) > 0 and len(new_line) == 0 and len(line) > 0:
+        # The space in front of an added key depends on the order of the
+        # edits if the removed keys leave an empty line
+        for (key, value) in edits:
+            line = set_key(line, key, value)
+        return line
+    for key in added_keys:
+        if len(new_line) > 0:
+            new_line = new_line + _as_line_type(line, " ")
+        new_line = new_line + key + colon + values[key]
+    return new_line
+
+
+def get_priority(line):
+    '''Returns the priority ("(A) Task") of a todo line or None. line may be
+    str or bytes.'''
+    pattern = _as_line_type(line, "^\\((?P<priority>[A-Z])\\) ")
+    result = re.match(pattern, line)
+    if result != None:
+        return result.group("priority")
+    return None
+
+
+def get_projects(line):
+    '''Returns the list of projects ("+project") of a todo line, without the
+    "+". line may be str or bytes.'''
+    return re.findall(_as_line_type(line, "(?:^|\\s)\\+(\\S+)"), line)
+
+
+def get_contexts(line):
+    '''Returns the list of contexts ("@context") of a todo line, without the
+    "@". line may be str or bytes.'''
+    return re.findall(_as_line_type(line, "(?:^|\\s)@(\\S+)"), line)
+
+
+def parse_recurrence(rec):
+    '''
+    Parses a recurrence rule (the value of "rec:") and returns a tuple
+    (number, qualifier, from_completion) or None for an invalid rule.
+
+    The rule is a number + qualifier, e.g. "2w", valid qualifiers are
         - "y": year
         - "m": month
         - "w": week
         - "d": day
+        - "b": business day (Monday to Friday)
+    A leading "+" (e.g. "+1w") marks a rule counted from completion: only
+    the next occurrence is due, missed occurrences are not repeated.
     '''
-    date = datetime.datetime.strptime(date_str, "%Y-%m-%d")
-    pattern = "(?P<number>\d+)(?P<qual>[ymwd])"
-    result = re.search(pattern, interval)
+    if isinstance(rec, bytes):
+        rec = rec.decode("latin-1")
+    pattern = "(?P<from_completion>[+])?(?P<number>[0-9]+)(?P<qual>[ymwdb])"
+    result = re.search(pattern, rec)
 
     if result is None:
         return None
 
-    number = int(result.group("number"))
-    qual = result.group("qual")
+    return (int(result.group("number")), result.group("qual"),
+            result.group("from_completion") is not None)
+
+
+def parse_date(date_str):
+    '''Returns the datetime.date of an ISO 8601 date string (str or bytes)
+    like "2015-01-01" or None if it is not a valid date.'''
+    if isinstance(date_str, bytes):
+        date_str = date_str.decode("latin-1")
+    if re.match("^[0-9]{4}-[0-9]{2}-[0-9]{2}$", date_str) is None:
+        return None
+    try:
+        return datetime.date(int(date_str[0:4]), int(date_str[5:7]),
+                int(date_str[8:10]))
+    except ValueError:
+        return None
+
+
+def _add_months(date, months):
+    '''Adds calendar months to date, the day is clamped to the end of the
+    month (2015-01-31 + 1 month is 2015-02-28).'''
+    month0 = date.month - 1 + months
+    year = date.year + month0 // 12
+    month = month0 % 12 + 1
+    return datetime.date(year, month,
+            min(date.day, calendar.monthrange(year, month)[1]))
+
+
+def _add_business_days(date, number):
+    '''Adds number business days (Monday to Friday) to date.'''
+    if date.weekday() >= 5:
+        # Counting from a weekend is counting from the Friday before
+        date = date - datetime.timedelta(days=date.weekday() - 4)
+    (weeks, number) = divmod(number, 5)
+    date = date + datetime.timedelta(days=7 * weeks)
+    while number > 0:
+        date = date + datetime.timedelta(days=1)
+        if date.weekday() < 5:
+            number = number - 1
+    return date
+
+
+def next_recurrence(date, rule, calendar_months=False):
+    '''
+    Returns the occurrence (datetime.date) after date for the rule of
+    parse_recurrence(). Months and years are 30 and 365 days unless
+    calendar_months is set.
+    '''
+    (number, qual, _) = rule
+    if qual == "b":
+        return _add_business_days(date, number)
+    if calendar_months and qual in ("m", "y"):
+        return _add_months(date, number * (12 if qual == "y" else 1))
+    nr_days = number * {"y": 365, "m": 30, "w": 7, "d": 1}[qual]
+    return date + datetime.timedelta(days=nr_days)
+
+
+def add_interval(date_str, interval):
+    '''
+    Adds an interval to an iso8601 date and returns the result
+
+    Parameters:
+
+    - date: date string in ISO8601 format: "2015-01-01"
+    - interval: textual representation of an time interval: number + qualifier,
+    e.g. "1y". See parse_recurrence() for the valid qualifiers, months and
+    years have a fixed length of 30 and 365 days.
+    '''
+    date = datetime.datetime.strptime(date_str, "%Y-%m-%d").date()
+    rule = parse_recurrence(interval)
+
+    if rule is None:
+        return None
+
+    return next_recurrence(date, rule).strftime("%Y-%m-%d")
+
+
+def iter_recurrence(threshold, rule, max_threshold, calendar_months=False):
+    '''
+    Lazily yields the occurrences (datetime.date) of a recurring task with
+    the first occurrence threshold and the rule of parse_recurrence() up to
+    max_threshold. For rules counted from completion only the first
+    occurrence is yielded.
+    '''
+    if rule is None or rule[0] == 0:
+        return
+    date = threshold
+    while date <= max_threshold:
+        yield date
+        if rule[2]:
+            return
+        date = next_recurrence(date, rule, calendar_months)
+
+
+def _get_next_threshold_steps(threshold, rule, max_threshold,
+        calendar_months):
+    '''Returns the tuple (date, steps) with the result of
+    get_next_threshold() and the number of computed recurrences.'''
+    date = threshold
+    steps = 0
+    while date <= max_threshold:
+        date = next_recurrence(date, rule, calendar_months)
+        steps = steps + 1
+    return (date, steps)
+
+
+def get_next_threshold(threshold, rule, max_threshold, calendar_months=False):
+    '''Returns the first occurrence after max_threshold of a recurring task
+    with the first occurrence threshold (all datetime.date), i.e. its new
+    threshold after adding the occurrences up to max_threshold.'''
+    return _get_next_threshold_steps(threshold, rule, max_threshold,
+            calendar_months)[0]
+
+
+def parse_catchup(policy):
+    '''
+    Parses a catch-up policy (the value of "catchup:", str or bytes) and
+    returns the maximum number of missed occurrences a recurring task adds,
+    None for all. Valid policies are
+        - "all": every missed occurrence
+        - "latest": only the latest missed occurrence
+        - a number N: the latest N missed occurrences
+    Raises ValueError for an invalid policy.
+    '''
+    if isinstance(policy, bytes):
+        policy = policy.decode("latin-1")
+    if policy == "all":
+        return None
+    if policy == "latest":
+        return 1
+    if re.match("^[0-9]+$", policy) is None:
+        raise ValueError("Invalid catch-up policy: " + policy)
+    return int(policy)
+
+
+def _advance_recurrence(date, rule, steps, calendar_months):
+    '''Returns the occurrence steps recurrences after date. Rules of a fixed
+    number of days and business days are computed arithmetically.'''
+    if steps == 0:
+        return date
+    (number, qual, _) = rule
+    if qual == "b":
+        return _add_business_days(date, number * steps)
+    if calendar_months and qual in ("m", "y"):
+        # The clamped day of a month carries over to the next occurrences
+        for _ in range(steps):
+            date = _add_months(date, number * (12 if qual == "y" else 1))
+        return date
+    nr_days = number * {"y": 365, "m": 30, "w": 7, "d": 1}[qual]
+    return date + datetime.timedelta(days=nr_days * steps)
+
+
+def _count_recurrences_before(date, rule, until, calendar_months):
+    '''Returns the number of occurrences before until (datetime.date) of a
+    recurring task with the first occurrence date.'''
+    delta = (until - date).days
+    if delta <= 0:
+        return 0
+    (number, qual, _) = rule
+    steps = 0
+    if qual == "b":
+        # Lower bound, number * steps business days span less than delta
+        steps = max(0, ((delta // 7) * 5 - 10) // number)
+    elif not (calendar_months and qual in ("m", "y")):
+        nr_days = number * {"y": 365, "m": 30, "w": 7, "d": 1}[qual]
+        return -(-delta // nr_days)
+    date = _advance_recurrence(date, rule, steps, calendar_months)
+    while date < until:
+        date = next_recurrence(date, rule, calendar_months)
+        steps = steps + 1
+    return steps
+
+
+def skip_recurrences(threshold, rule, now, max_missed, calendar_months=False):
+    '''
+    Applies a catch-up policy (see parse_catchup()) to a recurring task with
+    the first occurrence threshold: returns the first occurrence
+    (datetime.date) to add, so that at most max_missed occurrences before now
+    are added. The skipped occurrences are not enumerated. Rules counted from
+    completion are not changed, they add a single occurrence anyway.
+    '''
+    if max_missed is None or rule is None or rule[0] == 0 or rule[2]:
+        return threshold
+    steps = _count_recurrences_before(threshold, rule, now, calendar_months)
+    return _advance_recurrence(threshold, rule, max(steps - max_missed, 0),
+            calendar_months)
+
+
+def normalize_line(line):
+    '''Returns the bytes line without completion mark and date ("x 2015-01-01
+    ") and with whitespace runs collapsed to single spaces, so a task is
+    found in todo.txt after it was completed or reformatted.'''
+    line = _as_line_type(b"", line)
+    line = re.sub(b"^x ([0-9]{4}-[0-9]{2}-[0-9]{2} )?", b"", line.strip())
+    return b" ".join(line.split())
+
+
+def get_line_hash(line):
+    '''Returns the hash (LINE_HASH_SIZE bytes) of the normalized line (see
+    normalize_line()).'''
+    return hashlib.sha1(normalize_line(line)).digest()[:LINE_HASH_SIZE]
+
+
+def read_line_hashes(todo_filename, store=None):
+    '''
+    Returns the set of the hashes of all non empty lines in todo_filename
+    (see get_line_hash()). The persisted hashes (todo_filename +
+    LINE_HASHES_SUFFIX, see write_line_hashes()) are used if they are up to
+    date, otherwise todo_filename is read. Only local stores have persisted
+    hashes.
+    '''
+    store = _get_store(store)
+    hashes_filename = todo_filename + LINE_HASHES_SUFFIX
+    if store.local and os.path.isfile(hashes_filename):
+        stat_result = os.stat(todo_filename)
+        hashes_file = open(hashes_filename, "rb")
+        # Header: size and modification time of todo_filename
+        header = hashes_file.readline().split()
+        if len(header) == 2 and int(header[0]) == stat_result.st_size and \
+                int(header[1]) == get_mtime_ns(stat_result):
+            data = hashes_file.read()
+            hashes_file.close()
+            return set([data[pos:pos + LINE_HASH_SIZE]
+                for pos in range(0, len(data), LINE_HASH_SIZE)])
+        hashes_file.close()
+
+    hashes = set()
+    todo_file = store.open_read(todo_filename)
+    for line in todo_file:
+        if len(line.strip()) > 0:
+            hashes.add(get_line_hash(line))
+    todo_file.close()
+    return hashes
+
+
+def write_line_hashes(todo_filename, hashes):
+    '''Persists the set of line hashes of todo_filename as returned by
+    read_line_hashes(). Call it after changing todo_filename.'''
+    stat_result = os.stat(todo_filename)
+    (new_fd, new_filename) = tempfile.mkstemp(
+            dir=os.path.dirname(todo_filename))
+    new_file = os.fdopen(new_fd, "wb", IO_BUFFER_SIZE)
+    new_file.write(("%d %d\n" % (stat_result.st_size,
+        get_mtime_ns(stat_result))).encode("ascii"))
+    new_file.write(b"".join(sorted(hashes)))
+    new_file.close()
+    os.rename(new_filename, todo_filename + LINE_HASHES_SUFFIX)
+
 
-    delta = None
-    nr_days = 0
+def add_line_hash(hashes, line):
+    '''Adds the hash of line to the set hashes. Returns False if it was
+    already in it.'''
+    line_hash = get_line_hash(line)
+    with _LINE_HASHES_LOCK:
+        if line_hash in hashes:
+            return False
+        hashes.add(line_hash)
+    return True
 
-    if qual == "y":
-        nr_days = number * 365
-    elif qual == "m":
-        nr_days = number * 30
-    elif qual == "w":
-        nr_days = number * 7
-    elif qual == "d":
-        nr_days = number
-    delta = datetime.timedelta(days = nr_days)
 
-    final_date = date + delta
-    return final_date.strftime("%Y-%m-%d")
+def _get_catchup(line, catchup):
+    '''Returns the catch-up policy of the "catchup:" tag of line, catchup if
+    it is missing or invalid'''
+    policy = get_key(line, "catchup")
+    if policy is None:
+        return catchup
+    try:
+        return parse_catchup(policy)
+    except ValueError:
+        return catchup
 
 
-def add_recur(from_filename, to_filename, max_threshold, is_dryrun):
+def add_recur(from_filename, to_filename, max_threshold, is_dryrun,
+        record_callback=None, calendar_months=False, dedup=False, store=None,
+        metrics=None, catchup=None, now=None):
     '''
     Adds recurring tasks from from_filename to to_filename.
     A single repeating task may be added several times, depending on how many
     intervals fit in the timeframe until max_threshold is reached.
     In to_filename the "rec:" tag is stripped, in from_filename the "t:"
     tag is changed to the date of the next recurrence (the first one later as
-    max_threshold).
+    max_threshold). Rules counted from completion ("rec:+1w") are added at
+    most once per call. The catch-up policy ("catchup:" tag or catchup, see
+    parse_catchup()) limits the occurrences before now which are added, the
+    "catchup:" tag is stripped in to_filename, too. Lines with an invalid rule
+    or threshold date are not changed. The id maps of both files are updated if they exist (see
+    build_id_map()).
 
     Parameters:
         - max_threshold: maximum threshold date in ISO 8601 text format
         - is_dryrun: Do not change file, only return changed lines
+        - record_callback: If set, it is called for every new/updated line
+          as record_callback(key, line_nr, threshold, line) with key "to"
+          or "from", line_nr is the line number in from_filename. The lines
+          are then not collected in the returned dictionary.
+        - calendar_months: Use calendar months and years instead of 30 and
+          365 days for the "m" and "y" rules (see next_recurrence())
+        - dedup: Do not add lines which are already in to_filename (compared
+          with normalize_line()), e.g. after an interrupted run or when
+          from_filename was restored from a backup. The skipped lines are
+          returned under the key "skipped" or passed to record_callback
+          with key "skipped". The line hashes of to_filename are persisted
+          (see read_line_hashes()). dedup may also be a set of line hashes
+          shared by concurrent calls, it is updated but not persisted.
+        - to_filename: If None the new lines are not written but returned
+          with line endings under the key "append" (see append_lines()),
+          unless is_dryrun is set
+        - store: TodoStore for the file access, defaults to the local files
+        - metrics: dict for the run metrics (see add_metric())
+        - catchup: Catch-up policy of the tasks without "catchup:" tag as
+          returned by parse_catchup(), defaults to all occurrences
+        - now: Occurrences before now (datetime.date, defaults to today) are
+          missed ones for the catch-up policy
     Returns:
-        Dictionary with information with new/updated lines in to/from file, e.g.:
+        Dictionary with information with new/updated lines in to/from file.
+        The files are processed as raw bytes, so the lines are bytes, too
+        (use decode_line() to display them), e.g.:
         { "from": [
-            "Task1 t:2015-07-15 rec:2w",
-            "Task2 t:2015-07-22 rec:1m"
+            b"Task1 t:2015-07-15 rec:2w",
+            b"Task2 t:2015-07-22 rec:1m"
             ],
           "to": [
-            "Task1 t:2015-07-01",
-            "Task2 t:2015-06-22"
+            b"Task1 t:2015-07-01",
+            b"Task2 t:2015-06-22"
             ]
         }
     '''
@@ -141,77 +1288,407 @@ def add_recur(from_filename, to_filename, max_threshold, is_dryrun):
     result["from"] = []
     result["to"] = []
 
-    from_file = open(from_filename, "r")
+    # All lines are processed as bytes, only "t:" and "rec:" are inspected
+    store = _get_store(store)
+    max_date = parse_date(max_threshold)
+    if now is None:
+        now = datetime.date.today()
+    # Occurrences after max_threshold are never missed ones
+    catchup_until = min(now, max_date + datetime.timedelta(days=1))
+    from_file = store.open_read(from_filename)
 
     if not is_dryrun:
-        new_from_file = tempfile.NamedTemporaryFile(mode="a",
-                dir=os.path.dirname(from_filename), delete=False)
-        new_from_filename = new_from_file.name
+        new_from_file = store.open_replace(from_filename)
 
+    to_file = None
+    if not is_dryrun and to_filename is not None:
+        to_file = store.open_append(to_filename)
+
+    if to_filename is None and not is_dryrun:
+        result["append"] = []
+    if isinstance(dedup, set):
+        result["skipped"] = []
+        hashes = dedup
+    elif dedup:
+        result["skipped"] = []
+        hashes = read_line_hashes(to_filename, store)
+
+    # The id maps are only updated if they exist and are up to date
+    (from_has_ids, from_id_map) = (False, None)
+    (to_has_ids, to_id_map) = (False, None)
     if not is_dryrun:
-        to_file = open(to_filename, "a")
+        (from_has_ids, from_id_map) = store.read_id_map_for_update(
+                from_filename)
+        (to_has_ids, to_id_map) = store.read_id_map_for_update(to_filename)
+        lines_to_file = []
+    if to_id_map is not None and not store.ends_with_newline(to_filename):
+        # The first new line is joined with the last line, rebuilt on save
+        to_id_map = None
+    if to_id_map is not None:
+        to_size = store.get_append_offset(to_filename)
+    if from_id_map is not None:
+        old_ids = dict([(offset, task_id) for (task_id, (_, offset))
+            in from_id_map["ids"].items()])
+        from_id_map = {"ids": {}, "lines": 0}
+        changed_lines = []
+        old_offset = 0
+        new_offset = 0
 
-    for line in from_file:
+    # Counted locally, added to metrics at the end
+    nr_of_lines = 0
+    nr_of_added_lines = 0
+    nr_of_skipped_lines = 0
+    nr_of_steps = 0
+    bytes_read = 0
+    bytes_written = 0
+
+    for line_nr, line in enumerate(from_file, start=1):
+        nr_of_lines = line_nr
+        bytes_read = bytes_read + len(line)
         rec = get_key(line, "rec")
         threshold = get_key(line, "t")
         old_threshold = threshold
+        rule = None
         if rec != None and threshold != None:
-            # string comparison, works with ISO8601
-            while threshold <= max_threshold:
-                line_to_file = set_key(line, "rec", None)
-                line_to_file = set_key(line_to_file, "t", threshold)
-                if not is_dryrun:
+            rule = parse_recurrence(rec)
+            date = parse_date(threshold)
+        if rule is not None and rule[0] > 0 and date is not None:
+            date = skip_recurrences(date, rule, catchup_until,
+                    _get_catchup(line, catchup), calendar_months)
+            for date in iter_recurrence(date, rule, max_date,
+                    calendar_months):
+                nr_of_steps = nr_of_steps + 1
+                threshold = _as_line_type(line, date.strftime("%Y-%m-%d"))
+                line_to_file = set_keys(line,
+                        [("rec", None), ("catchup", None), ("t", threshold)])
+                if dedup is not False and \
+                        not add_line_hash(hashes, line_to_file):
+                    nr_of_skipped_lines = nr_of_skipped_lines + 1
+                    if record_callback is None:
+                        result["skipped"].append(line_to_file.strip())
+                    else:
+                        record_callback("skipped", line_nr, threshold,
+                                line_to_file.strip())
+                    continue
+                nr_of_added_lines = nr_of_added_lines + 1
+                if to_file is not None:
                     to_file.write(line_to_file)
-                result["to"].append(line_to_file.strip())
-                threshold = add_interval(threshold, rec)
+                    bytes_written = bytes_written + len(line_to_file)
+                elif not is_dryrun:
+                    result["append"].append(line_to_file)
+                if to_id_map is not None:
+                    lines_to_file.append(line_to_file)
+                if record_callback is None:
+                    result["to"].append(line_to_file.strip())
+                else:
+                    record_callback("to", line_nr, threshold,
+                            line_to_file.strip())
+            (date, steps) = _get_next_threshold_steps(date, rule, max_date,
+                    calendar_months)
+            nr_of_steps = nr_of_steps + steps
+            threshold = _as_line_type(line, date.strftime("%Y-%m-%d"))
         line_from_file = set_key(line, "t", threshold)
         if not is_dryrun:
             new_from_file.write(line_from_file)
+            bytes_written = bytes_written + len(line_from_file)
+        if from_id_map is not None:
+            # Unchanged lines keep their id, changed ones get a new one
+            from_id_map["lines"] = line_nr
+            if line_from_file == line and old_offset in old_ids:
+                from_id_map["ids"][old_ids[old_offset]] = (line_nr, new_offset)
+            elif len(line.strip()) > 0:
+                changed_lines.append((line_nr, new_offset, line_from_file))
+            old_offset = old_offset + len(line)
+            new_offset = new_offset + len(line_from_file)
         if old_threshold != threshold:
-            result["from"].append(line_from_file.strip())
+            if record_callback is None:
+                result["from"].append(line_from_file.strip())
+            else:
+                record_callback("from", line_nr, threshold,
+                        line_from_file.strip())
 
     from_file.close()
     if not is_dryrun:
+        if to_file is not None:
+            to_file.close()
         new_from_file.close()
-        to_file.close()
-        os.remove(from_filename)
-        os.rename(new_from_filename, from_filename)
+        if from_id_map is not None:
+            for (line_nr, offset, line) in changed_lines:
+                _add_task_id(from_id_map, line, line_nr, offset)
+        if to_id_map is not None:
+            _append_to_id_map(to_id_map, to_size, lines_to_file)
+        store.save_id_map(from_filename, from_has_ids, from_id_map)
+        store.save_id_map(to_filename, to_has_ids, to_id_map)
+        if dedup is True and store.local:
+            write_line_hashes(to_filename, hashes)
 
+    add_metrics(metrics, {"lines_scanned": nr_of_lines,
+        "lines_added": nr_of_added_lines,
+        "lines_skipped": nr_of_skipped_lines,
+        "recurrence_steps": nr_of_steps, "bytes_read": bytes_read,
+        "bytes_written": bytes_written})
     return result
 
 
-def move_lines(from_filename, to_filename, line_nrs, preserve_line_nrs):
+def _write_all(fd, data):
+    '''Writes all of data to the file descriptor fd'''
+    data = memoryview(data)
+    while len(data) > 0:
+        written = os.write(fd, data)
+        data = data[written:]
+
+
+def _copy_file_range(src_fd, dst_fd, offset, count):
+    '''
+    Copies count bytes starting at offset of src_fd to the current position of
+    dst_fd. The copy is done inside the kernel with os.copy_file_range() or
+    os.sendfile() if available, otherwise a buffered copy is done.
+    '''
+    end = offset + count
+    if hasattr(os, "copy_file_range"):
+        try:
+            while offset < end:
+                copied = os.copy_file_range(src_fd, dst_fd, end - offset,
+                        offset)
+                if copied == 0:
+                    break
+                offset = offset + copied
+        except OSError:
+            # Not supported for these files, try the next method
+            pass
+    if offset < end and hasattr(os, "sendfile"):
+        try:
+            while offset < end:
+                copied = os.sendfile(dst_fd, src_fd, offset, end - offset)
+                if copied == 0:
+                    break
+                offset = offset + copied
+        except OSError:
+            pass
+    if offset < end:
+        os.lseek(src_fd, offset, os.SEEK_SET)
+        while offset < end:
+            data = os.read(src_fd, min(IO_BUFFER_SIZE, end - offset))
+            if len(data) == 0:
+                break
+            _write_all(dst_fd, data)
+            offset = offset + len(data)
+
+
+def _find_line_ranges(from_file, line_nrs):
+    '''
+    Returns the sorted list of byte ranges (start, end) of the lines
+    referenced in line_nrs (first line is 1) of the file opened in binary
+    mode. Line numbers after the end of the file are ignored.
+    Newlines are counted per chunk of the file, only the chunks containing
+    referenced lines are searched line by line.
+    '''
+    ranges = []
+    wanted = sorted(set([line_nr for line_nr in line_nrs if line_nr > 0]))
+    idx = 0
+    # Number and start offset of the current line
+    line_nr = 1
+    line_start = 0
+    # Offset of the current chunk
+    offset = 0
+    from_file.seek(0)
+    while idx < len(wanted):
+        chunk = from_file.read(IO_BUFFER_SIZE)
+        if len(chunk) == 0:
+            break
+        pos = 0
+        while idx < len(wanted):
+            skip = wanted[idx] - line_nr
+            if skip > 0:
+                nr_of_newlines = chunk.count(b"\n", pos)
+                if nr_of_newlines < skip:
+                    # Wanted line starts in one of the next chunks
+                    if nr_of_newlines > 0:
+                        line_nr = line_nr + nr_of_newlines
+                        line_start = offset + chunk.rfind(b"\n") + 1
+                    break
+                for _ in range(skip):
+                    pos = chunk.find(b"\n", pos) + 1
+                line_nr = wanted[idx]
+                line_start = offset + pos
+            newline_pos = chunk.find(b"\n", pos)
+            if newline_pos < 0:
+                # Wanted line ends in one of the next chunks
+                break
+            pos = newline_pos + 1
+            ranges.append((line_start, offset + pos))
+            idx = idx + 1
+            line_nr = line_nr + 1
+            line_start = offset + pos
+        offset = offset + len(chunk)
+
+    # Last line without newline at the end
+    if idx < len(wanted) and wanted[idx] == line_nr and line_start < offset:
+        ranges.append((line_start, offset))
+    return ranges
+
+
+def move_lines(from_filename, to_filename, line_nrs, preserve_line_nrs,
+        store=None, metrics=None):
     '''
     Copies the lines referenced in the list line_nrs from from_filename to
-    to_filename and deletes empty lines in from_filename
+    to_filename and deletes empty lines in from_filename. Returns the moved
+    lines, if to_filename is None they are only removed from from_filename
+    (see append_lines()).
     If preserve_line_nrs is set to True, then the moved lines in from_file
     are replaced by empty lines. If preserve_line_nrs is set to False they are
-    removed completely, so the line numbers are changing.'''
+    removed completely, so the line numbers are changing.
+    The lines are copied as raw bytes, they are not decoded. The unchanged
+    parts of from_filename are copied inside the kernel where possible (see
+    _copy_file_range()), the moved lines are appended with a single write.
+    The id maps of both files are updated if they exist (see build_id_map()).
+    With a local store the new from_filename is written to the file of its
+    open_replace() (e.g. the journal of JournalStore), with a store which is
+    not local (see TodoStore) the lines are copied through its file objects.
+    metrics is a dict for the run metrics (see add_metric()).'''
 
-    new_from_file = tempfile.NamedTemporaryFile(mode="a",
-            dir=os.path.dirname(from_filename), delete=False)
-    new_from_filename = new_from_file.name
+    store = _get_store(store)
+    if not store.local:
+        return _move_lines_store(from_filename, to_filename, line_nrs,
+                preserve_line_nrs, store, metrics)
 
-    from_file = open(from_filename, "r")
-    to_file = open(to_filename, "a")
+    (from_has_ids, from_id_map) = store.read_id_map_for_update(from_filename)
 
-    for line_nr, line in enumerate(from_file, start=1):
-        if line_nr in line_nrs:
-            if preserve_line_nrs:
-                new_from_file.write("\n")
-            to_file.write(line)
-        else:
-            new_from_file.write(line)
-    to_file.close()
+    new_from_file = store.open_replace(from_filename)
+    new_from_fd = new_from_file.fileno()
+    from_file = open(from_filename, "rb", IO_BUFFER_SIZE)
+    from_fd = from_file.fileno()
+
+    moved_lines = []
+    pos = 0
+    ranges = _find_line_ranges(from_file, line_nrs)
+    for (start, end) in ranges:
+        _copy_file_range(from_fd, new_from_fd, pos, start - pos)
+        if preserve_line_nrs:
+            _write_all(new_from_fd, b"\n")
+        from_file.seek(start)
+        moved_lines.append(from_file.read(end - start))
+        pos = end
+    from_size = os.fstat(from_fd).st_size
+    _copy_file_range(from_fd, new_from_fd, pos, from_size - pos)
+    new_from_size = os.fstat(new_from_fd).st_size
+
+    if to_filename is not None:
+        append_lines(to_filename, moved_lines, store)
     from_file.close()
     new_from_file.close()
 
-    os.remove(from_filename)
-    os.rename(new_from_filename, from_filename)
+    if from_id_map is not None:
+        _remove_from_id_map(from_id_map, ranges, preserve_line_nrs)
+    store.save_id_map(from_filename, from_has_ids, from_id_map)
 
+    bytes_written = new_from_size
+    if to_filename is not None:
+        bytes_written = bytes_written + sum([len(line) for line in moved_lines])
+    add_metrics(metrics, {"lines_moved": len(moved_lines),
+        "bytes_read": from_size, "bytes_written": bytes_written})
+    return moved_lines
 
 
-def add_threshold_to_empty(agenda_data, threshold):
+def _move_lines_store(from_filename, to_filename, line_nrs, preserve_line_nrs,
+        store, metrics):
+    '''move_lines() for a store which is not local'''
+    wanted = set(line_nrs)
+    moved_lines = []
+    bytes_read = 0
+    bytes_written = 0
+    from_file = store.open_read(from_filename)
+    new_from_file = store.open_replace(from_filename)
+    for line_nr, line in enumerate(from_file, start=1):
+        bytes_read = bytes_read + len(line)
+        if line_nr in wanted:
+            moved_lines.append(line)
+            if preserve_line_nrs:
+                new_from_file.write(b"\n")
+                bytes_written = bytes_written + 1
+        else:
+            new_from_file.write(line)
+            bytes_written = bytes_written + len(line)
+    from_file.close()
+    if to_filename is not None:
+        append_lines(to_filename, moved_lines, store, metrics)
+    new_from_file.close()
+    add_metrics(metrics, {"lines_moved": len(moved_lines),
+        "bytes_read": bytes_read, "bytes_written": bytes_written})
+    return moved_lines
+
+
+def append_lines(filename, lines, store=None, metrics=None):
+    '''Appends the lines (bytes with line endings) to filename with a single
+    buffered write, e.g. the lines of several move_lines() or add_recur()
+    calls with to_filename None. The id map is updated if it exists.'''
+    store = _get_store(store)
+    (has_ids, id_map) = store.read_id_map_for_update(filename)
+    if id_map is not None and not store.ends_with_newline(filename):
+        # The first line is joined with the last line, rebuilt on save
+        id_map = None
+    if id_map is not None:
+        _append_to_id_map(id_map, store.get_append_offset(filename), lines)
+    to_file = store.open_append(filename)
+    data = b"".join(lines)
+    to_file.write(data)
+    to_file.close()
+    add_metrics(metrics, {"bytes_written": len(data)})
+    store.save_id_map(filename, has_ids, id_map)
+
+
+def bulk_edit(filename, line_filter, edits, is_dryrun, record_callback=None,
+        store=None):
+    '''
+    Changes keys in all non empty lines of filename for which
+    line_filter(line) returns True in a single streaming pass (see set_keys()).
+    The lines are processed as raw bytes. The file is replaced atomically.
+
+    Parameters:
+        - line_filter: Function returning True for lines to change, it gets
+          the line without line ending
+        - edits: List of (key, value) tuples. value may also be a function
+          which gets the current value of the key (None if not existent)
+          and returns the new one.
+        - is_dryrun: Do not change file
+        - record_callback: If set, it is called for every changed line as
+          record_callback(line_nr, line), line is the changed line.
+        - store: TodoStore for the file access, defaults to the local files
+    Returns:
+        The number of changed lines
+    '''
+    nr_of_changed_lines = 0
+    store = _get_store(store)
+    from_file = store.open_read(filename)
+    if not is_dryrun:
+        new_file = store.open_replace(filename)
+
+    for line_nr, line in enumerate(from_file, start=1):
+        content = line.rstrip(b"\r\n")
+        if len(content.strip()) > 0 and line_filter(content):
+            line_edits = []
+            for (key, value) in edits:
+                if callable(value):
+                    value = value(get_key(content, key))
+                line_edits.append((key, value))
+            new_content = set_keys(content, line_edits)
+            if new_content != content:
+                nr_of_changed_lines = nr_of_changed_lines + 1
+                if record_callback is not None:
+                    record_callback(line_nr, new_content)
+                # Keep the original line ending
+                line = new_content + line[len(content):]
+        if not is_dryrun:
+            new_file.write(line)
+
+    from_file.close()
+    if not is_dryrun:
+        new_file.close()
+
+    return nr_of_changed_lines
+
+
+def add_threshold_to_empty(agenda_data, threshold):
     '''
     Adds the given threshold value (datetime.date object) to entries with no
     threshold (key is None).
@@ -241,8 +1718,10 @@ def getthreshold(line):
     python date objects are comparable to each other
     If the date cannot be parsed (because the format does not match or
     threshold date is not available) None is returned.
+    line may be str or bytes.
     '''
-    pattern = " t:(?P<year>[0-9]{4})-(?P<month>[0-9]{2})-(?P<day>[0-9]{2})"
+    pattern = _as_line_type(line,
+            " t:(?P<year>[0-9]{4})-(?P<month>[0-9]{2})-(?P<day>[0-9]{2})")
     result = re.search(pattern, line)
     if result != None:
         return datetime.date(int(result.group("year")),
@@ -252,7 +1731,28 @@ def getthreshold(line):
         return None
 
 
-def readtodotxt(todo_filename):
+def _add_todo_lines(agenda_data, todo_file, line_nr):
+    '''Adds the lines of the already opened todo_file to agenda_data (see
+    readtodotxt()). The first line read gets the number line_nr.
+    Returns the number of lines read.
+    '''
+    first_line_nr = line_nr
+    for line in todo_file:
+        line = line.rstrip()
+        # Skip over empty lines
+        if len(line) > 0:
+            threshold = getthreshold(line)
+            if not threshold in agenda_data:
+                agenda_data[threshold] = []
+            item = {}
+            item["line"] = line
+            item["nr"] = line_nr
+            agenda_data[threshold].append(item)
+        line_nr = line_nr + 1
+    return line_nr - first_line_nr
+
+
+def readtodotxt(todo_filename, store=None, metrics=None):
     '''Reads the todo.txt file and returns the following dict (example):
 
         { 2015-01-01:
@@ -264,23 +1764,1204 @@ def readtodotxt(todo_filename):
         - The date is a datetime.date object
         - The numbers are line numbers
 
+    metrics is a dict for the run metrics (see add_metric()).
     '''
     agenda_data = {}
-    todo_file = open(todo_filename, "r")
-    line_nr = 1
-    for line in todo_file:
+    store = _get_store(store)
+    todo_file = store.open_text(todo_filename)
+    nr_of_lines = _add_todo_lines(agenda_data, todo_file, 1)
+    todo_file.close()
+    if metrics is not None:
+        bytes_read = 0
+        if store.local:
+            bytes_read = os.path.getsize(todo_filename)
+        add_metrics(metrics, {"lines_scanned": nr_of_lines,
+            "bytes_read": bytes_read})
+
+    return agenda_data
+
+
+def itertodotxt(todo_filename, store=None):
+    '''Reads the todo.txt file line by line and yields a tuple
+    (threshold, line_nr, line) for each non empty line, see readtodotxt().
+    Only the current line is kept in memory.'''
+    todo_file = _get_store(store).open_text(todo_filename)
+    for line_nr, line in enumerate(todo_file, start=1):
         line = line.rstrip()
-        # Skip over empty lines
         if len(line) > 0:
+            yield (getthreshold(line), line_nr, line)
+    todo_file.close()
+
+
+def select_agenda(entries, now, limit=None, max_days=None):
+    '''
+    Selects the first entries of an agenda without sorting all of them.
+    The entries are ordered by date and line as printed by the agenda.
+
+    Parameters:
+        - entries: Iterable of (threshold, line_nr, line) tuples, e.g. from
+          itertodotxt(). Entries without threshold are sorted in under now.
+        - limit: Maximum number of entries to select, None for all
+        - max_days: Only select entries of the first max_days dates having
+          entries, None for all
+    Returns:
+        agenda_data dict with the selected entries, see readtodotxt()
+    '''
+    # Largest of the max_days smallest dates on top (negative ordinals)
+    date_heap = []
+    dates = set()
+    # Entries per selected date, only needed without limit
+    entries_per_date = {}
+    selected = []
+
+    def by_date(entries):
+        '''Applies now as threshold, tracks the first max_days dates'''
+        for (threshold, line_nr, line) in entries:
+            if threshold is None:
+                threshold = now
+            if max_days is not None and threshold not in dates:
+                if len(date_heap) < max_days:
+                    heapq.heappush(date_heap, -threshold.toordinal())
+                    dates.add(threshold)
+                elif len(date_heap) > 0 and \
+                        threshold.toordinal() < -date_heap[0]:
+                    removed = datetime.date.fromordinal(
+                            -heapq.heapreplace(date_heap,
+                                -threshold.toordinal()))
+                    dates.remove(removed)
+                    dates.add(threshold)
+                    entries_per_date.pop(removed, None)
+                else:
+                    continue
+            yield (threshold, line, line_nr)
+
+    if limit is not None:
+        # Entries of the first dates are a prefix of the whole order, so the
+        # first limit entries only need to be cut to the selected dates
+        selected = heapq.nsmallest(limit, by_date(entries))
+        if max_days is not None:
+            selected = [entry for entry in selected if entry[0] in dates]
+    else:
+        for entry in by_date(entries):
+            if entry[0] not in entries_per_date:
+                entries_per_date[entry[0]] = []
+            entries_per_date[entry[0]].append(entry)
+        for date in entries_per_date:
+            selected.extend(entries_per_date[date])
+
+    agenda_data = {}
+    for (threshold, line, line_nr) in selected:
+        if threshold not in agenda_data:
+            agenda_data[threshold] = []
+        agenda_data[threshold].append({"line": line, "nr": line_nr})
+    return agenda_data
+
+
+def _iter_recur_line(line_nr, line, max_threshold, calendar_months):
+    '''Yields the tuples (threshold, line_nr, line) of iter_recur() for a
+    single line of the recurring tasks file.'''
+    rec = get_key(line, "rec")
+    threshold = get_key(line, "t")
+    if rec is None or threshold is None:
+        return
+    date = parse_date(threshold)
+    if date is None:
+        # Invalid threshold date
+        return
+    for date in iter_recurrence(date, parse_recurrence(rec), max_threshold,
+            calendar_months):
+        yield (date, line_nr, set_keys(line, [("rec", None),
+            ("catchup", None), ("t", date.strftime("%Y-%m-%d"))]))
+
+
+def iter_recur(recur_filename, max_threshold, calendar_months=False,
+        store=None):
+    '''
+    Yields a tuple (threshold, line_nr, line) for every occurrence of the
+    recurring tasks in recur_filename up to max_threshold (datetime.date).
+    The lines are the ones add_recur() would add to todo.txt, the file is not
+    changed.
+    '''
+    recur_file = _get_store(store).open_text(recur_filename)
+    for line_nr, line in enumerate(recur_file, start=1):
+        for entry in _iter_recur_line(line_nr, line.rstrip(), max_threshold,
+                calendar_months):
+            yield entry
+    recur_file.close()
+
+
+def forecast_recur(recur_filename, max_threshold, calendar_months=False,
+        store=None):
+    '''
+    Returns an iterator over the tuples (threshold, line_nr, line) of
+    iter_recur() sorted by threshold and line number. The occurrences are
+    generated lazily, only one pending occurrence per recurring task is
+    held in memory.
+    '''
+    recur_file = _get_store(store).open_text(recur_filename)
+    generators = [_iter_recur_line(line_nr, line.rstrip(), max_threshold,
+        calendar_months) for line_nr, line in enumerate(recur_file, start=1)]
+    recur_file.close()
+    return heapq.merge(*generators)
+
+
+def iter_sorted_agenda(entries, source, now, last_date=None):
+    '''
+    Returns an iterator over the tuples (threshold, line, source, line_nr)
+    sorted by date and line for the entries (threshold, line_nr, line) of
+    itertodotxt() or iter_recur(). Entries without threshold are sorted in
+    under now. Entries after last_date (datetime.date or None) are dropped
+    while reading, so only the entries of the time frame are sorted.
+    The iterators of several sources can be combined with heapq.merge().
+    '''
+    selected = []
+    for (threshold, line_nr, line) in entries:
+        if threshold is None:
+            threshold = now
+        if last_date is None or threshold <= last_date:
+            selected.append((threshold, line, source, line_nr))
+    selected.sort()
+    return iter(selected)
+
+
+def new_stats(now, last_date):
+    '''
+    Returns empty statistics for add_task_stats() and add_recur_stats(),
+    the following dict:
+
+        - tasks, done: Number of open and done tasks
+        - unscheduled: Open tasks without threshold date
+        - invalid: Open tasks with an invalid threshold date, e.g.
+          "t:2015-13-01"
+        - overdue: Open tasks with a threshold date before now
+        - later: Open tasks with a threshold date after last_date
+        - days: { threshold date: number of open tasks } from now up to
+          last_date
+        - projects: { project: number of open tasks }
+        - files: { source: number of open tasks }
+        - recurrences: { date: number of occurrences } from now up to
+          last_date
+        - missed: Occurrences before now
+
+    Only counters per distinct key are kept, the memory does not grow with
+    the number of lines.
+    '''
+    return {"now": now, "last_date": last_date, "tasks": 0, "done": 0,
+            "unscheduled": 0, "invalid": 0, "overdue": 0, "later": 0,
+            "days": {},
+            "projects": {}, "files": {}, "recurrences": {}, "missed": 0}
+
+
+def add_task_stats(stats, todo_filename, source, store=None):
+    '''Adds the tasks of todo_filename to stats (see new_stats()) in a
+    single pass, source is the name counted in stats["files"]'''
+    now = stats["now"]
+    last_date = stats["last_date"]
+    days = stats["days"]
+    projects = stats["projects"]
+    nr_of_tasks = 0
+    nr_of_done = 0
+    nr_of_unscheduled = 0
+    nr_of_invalid = 0
+    nr_of_overdue = 0
+    nr_of_later = 0
+    todo_file = _get_store(store).open_text(todo_filename)
+    for line in todo_file:
+        line = line.rstrip()
+        if len(line) == 0:
+            continue
+        if line.startswith("x "):
+            nr_of_done = nr_of_done + 1
+            continue
+        nr_of_tasks = nr_of_tasks + 1
+        try:
             threshold = getthreshold(line)
-            if not threshold in agenda_data:
-                agenda_data[threshold] = []
-            item = {}
-            item["line"] = line
-            item["nr"] = line_nr
-            agenda_data[threshold].append(item)
-        line_nr = line_nr + 1
+        except ValueError:
+            nr_of_invalid = nr_of_invalid + 1
+        else:
+            if threshold is None:
+                nr_of_unscheduled = nr_of_unscheduled + 1
+            elif threshold < now:
+                nr_of_overdue = nr_of_overdue + 1
+            elif threshold > last_date:
+                nr_of_later = nr_of_later + 1
+            else:
+                days[threshold] = days.get(threshold, 0) + 1
+        # Cheap test first, most lines have no project
+        if "+" in line:
+            for project in get_projects(line):
+                projects[project] = projects.get(project, 0) + 1
+    todo_file.close()
+    stats["tasks"] = stats["tasks"] + nr_of_tasks
+    stats["done"] = stats["done"] + nr_of_done
+    stats["unscheduled"] = stats["unscheduled"] + nr_of_unscheduled
+    stats["invalid"] = stats["invalid"] + nr_of_invalid
+    stats["overdue"] = stats["overdue"] + nr_of_overdue
+    stats["later"] = stats["later"] + nr_of_later
+    stats["files"][source] = stats["files"].get(source, 0) + nr_of_tasks
+
+
+def add_recur_stats(stats, entries):
+    '''Adds the occurrences (threshold, line_nr, line) of iter_recur() up to
+    stats["last_date"] to stats (see new_stats())'''
+    now = stats["now"]
+    recurrences = stats["recurrences"]
+    for (threshold, _, _) in entries:
+        if threshold < now:
+            stats["missed"] = stats["missed"] + 1
+        else:
+            recurrences[threshold] = recurrences.get(threshold, 0) + 1
+
+
+def _split_todo_file(todo_filename, nr_of_chunks):
+    '''Splits the file into up to nr_of_chunks byte ranges of roughly the
+    same size. Each range starts at the beginning of a line.
+    Returns a list of (start, end) tuples.
+    '''
+    size = os.path.getsize(todo_filename)
+    offsets = [0]
+    todo_file = open(todo_filename, "rb")
+    for chunk_nr in range(1, nr_of_chunks):
+        pos = chunk_nr * size // nr_of_chunks
+        if pos <= offsets[-1]:
+            continue
+        # Continue to the end of the line containing the byte before pos
+        todo_file.seek(pos - 1)
+        todo_file.readline()
+        boundary = todo_file.tell()
+        if boundary >= size:
+            break
+        if boundary > offsets[-1]:
+            offsets.append(boundary)
+    todo_file.close()
+    offsets.append(size)
+    return list(zip(offsets[:-1], offsets[1:]))
+
+
+def _read_chunk_text(todo_filename, start, end):
+    '''Returns the byte range (start, end) of the file decoded like
+    open(todo_filename, "r") reads it (bytes on Python 2)'''
+    todo_file = open(todo_filename, "rb")
+    todo_file.seek(start)
+    data = todo_file.read(end - start)
     todo_file.close()
+    if sys.version_info[0] < 3:
+        return data
+    # Same decoding and newline handling as open(todo_filename, "r")
+    return io.TextIOWrapper(io.BytesIO(data)).read()
 
+
+def _readtodotxt_chunk(args):
+    '''Worker for readtodotxt_parallel(): Parses the byte range (start, end)
+    of the file. Only the positions of the lines are passed back, the
+    parent process takes the lines from its own copy of the range. Returns
+    the tuple (positions, number of lines in range) with the dict positions
+    of threshold: array of (line number counted from the start of the range,
+    start, end) triples, start and end of the stripped line in the text of
+    _read_chunk_text().
+    '''
+    (todo_filename, start, end) = args
+    text = _read_chunk_text(todo_filename, start, end)
+    if sys.version_info[0] < 3:
+        lines = io.BytesIO(text)
+    else:
+        lines = io.StringIO(text)
+    positions = {}
+    line_nr = 0
+    pos = 0
+    for line in lines:
+        line_nr = line_nr + 1
+        stripped_line = line.rstrip()
+        # Skip over empty lines
+        if len(stripped_line) > 0:
+            threshold = getthreshold(stripped_line)
+            if not threshold in positions:
+                positions[threshold] = array.array("l")
+            positions[threshold].extend((line_nr, pos,
+                pos + len(stripped_line)))
+        pos = pos + len(line)
+    return (positions, line_nr)
+
+
+def readtodotxt_parallel(todo_filename, processes=None,
+        min_chunk_size=PARALLEL_MIN_CHUNK_SIZE, metrics=None):
+    '''Same as readtodotxt(), but the file is split at line boundaries into
+    chunks which are parsed in a pool of processes. The result is identical
+    to the one of readtodotxt(). Starting the processes and building the
+    result from their line positions takes time, so it is only faster for
+    big files on machines with several CPUs.
+
+    Parameters:
+        - processes: Number of worker processes, defaults to the number of
+          CPUs
+        - min_chunk_size: Minimum size of a chunk in bytes. Files smaller than
+          two chunks and compressed files are parsed in the current process.
+    '''
+    if is_compressed(todo_filename):
+        # Compressed files cannot be split at byte offsets
+        return readtodotxt(todo_filename, metrics=metrics)
+    if processes is None:
+        processes = multiprocessing.cpu_count()
+    size = os.path.getsize(todo_filename)
+    nr_of_chunks = min(processes, size // max(min_chunk_size, 1))
+    if nr_of_chunks < 2:
+        return readtodotxt(todo_filename, metrics=metrics)
+
+    chunks = _split_todo_file(todo_filename, nr_of_chunks)
+    agenda_data = {}
+    line_offset = 0
+    pool = multiprocessing.Pool(processes=min(processes, len(chunks)))
+    try:
+        # imap() keeps the order of the chunks, so the entries per date are
+        # in the same order as with readtodotxt()
+        for (chunk_nr, (positions, nr_of_lines)) in enumerate(pool.imap(
+                _readtodotxt_chunk, [(todo_filename, start, end)
+                    for (start, end) in chunks])):
+            (start, end) = chunks[chunk_nr]
+            text = _read_chunk_text(todo_filename, start, end)
+            for threshold in positions:
+                if not threshold in agenda_data:
+                    agenda_data[threshold] = []
+                items = agenda_data[threshold]
+                chunk_positions = positions[threshold]
+                for index in range(0, len(chunk_positions), 3):
+                    items.append({"line": text[chunk_positions[index + 1]:
+                        chunk_positions[index + 2]],
+                        "nr": chunk_positions[index] + line_offset})
+            line_offset = line_offset + nr_of_lines
+    finally:
+        pool.close()
+        pool.join()
+
+    add_metrics(metrics, {"lines_scanned": line_offset, "bytes_read": size})
     return agenda_data
 
+
+def get_mtime_ns(stat_result):
+    '''Returns the modification time in nanoseconds of an os.stat() result.
+    Python 2 has no st_mtime_ns, the float st_mtime is used there.'''
+    if hasattr(stat_result, "st_mtime_ns"):
+        return stat_result.st_mtime_ns
+    return int(stat_result.st_mtime * 1000000000)
+
+
+def _get_file_key(filename):
+    '''Returns (st_ino, st_size, mtime_ns) of filename, changes whenever the
+    file is changed or replaced'''
+    stat_result = os.stat(filename)
+    return (stat_result.st_ino, stat_result.st_size,
+            get_mtime_ns(stat_result))
+
+
+def get_agenda_data_size(agenda_data):
+    '''Returns the estimated memory in bytes of the result of
+    readtodotxt()'''
+    size = sys.getsizeof(agenda_data)
+    for entries in agenda_data.values():
+        size = size + sys.getsizeof(entries)
+        for entry in entries:
+            size = size + sys.getsizeof(entry) + sys.getsizeof(entry["line"])
+    return size
+
+
+class ParseCache(object):
+    '''
+    Keeps the results of readtodotxt() in memory for long running programs,
+    e.g. a service reading the todo.txt files of many users. A file is parsed
+    again only if its inode, size or modification time changed.
+
+    The least recently used files are evicted when more than max_entries
+    files or more than max_bytes (estimated, see get_agenda_data_size()) are
+    cached. The cache may be used by several threads: concurrent calls for
+    the same file wait for a single parse, calls for other files are not
+    blocked. The counters hits, misses and evictions help to size the cache.
+    '''
+
+    def __init__(self, max_entries=PARSE_CACHE_MAX_ENTRIES,
+            max_bytes=PARSE_CACHE_MAX_BYTES):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.size = 0
+        # filename: (file_key, agenda_data, size), least recently used first
+        self.entries = collections.OrderedDict()
+        # filename: [lock, number of threads using it]
+        self.path_locks = {}
+        self.lock = threading.Lock()
+
+    def _lookup(self, filename, file_key):
+        '''Returns the cached agenda_data of filename if it is still valid,
+        otherwise None. Called with self.lock held.'''
+        entry = self.entries.get(filename)
+        if entry is None or entry[0] != file_key:
+            return None
+        # Most recently used last
+        del self.entries[filename]
+        self.entries[filename] = entry
+        return entry[1]
+
+    def _store(self, filename, file_key, agenda_data):
+        '''Adds agenda_data and evicts the least recently used files.
+        Called with self.lock held.'''
+        self._remove(filename)
+        size = get_agenda_data_size(agenda_data)
+        if size > self.max_bytes or self.max_entries < 1:
+            return
+        self.entries[filename] = (file_key, agenda_data, size)
+        self.size = self.size + size
+        while len(self.entries) > self.max_entries or \
+                self.size > self.max_bytes:
+            self._remove(next(iter(self.entries)))
+            self.evictions = self.evictions + 1
+
+    def _remove(self, filename):
+        '''Removes filename from the cache. Called with self.lock held.'''
+        entry = self.entries.pop(filename, None)
+        if entry is not None:
+            self.size = self.size - entry[2]
+
+    def readtodotxt(self, todo_filename, metrics=None):
+        '''
+        Same as readtodotxt(), but the result is taken from the cache if
+        todo_filename was not changed. The returned dict and lists are a
+        copy, the entries ({"line": ..., "nr": ...}) are shared and must not
+        be changed.
+        '''
+        filename = os.path.abspath(todo_filename)
+        with self.lock:
+            if filename not in self.path_locks:
+                self.path_locks[filename] = [threading.Lock(), 0]
+            path_lock = self.path_locks[filename]
+            path_lock[1] = path_lock[1] + 1
+        try:
+            with path_lock[0]:
+                file_key = _get_file_key(filename)
+                with self.lock:
+                    agenda_data = self._lookup(filename, file_key)
+                    if agenda_data is not None:
+                        self.hits = self.hits + 1
+                    else:
+                        self.misses = self.misses + 1
+                if agenda_data is None:
+                    agenda_data = readtodotxt(filename, metrics=metrics)
+                    # A file changed while parsing is parsed again next time,
+                    # so is a file changed within the same mtime tick
+                    racy_time = (time.time() - OUTPUT_CACHE_RACY_SECONDS) * \
+                            1000000000
+                    if _get_file_key(filename) == file_key and \
+                            file_key[2] < racy_time:
+                        with self.lock:
+                            self._store(filename, file_key, agenda_data)
+        finally:
+            with self.lock:
+                path_lock[1] = path_lock[1] - 1
+                if path_lock[1] == 0:
+                    del self.path_locks[filename]
+        return dict([(threshold, list(entries))
+            for (threshold, entries) in agenda_data.items()])
+
+    def get_counters(self):
+        '''Returns the dict of the counters hits, misses and evictions and the
+        current number of entries and estimated bytes'''
+        with self.lock:
+            return {"hits": self.hits, "misses": self.misses,
+                    "evictions": self.evictions,
+                    "entries": len(self.entries), "bytes": self.size}
+
+    def clear(self):
+        '''Removes all files from the cache, the counters are kept'''
+        with self.lock:
+            self.entries.clear()
+            self.size = 0
+
+
+def get_shard_name(threshold):
+    '''Returns the filename of the month shard for a threshold date
+    (datetime.date or None), e.g. "2015-01.txt" or UNSCHEDULED_SHARD.'''
+    if threshold is None:
+        return UNSCHEDULED_SHARD
+    return threshold.strftime("%Y-%m") + ".txt"
+
+
+def get_shard_filenames(shard_dir, first_date, last_date):
+    '''
+    Returns the sorted list of filenames of the month shards in shard_dir
+    (see shard_todotxt()) which may contain tasks with a threshold date
+    between first_date and last_date (datetime.date objects, both inclusive,
+    None for an open end). The shard with unscheduled tasks is always part
+    of the list. Compressed shards (e.g. "2015-01.txt.gz", see
+    COMPRESSED_SUFFIXES) are part of the list, too. Only the directory is
+    listed, no shard is opened.
+    '''
+    result = []
+    first_shard = None
+    last_shard = None
+    if first_date is not None:
+        first_shard = get_shard_name(first_date)
+    if last_date is not None:
+        last_shard = get_shard_name(last_date)
+    for filename in sorted(os.listdir(shard_dir)):
+        if filename == UNSCHEDULED_SHARD:
+            result.append(os.path.join(shard_dir, filename))
+        elif re.match("^[0-9]{4}-[0-9]{2}\\.txt(\\.gz|\\.bz2|\\.xz)?$",
+                filename):
+            # string comparison of the month, works with ISO8601
+            shard_name = filename[:len("2015-01.txt")]
+            if first_shard is not None and shard_name < first_shard:
+                continue
+            if last_shard is not None and shard_name > last_shard:
+                continue
+            result.append(os.path.join(shard_dir, filename))
+    return result
+
+
+def get_source_filenames(todo_dir, source):
+    '''Returns the sorted list of the files of source, a directory (its *.txt
+    files) or a glob pattern. Relative paths are relative to todo_dir.'''
+    source = os.path.join(todo_dir, source)
+    if os.path.isdir(source):
+        source = os.path.join(source, "*.txt")
+    return sorted([filename for filename in glob.glob(source)
+        if os.path.isfile(filename)])
+
+
+def map_sources(function, sources, processes=None):
+    '''
+    Calls function(source) for every source in a pool of processes and
+    returns an iterator over the results in the order of sources. A result is
+    passed on as soon as its source and all sources before it are finished,
+    so the output can be written in source order while later sources are
+    still processed. With not more sources than processes (defaults to the
+    number of CPUs) the total time is the one of the slowest source. A single
+    source or processes 1 is processed in the current process.
+
+    function is pickled, so it must be a function of a module. The sources
+    and results are pickled, too: function should not change files but
+    return its changes in a CaptureStore, the calling process applies them
+    (see CaptureStore.apply()).
+    '''
+    if processes is None:
+        processes = multiprocessing.cpu_count()
+    if len(sources) <= 1 or processes <= 1:
+        for source in sources:
+            yield function(source)
+        return
+    pool = multiprocessing.Pool(min(processes, len(sources)))
+    try:
+        for result in pool.imap(function, sources):
+            yield result
+    finally:
+        # Stops the workers if the caller does not consume all results
+        pool.terminate()
+        pool.join()
+
+
+def shard_todotxt(todo_filename, shard_dir, is_dryrun, store=None):
+    '''
+    Moves all tasks of todo_filename in a single pass to month shards in
+    shard_dir, e.g. "shard_dir/2015-01.txt" for tasks with a threshold date
+    in January 2015. Tasks without threshold date are moved to
+    UNSCHEDULED_SHARD. Empty lines are dropped, todo_filename is empty
+    afterwards. store is the TodoStore for the file access.
+
+    Returns:
+        Dictionary with the number of tasks per shard filename, e.g.:
+        { "2015-01.txt": 3, "unscheduled.txt": 1 }
+    '''
+    result = {}
+    shard_files = {}
+    store = _get_store(store)
+    if not is_dryrun and store.local and not os.path.isdir(shard_dir):
+        os.makedirs(shard_dir)
+
+    todo_file = store.open_read(todo_filename)
+    for line in todo_file:
+        if len(line.strip()) == 0:
+            continue
+        shard_name = get_shard_name(getthreshold(line))
+        result[shard_name] = result.get(shard_name, 0) + 1
+        if not is_dryrun:
+            if shard_name not in shard_files:
+                shard_files[shard_name] = store.open_append(
+                        os.path.join(shard_dir, shard_name))
+            if not line.endswith(b"\n"):
+                line = line + b"\n"
+            shard_files[shard_name].write(line)
+    todo_file.close()
+
+    if not is_dryrun:
+        for shard_name in shard_files:
+            shard_files[shard_name].close()
+        store.open_replace(todo_filename).close()
+
+    return result
+
+
+def make_record(action, filename, line_nr, date, line):
+    '''Returns a record for get_record_writer(). date may be a datetime.date
+    object, an ISO 8601 string (str or bytes) or None.'''
+    if isinstance(date, datetime.date):
+        date = date.strftime("%Y-%m-%d")
+    elif date is not None:
+        date = _decode_record_text(date)
+    return {"date": date, "nr": line_nr,
+            "line": _decode_record_text(line).strip(),
+            "file": filename, "action": action}
+
+
+def _decode_record_text(text):
+    '''Returns text as unicode string for the records. Unlike decode_line()
+    the str of Python 2 is decoded as well, json cannot encode undecodable
+    bytes. Undecodable bytes are replaced.'''
+    if isinstance(text, bytes):
+        return text.decode("utf-8", "replace")
+    return text
+
+
+def get_record_writer(output_format, output_file):
+    '''Returns a function write_record(record) which writes a record (see
+    make_record()) as single line to output_file. The records are written
+    immediately, so big results can be streamed.
+
+    Parameters:
+        - output_format: "jsonl" (one JSON object per line) or "csv" (a
+          header line is written first)
+    '''
+    if output_format == "jsonl":
+        def write_record(record):
+            '''Writes record as JSON line'''
+            output_file.write(json.dumps(collections.OrderedDict(
+                [(field, record[field]) for field in RECORD_FIELDS])) + "\n")
+    elif output_format == "csv":
+        writer = csv.writer(output_file, lineterminator="\n")
+        writer.writerow(RECORD_FIELDS)
+        def write_record(record):
+            '''Writes record as CSV line'''
+            values = [record[field] for field in RECORD_FIELDS]
+            if sys.version_info[0] < 3:
+                # The csv module of Python 2 only writes byte strings
+                values = [value.encode("utf-8")
+                        if isinstance(value, type(u"")) else value
+                        for value in values]
+            writer.writerow(values)
+    else:
+        raise ValueError("Unknown output format: " + output_format)
+    return write_record
+
+
+def add_metric(metrics, name, value):
+    '''Adds value to the metric name (see METRICS) in the dict metrics.
+    Nothing is done if metrics is None, so the metrics are optional for the
+    library functions.'''
+    add_metrics(metrics, {name: value})
+
+
+def add_metrics(metrics, values):
+    '''Adds the dict values (metric name: value) to the dict metrics, see
+    add_metric().'''
+    if metrics is None:
+        return
+    with _METRICS_LOCK:
+        for name in values:
+            metrics[name] = metrics.get(name, 0) + values[name]
+
+
+def add_phase_duration(metrics, phase, start_time):
+    '''Adds the seconds since start_time (time.time()) to the duration of
+    phase (e.g. "parse" or "append") in the dict metrics.'''
+    add_metric(metrics, "phase:" + phase, time.time() - start_time)
+
+
+def _escape_label_value(value):
+    '''Escapes a label value for the Prometheus text format'''
+    return value.replace("\\", "\\\\").replace("\"", "\\\"").replace(
+            "\n", "\\n")
+
+
+def _format_labels(labels):
+    '''Returns the labels (list of (name, value)) in the Prometheus text
+    format, e.g. {plugin="addrecurtasks"}'''
+    if len(labels) == 0:
+        return ""
+    return "{" + ",".join(['%s="%s"' % (name, _escape_label_value(value))
+        for (name, value) in labels]) + "}"
+
+
+def format_metrics(metrics, labels, start_time, end_time=None):
+    '''Returns the metrics (see add_metric()) of a run which started at
+    start_time (time.time()) in the Prometheus text exposition format. The
+    metrics are gauges as they describe the last run.
+
+    Parameters:
+        - labels: list of (name, value) added to every metric, e.g.
+          [("plugin", "addrecurtasks")]
+        - end_time: end of the run, defaults to now
+    '''
+    if end_time is None:
+        end_time = time.time()
+    lines = []
+    def add_gauge(name, help_text, samples):
+        '''Adds the gauge name with the samples (list of (labels, value))'''
+        name = METRICS_PREFIX + name
+        lines.append("# HELP %s %s" % (name, help_text))
+        lines.append("# TYPE %s gauge" % name)
+        for (sample_labels, value) in samples:
+            lines.append("%s%s %s" % (name,
+                _format_labels(labels + sample_labels), repr(float(value))))
+
+    for (name, help_text) in METRICS:
+        add_gauge(name, help_text, [([], metrics.get(name, 0))])
+    phases = sorted([name[len("phase:"):] for name in metrics
+        if name.startswith("phase:")])
+    if len(phases) > 0:
+        add_gauge("phase_duration_seconds", "Duration of the run phases",
+                [([("phase", phase)], metrics["phase:" + phase])
+                    for phase in phases])
+    add_gauge("run_duration_seconds", "Duration of the run",
+            [([], end_time - start_time)])
+    add_gauge("last_run_timestamp_seconds", "End time of the run (Unix time)",
+            [([], end_time)])
+    return "\n".join(lines) + "\n"
+
+
+def write_metrics(filename, metrics, labels, start_time):
+    '''Writes the metrics of a run (see format_metrics()) to filename, e.g.
+    for the textfile collector of the Prometheus node exporter. The file is
+    replaced atomically, so a collector never reads a partial file.'''
+    data = format_metrics(metrics, labels, start_time).encode("utf-8")
+    # The node exporter only reads *.prom files, so the temporary file is
+    # ignored until it is renamed
+    (new_fd, new_filename) = tempfile.mkstemp(
+            dir=os.path.dirname(os.path.abspath(filename)),
+            prefix=os.path.basename(filename) + ".")
+    _write_all(new_fd, data)
+    os.close(new_fd)
+    os.chmod(new_filename, 0o644)
+    os.rename(new_filename, filename)
+
+
+def _hash_files(filenames):
+    '''Returns the SHA-1 (hex) of the content of the existing filenames'''
+    content_hash = hashlib.sha1()
+    for filename in filenames:
+        if not os.path.isfile(filename):
+            continue
+        with open(filename, "rb") as file_:
+            for data in iter(lambda: file_.read(IO_BUFFER_SIZE), b""):
+                content_hash.update(data)
+        content_hash.update(b"\0")
+    return content_hash.hexdigest()
+
+
+def get_output_cache_key(filenames, options):
+    '''
+    Returns the key of the output cache (see read_output_cache()) for an
+    output depending on the files filenames and the list of strings options
+    (e.g. today's date and the output format). The files are identified by
+    path, size and modification time, so usually only a stat is needed. The
+    content is hashed if a file was changed in the last
+    OUTPUT_CACHE_RACY_SECONDS, since another change within the same mtime
+    tick would not be noticed.
+
+    Returns:
+        Tuple (name, content_hash) with the name of the cache entry and the
+        content hash or None
+    '''
+    fingerprint = hashlib.sha1()
+    racy_time = (time.time() - OUTPUT_CACHE_RACY_SECONDS) * 1000000000
+    is_racy = False
+    for filename in filenames:
+        try:
+            stat_result = os.stat(filename)
+        except OSError as error:
+            if error.errno != errno.ENOENT:
+                raise
+            fingerprint.update((filename + " -\n").encode("utf-8"))
+            continue
+        mtime_ns = get_mtime_ns(stat_result)
+        fingerprint.update(("%s %d %d\n" % (filename, stat_result.st_size,
+            mtime_ns)).encode("utf-8"))
+        if mtime_ns >= racy_time:
+            is_racy = True
+    for option in options:
+        fingerprint.update((option + "\n").encode("utf-8"))
+    content_hash = None
+    if is_racy:
+        content_hash = _hash_files(filenames)
+    return (fingerprint.hexdigest(), content_hash)
+
+
+def read_output_cache(cache_dir, key, filenames):
+    '''
+    Returns the cached output (bytes) for key (see get_output_cache_key()) or
+    None. Entries written while a file was changed recently are only
+    returned if the content of filenames is unchanged.
+    '''
+    try:
+        cache_file = open(os.path.join(cache_dir, key[0]), "rb")
+    except IOError as error:
+        if error.errno != errno.ENOENT:
+            raise
+        return None
+    with cache_file:
+        header = cache_file.readline().split()
+        data = cache_file.read()
+    if len(header) != 2 or header[0] != b"todotxt-output-cache":
+        return None
+    content_hash = header[1].decode("ascii")
+    if content_hash != "-":
+        if key[1] is None:
+            key = (key[0], _hash_files(filenames))
+        if content_hash != key[1]:
+            return None
+    return data
+
+
+def write_output_cache(cache_dir, key, data,
+        max_entries=OUTPUT_CACHE_MAX_ENTRIES, max_age=OUTPUT_CACHE_MAX_AGE):
+    '''Writes the output data (bytes) for key (see get_output_cache_key())
+    to the cache in cache_dir. Entries older than max_age seconds and the
+    oldest entries beyond max_entries are removed.'''
+    if not os.path.isdir(cache_dir):
+        os.makedirs(cache_dir)
+    (new_fd, new_filename) = tempfile.mkstemp(dir=cache_dir, prefix=".")
+    _write_all(new_fd, b"todotxt-output-cache " +
+            (key[1] or "-").encode("ascii") + b"\n" + data)
+    os.close(new_fd)
+    os.rename(new_filename, os.path.join(cache_dir, key[0]))
+
+    entries = []
+    for name in os.listdir(cache_dir):
+        if name.startswith("."):
+            continue
+        try:
+            entries.append((os.path.getmtime(os.path.join(cache_dir, name)),
+                name))
+        except OSError:
+            # Removed by a concurrent run
+            continue
+    entries.sort(reverse=True)
+    min_mtime = time.time() - max_age
+    for (index, (mtime, name)) in enumerate(entries):
+        if name != key[0] and (index >= max_entries or mtime < min_mtime):
+            try:
+                os.remove(os.path.join(cache_dir, name))
+            except OSError:
+                pass
+
+
+def get_completion_date(line):
+    '''Returns the completion date of a done task ("x 2015-01-01 Task") as
+    ISO 8601 string of the same type as line (str or bytes). Returns None if
+    the task is not done or has no completion date.
+    '''
+    pattern = _as_line_type(line, "^x (?P<date>[0-9]{4}-[0-9]{2}-[0-9]{2})\\s")
+    result = re.search(pattern, line)
+    if result != None:
+        return result.group("date")
+    return None
+
+
+def read_done_index(done_dir):
+    '''Reads the index of the month segmented done files in done_dir and
+    returns a dict, e.g.:
+
+        { "2015-01": { "count": 12, "first": "2015-01-02", "last": "2015-01-30" } }
+
+    Returns an empty dict if there is no index.
+    '''
+    index = {}
+    index_filename = os.path.join(done_dir, DONE_INDEX_FILENAME)
+    if not os.path.isfile(index_filename):
+        return index
+    index_file = open(index_filename, "r")
+    for line in index_file:
+        fields = line.split()
+        if len(fields) == 4:
+            index[fields[0]] = {"count": int(fields[1]),
+                    "first": fields[2], "last": fields[3]}
+    index_file.close()
+    return index
+
+
+def write_done_index(done_dir, index):
+    '''Writes the index as returned by read_done_index() to done_dir'''
+    index_filename = os.path.join(done_dir, DONE_INDEX_FILENAME)
+    (new_index_fd, new_index_filename) = tempfile.mkstemp(dir=done_dir)
+    new_index_file = os.fdopen(new_index_fd, "w")
+    for month in sorted(index):
+        new_index_file.write("%s %d %s %s\n" % (month, index[month]["count"],
+            index[month]["first"], index[month]["last"]))
+    new_index_file.close()
+    os.rename(new_index_filename, index_filename)
+
+
+def get_done_segments(done_dir, first_date, last_date):
+    '''Returns the sorted list of filenames of the done segments in done_dir
+    containing tasks completed between first_date and last_date (ISO 8601
+    strings, both inclusive). Only the index is read. Compressed segments
+    (e.g. "2015-01.txt.gz") are returned after the uncompressed one.
+    '''
+    result = []
+    index = read_done_index(done_dir)
+    for month in sorted(index):
+        if index[month]["first"] <= last_date and \
+                index[month]["last"] >= first_date:
+            filename = os.path.join(done_dir, month + ".txt")
+            compressed = [filename + suffix for suffix in COMPRESSED_SUFFIXES
+                    if os.path.exists(filename + suffix)]
+            if os.path.exists(filename) or len(compressed) == 0:
+                result.append(filename)
+            result.extend(compressed)
+    return result
+
+
+def archive_done(todo_filename, done_dir, default_date, preserve_line_nrs,
+        is_dryrun, store=None):
+    '''
+    Moves done tasks (starting with "x ") from todo_filename in a single pass
+    to month segmented files in done_dir, e.g. "done_dir/2015-01.txt". The
+    segment is selected by the completion date, tasks without completion date
+    are archived under default_date (ISO 8601 string). The index in done_dir
+    (see read_done_index()) is updated.
+    If preserve_line_nrs is set to True, then the moved lines in todo_filename
+    are replaced by empty lines.
+
+    Parameters:
+        - is_dryrun: Do not change files, only return the counts
+        - store: TodoStore for the file access. The index is a sidecar
+          file, it is only kept with a local store.
+    Returns:
+        Dictionary with the number of archived tasks per month, e.g.:
+        { "2015-01": 3, "2015-02": 1 }
+    '''
+    result = {}
+    store = _get_store(store)
+    index = {}
+    if store.local:
+        index = read_done_index(done_dir)
+    default_date = _as_line_type(b"", default_date)
+    segment_files = {}
+
+    todo_file = store.open_read(todo_filename)
+    if not is_dryrun:
+        if store.local and not os.path.isdir(done_dir):
+            os.makedirs(done_dir)
+        new_todo_file = store.open_replace(todo_filename)
+
+    for line in todo_file:
+        if not line.startswith(b"x "):
+            if not is_dryrun:
+                new_todo_file.write(line)
+            continue
+
+        date = get_completion_date(line)
+        if date is None:
+            date = default_date
+        date = date.decode("ascii")
+        month = date[:7]
+        result[month] = result.get(month, 0) + 1
+        if month in index:
+            index[month]["count"] = index[month]["count"] + 1
+            index[month]["first"] = min(index[month]["first"], date)
+            index[month]["last"] = max(index[month]["last"], date)
+        else:
+            index[month] = {"count": 1, "first": date, "last": date}
+
+        if not is_dryrun:
+            if month not in segment_files:
+                segment_files[month] = store.open_append(
+                        os.path.join(done_dir, month + ".txt"))
+            if not line.endswith(b"\n"):
+                line = line + b"\n"
+            segment_files[month].write(line)
+            if preserve_line_nrs:
+                new_todo_file.write(b"\n")
+
+    todo_file.close()
+    if not is_dryrun:
+        for month in segment_files:
+            segment_files[month].close()
+        if len(result) > 0:
+            new_todo_file.close()
+            if store.local:
+                write_done_index(done_dir, index)
+        else:
+            new_todo_file.discard()
+
+    return result
+
+
+def get_task_id(line):
+    '''Returns the content derived id of a task: the first 16 hex digits of
+    the SHA-1 of the line without line ending (str is encoded as UTF-8).'''
+    if not isinstance(line, bytes):
+        line = line.encode("utf-8")
+    return hashlib.sha1(line.rstrip(b"\r\n")).hexdigest()[:16]
+
+
+def _add_task_id(id_map, line, line_nr, offset):
+    '''Adds the line at line_nr and byte offset to id_map and returns its id.
+    Duplicates of a line get the suffix ".2", ".3", ... in the order they are
+    added, so the ids of existing tasks never change.'''
+    base_id = get_task_id(line)
+    task_id = base_id
+    nr = 1
+    while task_id in id_map["ids"]:
+        nr = nr + 1
+        task_id = "%s.%d" % (base_id, nr)
+    id_map["ids"][task_id] = (line_nr, offset)
+    return task_id
+
+
+def build_id_map(filename, store=None):
+    '''
+    Reads filename and returns the map from the ids of its tasks (see
+    get_task_id()) to their line number and byte offset, e.g.:
+
+        { "ids": { "3f786850e387550f": (1, 0), "89e6c98d92887913": (3, 25) },
+          "lines": 3 }
+
+    Empty lines get no id. store is the TodoStore for reading filename.
+    '''
+    id_map = {"ids": {}, "lines": 0}
+    offset = 0
+    todo_file = _get_store(store).open_read(filename)
+    for line_nr, line in enumerate(todo_file, start=1):
+        if len(line.strip()) > 0:
+            _add_task_id(id_map, line, line_nr, offset)
+        offset = offset + len(line)
+        id_map["lines"] = line_nr
+    todo_file.close()
+    return id_map
+
+
+def read_id_map(filename):
+    '''Reads the id map of filename from its sidecar file (filename +
+    ID_MAP_SUFFIX). Returns None if there is none or if it is out of date,
+    i.e. filename was changed without updating it.'''
+    id_map_filename = filename + ID_MAP_SUFFIX
+    if not os.path.isfile(id_map_filename):
+        return None
+    stat_result = os.stat(filename)
+    id_map_file = open(id_map_filename, "r")
+    # Header: size, modification time and number of lines of filename
+    header = id_map_file.readline().split()
+    if len(header) != 3 or int(header[0]) != stat_result.st_size or \
+            int(header[1]) != get_mtime_ns(stat_result):
+        id_map_file.close()
+        return None
+    id_map = {"ids": {}, "lines": int(header[2])}
+    for line in id_map_file:
+        fields = line.split()
+        if len(fields) == 3:
+            id_map["ids"][fields[0]] = (int(fields[1]), int(fields[2]))
+    id_map_file.close()
+    return id_map
+
+
+def write_id_map(filename, id_map):
+    '''Writes id_map as returned by build_id_map() to the sidecar file of
+    filename. Call it after changing filename, its size and modification
+    time are recorded to detect later changes by other tools.'''
+    stat_result = os.stat(filename)
+    (new_fd, new_filename) = tempfile.mkstemp(
+            dir=os.path.dirname(filename))
+    new_file = os.fdopen(new_fd, "w", IO_BUFFER_SIZE)
+    new_file.write("%d %d %d\n" % (stat_result.st_size,
+        get_mtime_ns(stat_result), id_map["lines"]))
+    for (task_id, (line_nr, offset)) in sorted(id_map["ids"].items(),
+            key=lambda item: item[1]):
+        new_file.write("%s %d %d\n" % (task_id, line_nr, offset))
+    new_file.close()
+    os.rename(new_filename, filename + ID_MAP_SUFFIX)
+
+
+def create_id_map(filename):
+    '''Builds the id map of filename and writes its sidecar file. From then
+    on move_lines() and add_recur() keep it up to date.'''
+    id_map = build_id_map(filename)
+    write_id_map(filename, id_map)
+    return id_map
+
+
+def lookup_task(filename, task_id, id_map=None, store=None):
+    '''
+    Returns the tuple (line_nr, line) of the task with task_id in filename or
+    None if it is not found. Only the line at the offset of the id map
+    (read_id_map() if id_map is None) is read and checked against the id,
+    filename is not scanned. store is the TodoStore for reading filename,
+    its file objects must support seek().
+    '''
+    if id_map is None:
+        id_map = read_id_map(filename)
+        if id_map is None:
+            return None
+    if task_id not in id_map["ids"]:
+        return None
+    (line_nr, offset) = id_map["ids"][task_id]
+    todo_file = _get_store(store).open_read(filename)
+    todo_file.seek(offset)
+    line = todo_file.readline()
+    todo_file.close()
+    if get_task_id(line) != task_id.split(".")[0]:
+        return None
+    return (line_nr, line.rstrip(b"\r\n"))
+
+
+def _read_id_map_for_update(filename):
+    '''Returns the tuple (has_sidecar, id_map) for a function changing
+    filename. id_map is None if the sidecar is missing or out of date.'''
+    if filename is None or not os.path.isfile(filename + ID_MAP_SUFFIX):
+        return (False, None)
+    return (True, read_id_map(filename))
+
+
+def _append_to_id_map(id_map, size, lines):
+    '''Adds the lines appended to a file of size bytes to its id_map. The
+    file must end with a newline. Empty lines get no id, like in
+    build_id_map().'''
+    # Split like build_id_map(), a line without newline is joined with the
+    # next one
+    for line in io.BytesIO(b"".join(lines)):
+        id_map["lines"] = id_map["lines"] + 1
+        if len(line.strip()) > 0:
+            _add_task_id(id_map, line, id_map["lines"], size)
+        size = size + len(line)
+
+
+def _remove_from_id_map(id_map, ranges, preserve_line_nrs):
+    '''Updates id_map after the lines with the sorted byte ranges
+    (start, end) were removed (replaced by an empty line if
+    preserve_line_nrs is set) from its file.'''
+    starts = [start for (start, _) in ranges]
+    removed_bytes = [0]
+    for (start, end) in ranges:
+        removed_bytes.append(removed_bytes[-1] + end - start)
+    if preserve_line_nrs:
+        # Every removed line is replaced by a newline
+        removed_bytes = [nr_of_bytes - idx
+                for (idx, nr_of_bytes) in enumerate(removed_bytes)]
+    ids = {}
+    for (task_id, (line_nr, offset)) in id_map["ids"].items():
+        idx = bisect.bisect_left(starts, offset)
+        if idx < len(starts) and starts[idx] == offset:
+            continue
+        if not preserve_line_nrs:
+            line_nr = line_nr - idx
+        ids[task_id] = (line_nr, offset - removed_bytes[idx])
+    id_map["ids"] = ids
+    if not preserve_line_nrs:
+        id_map["lines"] = id_map["lines"] - len(ranges)
+
+
+def _save_id_map(filename, has_sidecar, id_map):
+    '''Writes the updated id_map after filename was changed if filename has
+    a sidecar file. An out of date id_map (None) is rebuilt.'''
+    if not has_sidecar:
+        return
+    if id_map is None:
+        id_map = build_id_map(filename)
+    write_id_map(filename, id_map)
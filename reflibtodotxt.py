@@ -0,0 +1,404 @@
+# vim: set fileencoding=utf-8 :
+"""
+    reflibtodotxt.py
+
+    Reference implementation of the libtodotxt.py functions which parse and
+    change task lines. testdifferential.py compares the optimized functions
+    of libtodotxt.py with it.
+
+    The first part holds unchanged copies of the original get_key(),
+    set_key(), add_interval(), add_recur() and getthreshold(), they define
+    the behaviour which was not meant to change. Never edit them. The second
+    part extends them by the later features, one function per feature. Change
+    it only if the behaviour of libtodotxt.py is meant to change.
+"""
+# The MIT License (MIT)
+#
+# Copyright (c) 2015 Georg Lutz <georg@georglutz.de>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+import datetime
+import os
+import re
+import tempfile
+
+
+# Original functions
+
+def get_key_search_pattern(key):
+    '''Returns the re search pattern for a given key'''
+    return "(^|(?P<spaces>\s))" + key + ":" + "(?P<value>\\S+)"
+
+
+def get_key(line, key):
+    '''
+    Returns a value referenced by key from a todo line (first occurence).
+    Returns None if key is not found
+    '''
+    pattern = get_key_search_pattern(key)
+    result = re.search(pattern, line)
+    if result != None:
+        return result.group("value")
+    return None
+
+
+def set_key(line, key, value):
+    '''
+    Sets or adds (if not existent) a key inside the line to a value. If value
+    is None, the key is deleted completely.
+    Returns the changed line.
+    '''
+    search_pattern = get_key_search_pattern(key)
+    replace_pattern = ""
+    if value is not None:
+        replace_pattern = "\\g<spaces>" + key + ":" + value
+
+    (new_line, number_of_subs_made) = re.subn(
+            search_pattern, replace_pattern, line)
+    if number_of_subs_made == 0 and value is not None:
+        if len(line) > 0:
+            new_line = line + " "
+        new_line = new_line + key + ":" + value
+    return new_line
+
+
+def add_interval(date_str, interval):
+    '''
+    Adds an interval to an iso8601 date and returns the result
+
+    Parameters:
+
+    - date: date string in ISO8601 format: "2015-01-01"
+    - interval: textual representation of an time interval: number + qualifier,
+    e.g. "1y". Valid qualifiers are
+        - "y": year
+        - "m": month
+        - "w": week
+        - "d": day
+    '''
+    date = datetime.datetime.strptime(date_str, "%Y-%m-%d")
+    pattern = "(?P<number>\d+)(?P<qual>[ymwd])"
+    result = re.search(pattern, interval)
+
+    if result is None:
+        return None
+
+    number = int(result.group("number"))
+    qual = result.group("qual")
+
+    delta = None
+    nr_days = 0
+
+    if qual == "y":
+        nr_days = number * 365
+    elif qual == "m":
+        nr_days = number * 30
+    elif qual == "w":
+        nr_days = number * 7
+    elif qual == "d":
+        nr_days = number
+    delta = datetime.timedelta(days = nr_days)
+
+    final_date = date + delta
+    return final_date.strftime("%Y-%m-%d")
+
+
+def add_recur(from_filename, to_filename, max_threshold, is_dryrun):
+    '''
+    Adds recurring tasks from from_filename to to_filename.
+    A single repeating task may be added several times, depending on how many
+    intervals fit in the timeframe until max_threshold is reached.
+    In to_filename the "rec:" tag is stripped, in from_filename the "t:"
+    tag is changed to the date of the next recurrence (the first one later as
+    max_threshold).
+
+    Parameters:
+        - max_threshold: maximum threshold date in ISO 8601 text format
+        - is_dryrun: Do not change file, only return changed lines
+    Returns:
+        Dictionary with information with new/updated lines in to/from file, e.g.:
+        { "from": [
+            "Task1 t:2015-07-15 rec:2w",
+            "Task2 t:2015-07-22 rec:1m"
+            ],
+          "to": [
+            "Task1 t:2015-07-01",
+            "Task2 t:2015-06-22"
+            ]
+        }
+    '''
+
+    result = {}
+    result["from"] = []
+    result["to"] = []
+
+    from_file = open(from_filename, "r")
+
+    if not is_dryrun:
+        new_from_file = tempfile.NamedTemporaryFile(mode="a",
+                dir=os.path.dirname(from_filename), delete=False)
+        new_from_filename = new_from_file.name
+
+    if not is_dryrun:
+        to_file = open(to_filename, "a")
+
+    for line in from_file:
+        rec = get_key(line, "rec")
+        threshold = get_key(line, "t")
+        old_threshold = threshold
+        if rec != None and threshold != None:
+            # string comparison, works with ISO8601
+            while threshold <= max_threshold:
+                line_to_file = set_key(line, "rec", None)
+                line_to_file = set_key(line_to_file, "t", threshold)
+                if not is_dryrun:
+                    to_file.write(line_to_file)
+                result["to"].append(line_to_file.strip())
+                threshold = add_interval(threshold, rec)
+        line_from_file = set_key(line, "t", threshold)
+        if not is_dryrun:
+            new_from_file.write(line_from_file)
+        if old_threshold != threshold:
+            result["from"].append(line_from_file.strip())
+
+    from_file.close()
+    if not is_dryrun:
+        new_from_file.close()
+        to_file.close()
+        os.remove(from_filename)
+        os.rename(new_from_filename, from_filename)
+
+    return result
+
+
+def getthreshold(line):
+    '''Parses line and returns threshold ("t:") date object
+    python date objects are comparable to each other
+    If the date cannot be parsed (because the format does not match or
+    threshold date is not available) None is returned.
+    '''
+    pattern = " t:(?P<year>[0-9]{4})-(?P<month>[0-9]{2})-(?P<day>[0-9]{2})"
+    result = re.search(pattern, line)
+    if result != None:
+        return datetime.date(int(result.group("year")),
+                int(result.group("month")),
+                int(result.group("day")))
+    else:
+        return None
+
+
+
+# Extensions, one function per later feature. The lines are bytes with the
+# line ending, like the lines of the later add_recur(). They are decoded as
+# latin-1 and matched with ASCII only character classes, so every byte is
+# compared as is, like the original functions do with str on Python 2.
+
+# ASCII only \s and \S on Python 3, the default on Python 2
+RE_FLAGS = getattr(re, "ASCII", 0)
+
+
+def _decode(line):
+    '''Returns the bytes line as text with one character per byte'''
+    return line.decode("latin-1")
+
+
+def _encode(line):
+    '''Returns the text line of _decode() as bytes'''
+    return line.encode("latin-1")
+
+
+def get_key_bytes(line, key):
+    '''get_key() of a bytes line, the value is bytes'''
+    result = re.search(get_key_search_pattern(key), _decode(line), RE_FLAGS)
+    if result is None:
+        return None
+    return _encode(result.group("value"))
+
+
+def set_key_bytes(line, key, value):
+    '''
+    set_key() of a bytes line and value. A key at the start of the line is
+    replaced, too, set_key() raises for it on Python 2 because of the
+    unmatched group in the replacement template.
+    '''
+    text = _decode(line)
+    def replace(match):
+        '''Returns the replacement of a key:value, a key at the line start
+        has no spaces'''
+        if value is None:
+            return ""
+        return (match.group("spaces") or "") + key + ":" + _decode(value)
+    (new_text, number_of_subs_made) = re.subn(get_key_search_pattern(key),
+            replace, text, flags=RE_FLAGS)
+    if number_of_subs_made == 0 and value is not None:
+        if len(text) > 0:
+            new_text = text + " "
+        new_text = new_text + key + ":" + _decode(value)
+    return _encode(new_text)
+
+
+def getthreshold_bytes(line):
+    '''getthreshold() of a bytes line. An invalid date raises ValueError.'''
+    return getthreshold(_decode(line))
+
+
+def parse_date(date_str):
+    '''Returns the datetime.date of the bytes "YYYY-MM-DD" or None. Lines
+    with an invalid threshold date are left unchanged by add_recur_lines(),
+    add_recur() raises for them.'''
+    text = _decode(date_str)
+    if re.match("^[0-9]{4}-[0-9]{2}-[0-9]{2}$", text, RE_FLAGS) is None:
+        return None
+    try:
+        return datetime.datetime.strptime(text, "%Y-%m-%d").date()
+    except ValueError:
+        return None
+
+
+def parse_rule(rec):
+    '''Returns the tuple (number, qualifier, from_completion) of the bytes
+    rule rec (e.g. b"+2w") or None. Compared to add_interval() it adds the
+    business days ("b") and the rules counted from completion ("+").'''
+    result = re.search("(\\+)?([0-9]+)([ymwdb])", _decode(rec), RE_FLAGS)
+    if result is None:
+        return None
+    return (int(result.group(2)), result.group(3),
+            result.group(1) is not None)
+
+
+def add_rule(date, rule, calendar_months=False):
+    '''Returns the datetime.date date plus the rule of parse_rule(). Business
+    days are counted one day after the other. With calendar_months the "m"
+    and "y" rules add calendar months, the day is clamped to the end of the
+    month.'''
+    (number, qual, _) = rule
+    if qual == "b":
+        while number > 0:
+            date = date + datetime.timedelta(days=1)
+            if date.weekday() < 5:
+                number = number - 1
+        return date
+    if calendar_months and qual in ("y", "m"):
+        months = number
+        if qual == "y":
+            months = number * 12
+        year = date.year + (date.month - 1 + months) // 12
+        month = (date.month - 1 + months) % 12 + 1
+        day = date.day
+        while True:
+            try:
+                return datetime.date(year, month, day)
+            except ValueError:
+                day = day - 1
+    days = {"y": 365, "m": 30, "w": 7, "d": 1}[qual]
+    return date + datetime.timedelta(days=number * days)
+
+
+def add_recur_lines(lines, max_threshold, calendar_months=False):
+    '''
+    add_recur() of the bytes lines up to the bytes date max_threshold with
+    the rules of parse_rule() and add_rule(). Returns the tuple (from_lines,
+    to_lines, result) with the new lines of the recur file, the lines
+    appended to the todo file and the dictionary returned by add_recur().
+
+    Lines with an invalid rule or threshold date and rules with the number 0
+    are not changed, add_recur() raises or loops forever for them. Rules
+    counted from completion ("+1w") add only the first occurrence.
+    '''
+    max_date = parse_date(max_threshold)
+    from_lines = []
+    to_lines = []
+    result = {"from": [], "to": []}
+    for line in lines:
+        rec = get_key_bytes(line, "rec")
+        threshold = get_key_bytes(line, "t")
+        new_threshold = threshold
+        rule = None
+        date = None
+        if rec is not None and threshold is not None:
+            rule = parse_rule(rec)
+            date = parse_date(threshold)
+        if rule is not None and rule[0] > 0 and date is not None:
+            first = True
+            while date <= max_date:
+                if first or not rule[2]:
+                    line_to_file = set_key_bytes(set_key_bytes(line, "rec",
+                        None), "t", _encode(date.strftime("%Y-%m-%d")))
+                    to_lines.append(line_to_file)
+                    result["to"].append(line_to_file.strip())
+                first = False
+                date = add_rule(date, rule, calendar_months)
+            new_threshold = _encode(date.strftime("%Y-%m-%d"))
+        line_from_file = set_key_bytes(line, "t", new_threshold)
+        from_lines.append(line_from_file)
+        if new_threshold != threshold:
+            result["from"].append(line_from_file.strip())
+    return (from_lines, to_lines, result)
+
+
+def parse_catchup(policy):
+    '''Returns the maximum number of missed occurrences of the bytes
+    catch-up policy, None for all. Raises ValueError if it is invalid.'''
+    text = _decode(policy)
+    if text == "all":
+        return None
+    if text == "latest":
+        return 1
+    if re.match("^[0-9]+$", text, RE_FLAGS) is None:
+        raise ValueError("Invalid catch-up policy")
+    return int(text)
+
+
+def add_recur_catchup(lines, max_threshold, calendar_months=False,
+        catchup=None, now=None):
+    '''
+    add_recur_lines() with a catch-up policy. Of the occurrences before now
+    (datetime.date) only the latest ones allowed by the "catchup:" tag or
+    catchup (see parse_catchup()) are added, an invalid tag is ignored. Rules
+    counted from completion add their single occurrence. The "catchup:" tag
+    is stripped from the added lines. The new thresholds do not depend on the
+    policy.
+    '''
+    if now is None:
+        now = datetime.date.today()
+    from_lines = []
+    to_lines = []
+    result = {"from": [], "to": []}
+    for line in lines:
+        (line_from_lines, line_to_lines, line_result) = add_recur_lines(
+                [line], max_threshold, calendar_months)
+        max_missed = catchup
+        if get_key_bytes(line, "catchup") is not None:
+            try:
+                max_missed = parse_catchup(get_key_bytes(line, "catchup"))
+            except ValueError:
+                pass
+        missed = [to_line for to_line in line_to_lines
+                if parse_date(get_key_bytes(to_line, "t")) < now]
+        if max_missed is not None and len(missed) > max_missed and \
+                not parse_rule(get_key_bytes(line, "rec"))[2]:
+            line_to_lines = line_to_lines[len(missed) - max_missed:]
+        for to_line in line_to_lines:
+            to_line = set_key_bytes(to_line, "catchup", None)
+            to_lines.append(to_line)
+            result["to"].append(to_line.strip())
+        from_lines.extend(line_from_lines)
+        result["from"].extend(line_result["from"])
+    return (from_lines, to_lines, result)
@@ -0,0 +1,186 @@
+#!/usr/bin/env python
+# vim: set fileencoding=utf-8 :
+"""
+    stats.py
+
+    Prints statistics of todo.txt, future.txt and recur.txt (plugin for todo.sh)
+"""
+# The MIT License (MIT)
+#
+# Copyright (c) 2015 Georg Lutz <georg@georglutz.de>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+from __future__ import print_function
+import argparse
+import datetime
+import json
+import os
+import sys
+import libtodotxt
+
+# Name of the plugin (shell wrapper script)
+PLUGIN_NAME = "stats"
+
+# Maximum length of the bars of the text histograms
+HISTOGRAM_WIDTH = 40
+
+def usage(args):
+    '''Usage message for todo.sh plugin system'''
+    print("    " + PLUGIN_NAME + ": " +
+            "Prints the number of tasks per day and project")
+    print("      Reads todo.txt, future.txt, future.d and recur.txt once.")
+    print("      --format json prints the statistics as JSON")
+
+
+def get_task_names(todo_dir):
+    '''Returns the names of todo.txt, future.txt and the shards in future.d
+    (including compressed ones) relative to todo_dir'''
+    names = [name for name in ["todo.txt", "future.txt"]
+            if os.path.isfile(os.path.join(todo_dir, name))]
+    shard_dir = os.path.join(todo_dir, libtodotxt.FUTURE_SHARD_DIR)
+    if os.path.isdir(shard_dir):
+        for shard_filename in libtodotxt.get_shard_filenames(
+                shard_dir, None, None):
+            names.append(os.path.join(libtodotxt.FUTURE_SHARD_DIR,
+                os.path.basename(shard_filename)))
+    return names
+
+
+def print_histogram(counts, labels):
+    '''Prints the counts (list of numbers) with their labels (list of str)
+    as text histogram'''
+    if len(counts) == 0:
+        print("  -")
+        return
+    max_count = max(counts)
+    label_width = max([len(label) for label in labels])
+    count_width = len(str(max_count))
+    for (count, label) in zip(counts, labels):
+        bar = ""
+        if max_count > 0:
+            bar = "#" * max(1, count * HISTOGRAM_WIDTH // max_count)
+        print("  %s %s %s" % (label.ljust(label_width),
+            str(count).rjust(count_width), bar))
+
+
+def print_text(stats):
+    '''Prints stats (see libtodotxt.new_stats()) as text'''
+    print("Tasks: %d open, %d done, %d overdue, %d unscheduled" % (
+        stats["tasks"], stats["done"], stats["overdue"],
+        stats["unscheduled"]))
+    if stats["invalid"] > 0:
+        print("  %d with invalid threshold date" % stats["invalid"])
+    for name in sorted(stats["files"]):
+        print("  %s: %d" % (name, stats["files"][name]))
+    print()
+
+    last_date = stats["last_date"].strftime("%Y-%m-%d")
+    print("Tasks per day until %s (%d later):" % (last_date, stats["later"]))
+    days = sorted(stats["days"])
+    print_histogram([stats["days"][day] for day in days],
+            [day.strftime("%a, %Y-%m-%d") for day in days])
+    print()
+
+    print("Tasks per project:")
+    projects = sorted(stats["projects"].items(),
+            key=lambda item: (-item[1], item[0]))
+    print_histogram([count for (_, count) in projects],
+            ["+" + project for (project, _) in projects])
+    print()
+
+    print("Recurring tasks until %s (%d missed):" % (last_date,
+        stats["missed"]))
+    days = sorted(stats["recurrences"])
+    print_histogram([stats["recurrences"][day] for day in days],
+            [day.strftime("%a, %Y-%m-%d") for day in days])
+
+
+def print_json(stats):
+    '''Prints stats (see libtodotxt.new_stats()) as JSON object, the dates
+    are ISO 8601 strings'''
+    result = dict(stats)
+    for key in ["now", "last_date"]:
+        result[key] = stats[key].strftime("%Y-%m-%d")
+    for key in ["days", "recurrences"]:
+        result[key] = dict([(day.strftime("%Y-%m-%d"), count)
+            for (day, count) in stats[key].items()])
+    print(json.dumps(result, indent=2, sort_keys=True))
+
+
+def plugin(args):
+    '''Plugin main logic'''
+
+    todo_dir = os.environ.get("TODO_DIR")
+    if todo_dir == None:
+        print("Env variable TODO_DIR not set! Exit.", file=sys.stderr)
+        sys.exit(1)
+
+    if args.file is not None:
+        task_names = args.file
+        for name in task_names:
+            if not os.path.isfile(os.path.join(todo_dir, name)):
+                print(name + " not found in TODO_DIR! Exit.", file=sys.stderr)
+                sys.exit(1)
+    else:
+        task_names = get_task_names(todo_dir)
+
+    now = datetime.date.today()
+    last_date = now + datetime.timedelta(days=args.days)
+    stats = libtodotxt.new_stats(now, last_date)
+    # Every file is streamed line by line, only the counters are kept
+    for name in task_names:
+        libtodotxt.add_task_stats(stats, os.path.join(todo_dir, name), name)
+    recur_filename = os.path.join(todo_dir, "recur.txt")
+    if os.path.isfile(recur_filename):
+        libtodotxt.add_recur_stats(stats, libtodotxt.iter_recur(
+            recur_filename, last_date, args.calendar_months))
+
+    if args.format == "json":
+        print_json(stats)
+    else:
+        print_text(stats)
+
+
+def main():
+    '''main function'''
+    parser = argparse.ArgumentParser(prog=PLUGIN_NAME)
+    subparsers = parser.add_subparsers()
+    parser_usage = subparsers.add_parser('usage',
+            help='show usage message')
+    parser_usage.set_defaults(func=usage)
+    parser_plugin = subparsers.add_parser(PLUGIN_NAME,
+            help='plugin main command')
+    parser_plugin.add_argument("--days", type=int, default=30,
+            help="Number of days counted per day, later tasks are summed up.")
+    parser_plugin.add_argument("-f", "--file", action="append",
+            metavar="NAME",
+            help="Read the tasks from NAME (relative to TODO_DIR) instead of "
+            "todo.txt, future.txt and future.d, compressed files are "
+            "decompressed while reading. May be given several times.")
+    parser_plugin.add_argument("--calendar-months", action="store_true",
+            help="Use calendar months and years for the recurring tasks.")
+    parser_plugin.add_argument("--format", default="text",
+            choices=["text", "json"],
+            help="Output format.")
+    parser_plugin.set_defaults(func=plugin)
+    args = parser.parse_args()
+    args.func(args)
+
+if __name__ == "__main__":
+    main()
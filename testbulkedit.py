@@ -0,0 +1,60 @@
+#!/usr/bin/env python
+# vim: set fileencoding=utf-8 :
+"""
+    testbulkedit.py
+
+    Unittests for bulkedit.py, can be run by ./testbulkedit.py
+"""
+# The MIT License (MIT)
+#
+# Copyright (c) 2015 Georg Lutz <georg@georglutz.de>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+import argparse
+import unittest
+import bulkedit
+
+
+class TestParseEdit(unittest.TestCase):
+    '''unit tests for the function parse_edit()'''
+
+    def test_01(self):
+        '''set and delete'''
+        self.assertEqual(("due", b"2016-09-30"),
+                bulkedit.parse_edit("due=2016-09-30"))
+        self.assertEqual(("t", None), bulkedit.parse_edit("t="))
+        self.assertEqual(("my_key-2", b"x"), bulkedit.parse_edit("my_key-2=x"))
+
+    def test_02(self):
+        '''shift'''
+        (key, shift) = bulkedit.parse_edit("t+=1w")
+        self.assertEqual("t", key)
+        self.assertEqual("2015-01-08", shift(b"2015-01-01"))
+        self.assertEqual(b"someday", shift(b"someday"))
+
+    def test_03(self):
+        '''invalid edits and keys'''
+        for edit in ["due", "=1", "due=a b", "a(=1", "due.x=1", "a*+=1d"]:
+            self.assertRaises(argparse.ArgumentTypeError,
+                    bulkedit.parse_edit, edit)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,398 @@
+#!/usr/bin/env python
+# vim: set fileencoding=utf-8 :
+"""
+    testdifferential.py
+
+    Differential tests of libtodotxt.py against reflibtodotxt.py
+"""
+# The MIT License (MIT)
+#
+# Copyright (c) 2015 Georg Lutz <georg@georglutz.de>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+import datetime
+import os
+import random
+import unittest
+import shutil
+import tempfile
+import libtodotxt
+import reflibtodotxt
+
+# Number of random cases per test, e.g. TODOTXT_DIFFERENTIAL_CASES=100000
+NR_OF_CASES = int(os.environ.get("TODOTXT_DIFFERENTIAL_CASES", "2000"))
+
+# Seed of the random cases, a failure message contains it to repeat the run
+SEED = int(os.environ.get("TODOTXT_DIFFERENTIAL_SEED",
+    str(random.randint(0, 2 ** 31))))
+
+# Building blocks of the generated lines
+WORDS = [b"Task", b"(A)", b"x", b"2015-01-01", b"+project", b"@context",
+        b"due:2015-02-01", b"t:", b"rec:", b"t::", b"at:2015-01-01",
+        b"xt:2015-01-01", b"T:2015-01-01", b"\xc3\xa4rger", b"\xe2\x82\xac",
+        b"\xa0", b"http://example.com/t:1"]
+DATES = [b"2015-01-01", b"2015-01-31", b"2015-02-28", b"2016-02-29",
+        b"2014-12-31", b"2015-03-01", b"2015-13-01", b"2015-02-30",
+        b"2015-1-1", b"20150101", b"2015-01-01x", b"0000-01-01", b""]
+RULES = [b"1d", b"2w", b"1m", b"3m", b"1y", b"5b", b"1b", b"+1w", b"+3d",
+        b"0d", b"x", b"-1d", b"1x", b"12", b"d1", b"10d", b"++1d"]
+CATCHUPS = [b"all", b"latest", b"0", b"1", b"3", b"x", b"-1"]
+SPACES = [b" ", b" ", b" ", b"  ", b"\t", b"\x0b", b"\x0c", b"\r"]
+ENDINGS = [b"\n", b"\n", b"\r\n", b""]
+KEYS = ["t", "rec", "due"]
+
+# Building blocks of the lines for the original add_recur(), which raises or
+# loops forever for invalid dates and rules and reads the files as text
+BASELINE_WORDS = [b"Task", b"(A)", b"x", b"2015-01-01", b"+project",
+        b"@context", b"due:2015-02-01", b"at:2015-01-01",
+        b"xt:2015-01-01", b"T:2015-01-01", b"http://example.com/t:1"]
+BASELINE_DATES = [b"2015-01-01", b"2015-01-31", b"2015-02-28", b"2016-02-29",
+        b"2014-12-31", b"2015-03-01"]
+BASELINE_RULES = [b"1d", b"2w", b"1m", b"3m", b"1y", b"-1d", b"10d"]
+BASELINE_SPACES = [b" ", b" ", b"  ", b"\t"]
+
+# Maximum threshold of the add_recur() cases
+MAX_THRESHOLD = b"2015-03-01"
+
+
+def get_seed_lines():
+    '''Returns the lines of the files in testfiles as seeds of the random
+    lines'''
+    script_dir = os.path.dirname(os.path.abspath(__file__))
+    lines = []
+    for dirpath, _, filenames in os.walk(os.path.join(script_dir,
+            "testfiles")):
+        for filename in sorted(filenames):
+            if filename.endswith(".txt"):
+                with open(os.path.join(dirpath, filename), "rb") as file_:
+                    lines.extend(file_.read().splitlines())
+    return lines
+
+
+def random_token(rng):
+    '''Returns a random word, key:value or date'''
+    choice = rng.randint(0, 5)
+    if choice == 0:
+        return b"t:" + rng.choice(DATES)
+    if choice == 1:
+        return b"rec:" + rng.choice(RULES)
+    if choice == 2:
+        return rng.choice(DATES)
+    return rng.choice(WORDS)
+
+
+def random_line(rng, seed_lines):
+    '''Returns a random line (bytes without line ending), either a mutated
+    seed line or one built from random tokens. Whitespace, duplicate keys,
+    keys at the line start and malformed dates are likely.'''
+    if rng.randint(0, 1) == 0 and len(seed_lines) > 0:
+        tokens = rng.choice(seed_lines).split(b" ")
+        for _ in range(rng.randint(0, 3)):
+            position = rng.randint(0, len(tokens))
+            if rng.randint(0, 2) == 0 and position < len(tokens):
+                del tokens[position]
+            else:
+                tokens.insert(position, random_token(rng))
+    else:
+        tokens = [random_token(rng) for _ in range(rng.randint(0, 6))]
+    line = b""
+    for (index, token) in enumerate(tokens):
+        if index > 0 or rng.randint(0, 4) == 0:
+            line = line + rng.choice(SPACES)
+        line = line + token
+    if rng.randint(0, 4) == 0:
+        line = line + rng.choice(SPACES)
+    return line
+
+
+def random_baseline_line(rng):
+    '''Returns a random line (bytes without line ending) for the original
+    add_recur(). It starts with a word, Python 2 rejects a key at the line
+    start in the original set_key().'''
+    line = rng.choice(BASELINE_WORDS)
+    for _ in range(rng.randint(0, 5)):
+        choice = rng.randint(0, 3)
+        if choice == 0:
+            token = b"t:" + rng.choice(BASELINE_DATES)
+        elif choice == 1:
+            token = b"rec:" + rng.choice(BASELINE_RULES)
+        else:
+            token = rng.choice(BASELINE_WORDS)
+        line = line + rng.choice(BASELINE_SPACES) + token
+    return line
+
+
+def native(line):
+    '''Returns the bytes line as str, the type of the lines of the original
+    functions'''
+    if isinstance(line, str):
+        return line
+    return line.decode("latin-1")
+
+
+def call(function, *args):
+    '''Returns ("value", result) or ("error", exception type) of function'''
+    try:
+        return ("value", function(*args))
+    except (ValueError, TypeError, OverflowError) as error:
+        return ("error", type(error))
+
+
+class TestDifferential(unittest.TestCase):
+    '''compares libtodotxt.py with the reference implementation on random
+    lines'''
+
+    def setUp(self):
+        self.rng = random.Random(SEED)
+        self.seed_lines = get_seed_lines()
+
+    def assert_same(self, expected, actual, description):
+        '''Asserts expected == actual with the seed in the message'''
+        self.assertEqual(expected, actual, "%s (TODOTXT_DIFFERENTIAL_SEED=%d)"
+                % (description, SEED))
+
+    def test_01(self):
+        '''get_key() and getthreshold()'''
+        for _ in range(NR_OF_CASES):
+            line = random_line(self.rng, self.seed_lines) + \
+                    self.rng.choice(ENDINGS)
+            for key in KEYS:
+                self.assert_same(reflibtodotxt.get_key(native(line), key),
+                        libtodotxt.get_key(native(line), key),
+                        "get_key(%r, %r)" % (native(line), key))
+                self.assert_same(reflibtodotxt.get_key_bytes(line, key),
+                        libtodotxt.get_key(line, key),
+                        "get_key(%r, %r)" % (line, key))
+            self.assert_same(call(reflibtodotxt.getthreshold, native(line)),
+                    call(libtodotxt.getthreshold, native(line)),
+                    "getthreshold(%r)" % native(line))
+            self.assert_same(call(reflibtodotxt.getthreshold_bytes, line),
+                    call(libtodotxt.getthreshold, line),
+                    "getthreshold(%r)" % line)
+
+    def test_02(self):
+        '''set_key() and set_keys()'''
+        for _ in range(NR_OF_CASES):
+            line = random_line(self.rng, self.seed_lines) + \
+                    self.rng.choice(ENDINGS)
+            edits = []
+            for _ in range(self.rng.randint(1, 3)):
+                key = self.rng.choice(KEYS)
+                value = None
+                if self.rng.randint(0, 2) > 0:
+                    value = self.rng.choice(DATES + RULES) or b"v"
+                edits.append((key, value))
+            expected = line
+            for (key, value) in edits:
+                expected = reflibtodotxt.set_key_bytes(expected, key, value)
+            (key, value) = edits[0]
+            if not native(line).startswith(key + ":"):
+                native_value = None
+                if value is not None:
+                    native_value = native(value)
+                self.assert_same(reflibtodotxt.set_key(native(line), key,
+                    native_value), libtodotxt.set_key(native(line), key,
+                        native_value), "set_key(%r, %r, %r)" % (native(line),
+                            key, native_value))
+            self.assert_same(reflibtodotxt.set_key_bytes(line, key, value),
+                    libtodotxt.set_key(line, key, value),
+                    "set_key(%r, %r, %r)" % (line, key, value))
+            self.assert_same(expected, libtodotxt.set_keys(line, edits),
+                    "set_keys(%r, %r)" % (line, edits))
+
+    def test_03(self):
+        '''add_interval() and next_recurrence()'''
+        start = datetime.date(2014, 1, 1)
+        for _ in range(NR_OF_CASES):
+            date = start + datetime.timedelta(days=self.rng.randint(0, 1000))
+            date_str = date.strftime("%Y-%m-%d")
+            if self.rng.randint(0, 9) == 0:
+                date_str = native(self.rng.choice(DATES))
+            rec = self.rng.choice(RULES)
+            interval = native(rec)
+            rule = reflibtodotxt.parse_rule(rec)
+            if rule is not None and rule[1] == "b":
+                # The original add_interval() has no business days
+                expected = call(lambda: reflibtodotxt.add_rule(
+                    datetime.datetime.strptime(date_str, "%Y-%m-%d").date(),
+                    rule).strftime("%Y-%m-%d"))
+            else:
+                expected = call(reflibtodotxt.add_interval, date_str,
+                        interval)
+            self.assert_same(expected, call(libtodotxt.add_interval,
+                date_str, interval), "add_interval(%r, %r)" % (date_str,
+                    interval))
+            self.assert_same(rule, libtodotxt.parse_recurrence(rec),
+                    "parse_recurrence(%r)" % rec)
+            if rule is not None:
+                for calendar_months in (False, True):
+                    self.assert_same(reflibtodotxt.add_rule(date, rule,
+                        calendar_months), libtodotxt.next_recurrence(date,
+                            rule, calendar_months),
+                        "next_recurrence(%r, %r, %r)" % (date, rule,
+                            calendar_months))
+
+    def random_recur_lines(self, catchups=()):
+        '''Returns random lines for add_recur(), half of them with a rule and
+        half of them with a "catchup:" tag of catchups'''
+        lines = []
+        for _ in range(self.rng.randint(0, 20)):
+            line = random_line(self.rng, self.seed_lines)
+            if self.rng.randint(0, 1) == 0:
+                line = reflibtodotxt.set_key_bytes(line, "rec",
+                        self.rng.choice(RULES))
+            if len(catchups) > 0 and self.rng.randint(0, 1) == 0:
+                line = reflibtodotxt.set_key_bytes(line, "catchup",
+                        self.rng.choice(catchups))
+            lines.append(line + self.rng.choice(ENDINGS[:-1]))
+        if len(lines) > 0 and self.rng.randint(0, 3) == 0:
+            # Only the last line may lack the line ending
+            lines[-1] = lines[-1].rstrip(b"\n")
+        return lines
+
+    def assert_add_recur(self, expected, lines, *args):
+        '''Asserts that libtodotxt.add_recur() with the optional arguments
+        args after is_dryrun and record_callback writes and returns the
+        expected result (see call()) of the reference for lines'''
+        temp_dir = tempfile.mkdtemp(prefix="tmp_testdifferential")
+        from_filename = os.path.join(temp_dir, "from.txt")
+        to_filename = os.path.join(temp_dir, "to.txt")
+        with open(from_filename, "wb") as file_:
+            file_.write(b"".join(lines))
+        with open(to_filename, "wb") as file_:
+            file_.write(b"")
+        actual = call(libtodotxt.add_recur, from_filename, to_filename,
+                MAX_THRESHOLD.decode("ascii"), False, None, *args)
+        with open(from_filename, "rb") as file_:
+            from_content = file_.read()
+        with open(to_filename, "rb") as file_:
+            to_content = file_.read()
+        shutil.rmtree(temp_dir)
+        description = "add_recur(%r, %r)" % (lines, args)
+        if expected[0] == "error" or actual[0] == "error":
+            self.assert_same(expected, actual, description)
+            return
+        (from_lines, to_lines, result) = expected[1]
+        self.assert_same(result, actual[1], description)
+        self.assert_same(b"".join(from_lines), from_content, description)
+        self.assert_same(b"".join(to_lines), to_content, description)
+
+    def test_04(self):
+        '''add_recur() byte for byte with the extended rules'''
+        for _ in range(max(NR_OF_CASES // 20, 1)):
+            lines = self.random_recur_lines()
+            calendar_months = self.rng.randint(0, 1) == 1
+            self.assert_add_recur(call(reflibtodotxt.add_recur_lines, lines,
+                MAX_THRESHOLD, calendar_months), lines, calendar_months)
+
+    def test_05(self):
+        '''add_recur() byte for byte against the original add_recur()'''
+        temp_dir = tempfile.mkdtemp(prefix="tmp_testdifferential")
+        from_filename = os.path.join(temp_dir, "from.txt")
+        to_filename = os.path.join(temp_dir, "to.txt")
+        for _ in range(max(NR_OF_CASES // 20, 1)):
+            lines = [random_baseline_line(self.rng) + b"\n"
+                    for _ in range(self.rng.randint(0, 20))]
+            if len(lines) > 0 and self.rng.randint(0, 3) == 0:
+                lines[-1] = lines[-1].rstrip(b"\n")
+            files = []
+            for function in (reflibtodotxt.add_recur, libtodotxt.add_recur):
+                with open(from_filename, "wb") as file_:
+                    file_.write(b"".join(lines))
+                with open(to_filename, "wb") as file_:
+                    file_.write(b"")
+                result = function(from_filename, to_filename,
+                        native(MAX_THRESHOLD), False)
+                result = dict([(key, [native(line) for line in result[key]])
+                    for key in ("from", "to")])
+                with open(from_filename, "rb") as from_file:
+                    with open(to_filename, "rb") as to_file:
+                        files.append((result, from_file.read(),
+                            to_file.read()))
+            self.assert_same(files[0], files[1], "add_recur(%r)" % lines)
+        shutil.rmtree(temp_dir)
+
+
+    def test_06(self):
+        '''add_recur() byte for byte with catch-up policies'''
+        for _ in range(max(NR_OF_CASES // 20, 1)):
+            lines = self.random_recur_lines(CATCHUPS)
+            calendar_months = self.rng.randint(0, 1) == 1
+            catchup = reflibtodotxt.parse_catchup(
+                    self.rng.choice(CATCHUPS[:5]))
+            now = datetime.date(2014, 6, 1) + datetime.timedelta(
+                    days=self.rng.randint(0, 400))
+            self.assert_add_recur(call(reflibtodotxt.add_recur_catchup,
+                lines, MAX_THRESHOLD, calendar_months, catchup, now), lines,
+                calendar_months, False, None, None, catchup, now)
+
+
+class TestReference(unittest.TestCase):
+    '''add_recur_catchup() of the reference on hand-computed examples'''
+
+    def test_01(self):
+        '''latest missed occurrence'''
+        lines = [b"Task t:2015-01-01 rec:1w\n"]
+        self.assertEqual(reflibtodotxt.add_recur_catchup(lines, b"2015-01-29",
+            catchup=1, now=datetime.date(2015, 1, 20)),
+            ([b"Task t:2015-02-05 rec:1w\n"],
+                [b"Task t:2015-01-15\n", b"Task t:2015-01-22\n",
+                    b"Task t:2015-01-29\n"],
+                {"from": [b"Task t:2015-02-05 rec:1w"],
+                    "to": [b"Task t:2015-01-15", b"Task t:2015-01-22",
+                        b"Task t:2015-01-29"]}))
+
+    def test_02(self):
+        '''the catchup: tag wins and is stripped from the added lines'''
+        lines = [b"Task t:2015-01-01 rec:1d catchup:2\n"]
+        self.assertEqual(reflibtodotxt.add_recur_catchup(lines, b"2015-01-05",
+            catchup=None, now=datetime.date(2015, 1, 4)),
+            ([b"Task t:2015-01-06 rec:1d catchup:2\n"],
+                [b"Task t:2015-01-02\n", b"Task t:2015-01-03\n",
+                    b"Task t:2015-01-04\n", b"Task t:2015-01-05\n"],
+                {"from": [b"Task t:2015-01-06 rec:1d catchup:2"],
+                    "to": [b"Task t:2015-01-02", b"Task t:2015-01-03",
+                        b"Task t:2015-01-04", b"Task t:2015-01-05"]}))
+
+    def test_03(self):
+        '''no missed occurrence, an invalid tag and a rule counted from
+        completion'''
+        lines = [b"Task t:2015-01-01 rec:1w\n",
+                b"Other t:2015-01-01 rec:+1w catchup:x\n"]
+        self.assertEqual(reflibtodotxt.add_recur_catchup(lines, b"2015-01-29",
+            catchup=0, now=datetime.date(2015, 2, 1)),
+            ([b"Task t:2015-02-05 rec:1w\n",
+                b"Other t:2015-02-05 rec:+1w catchup:x\n"],
+                [b"Other t:2015-01-01\n"],
+                {"from": [b"Task t:2015-02-05 rec:1w",
+                    b"Other t:2015-02-05 rec:+1w catchup:x"],
+                    "to": [b"Other t:2015-01-01"]}))
+
+    def test_04(self):
+        '''parse_catchup()'''
+        self.assertEqual(reflibtodotxt.parse_catchup(b"all"), None)
+        self.assertEqual(reflibtodotxt.parse_catchup(b"latest"), 1)
+        self.assertEqual(reflibtodotxt.parse_catchup(b"3"), 3)
+        self.assertRaises(ValueError, reflibtodotxt.parse_catchup, b"x")
+        self.assertRaises(ValueError, reflibtodotxt.parse_catchup, b"-1")
+
+
+if __name__ == '__main__':
+    unittest.main()
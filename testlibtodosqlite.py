@@ -0,0 +1,154 @@
+#!/usr/bin/env python
+# vim: set fileencoding=utf-8 :
+"""
+    testlibtodosqlite.py
+
+    Unittests for libtodosqlite.py, can be run by ./testlibtodosqlite.py
+"""
+# The MIT License (MIT)
+#
+# Copyright (c) 2015 Georg Lutz <georg@georglutz.de>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+import datetime
+import os
+import unittest
+import shutil
+import tempfile
+import libtodosqlite
+
+
+class TestSync(unittest.TestCase):
+    '''unit tests for the functions sync_file() and sync_dir()'''
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp(prefix="tmp_testlibtodosqlite")
+        self.conn = libtodosqlite.open_mirror(
+                os.path.join(self.temp_dir, "mirror.sqlite"))
+        self.todo_filename = os.path.join(self.temp_dir, "todo.txt")
+        with open(self.todo_filename, "w") as file_:
+            file_.write("(A) Task1 +p1 @c1 t:2015-01-02\n\nTask2 +p2\n")
+
+    def tearDown(self):
+        self.conn.close()
+        shutil.rmtree(self.temp_dir)
+
+    def get_lines(self):
+        '''Returns all lines in the mirror'''
+        return [row[0] for row in
+                self.conn.execute("SELECT line FROM tasks ORDER BY nr")]
+
+    def test_01(self):
+        '''Initial sync, unchanged file is skipped'''
+        self.assertTrue(libtodosqlite.sync_file(
+            self.conn, self.todo_filename, "todo.txt"))
+        self.assertEqual(["(A) Task1 +p1 @c1 t:2015-01-02", "Task2 +p2"],
+                self.get_lines())
+        self.assertFalse(libtodosqlite.sync_file(
+            self.conn, self.todo_filename, "todo.txt"))
+
+    def test_02(self):
+        '''Changed content, same modification time'''
+        libtodosqlite.sync_file(self.conn, self.todo_filename, "todo.txt")
+        stat_result = os.stat(self.todo_filename)
+        with open(self.todo_filename, "w") as file_:
+            file_.write("Task3\n")
+        os.utime(self.todo_filename,
+                (stat_result.st_atime, stat_result.st_mtime))
+        self.assertTrue(libtodosqlite.sync_file(
+            self.conn, self.todo_filename, "todo.txt"))
+        self.assertEqual(["Task3"], self.get_lines())
+        self.assertEqual(0, self.conn.execute(
+            "SELECT COUNT(*) FROM tags").fetchone()[0])
+
+    def test_03(self):
+        '''Touched file with same content is not parsed again'''
+        libtodosqlite.sync_file(self.conn, self.todo_filename, "todo.txt")
+        os.utime(self.todo_filename, (0, 0))
+        self.assertFalse(libtodosqlite.sync_file(
+            self.conn, self.todo_filename, "todo.txt"))
+
+    def test_04(self):
+        '''Removed files are removed from the mirror'''
+        actual = libtodosqlite.sync_dir(self.conn, self.temp_dir,
+                ["todo.txt", "future.txt"])
+        self.assertEqual(["todo.txt"], actual)
+        os.remove(self.todo_filename)
+        actual = libtodosqlite.sync_dir(self.conn, self.temp_dir,
+                ["todo.txt", "future.txt"])
+        self.assertEqual([], actual)
+        self.assertEqual([], self.get_lines())
+
+
+class TestQuery(unittest.TestCase):
+    '''unit tests for the functions query_agenda() and query_tasks()'''
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp(prefix="tmp_testlibtodosqlite")
+        self.conn = libtodosqlite.open_mirror(":memory:")
+        with open(os.path.join(self.temp_dir, "todo.txt"), "w") as file_:
+            file_.write("(A) Task1 +p1 @c1 t:2015-01-02\n"
+                    "Task2 +p2 +p1\n"
+                    "(B) Task3 +p1 t:2015-01-01\n")
+        with open(os.path.join(self.temp_dir, "future.txt"), "w") as file_:
+            file_.write("Task4 @c1 t:2015-03-01\n")
+        libtodosqlite.sync_dir(self.conn, self.temp_dir,
+                ["todo.txt", "future.txt"])
+
+    def tearDown(self):
+        self.conn.close()
+        shutil.rmtree(self.temp_dir)
+
+    def test_01(self):
+        '''agenda, ordered by date'''
+        actual = libtodosqlite.query_agenda(self.conn, None,
+                datetime.date(2015, 2, 1))
+        expected = [
+                {"file": "todo.txt", "nr": 3,
+                    "threshold": datetime.date(2015, 1, 1),
+                    "line": "(B) Task3 +p1 t:2015-01-01"},
+                {"file": "todo.txt", "nr": 1,
+                    "threshold": datetime.date(2015, 1, 2),
+                    "line": "(A) Task1 +p1 @c1 t:2015-01-02"}]
+        self.assertEqual(expected, actual)
+
+    def test_02(self):
+        '''agenda, restricted to file'''
+        actual = libtodosqlite.query_agenda(self.conn,
+                datetime.date(2015, 1, 2), None, ["future.txt"])
+        self.assertEqual([("future.txt", 1)],
+                [(entry["file"], entry["nr"]) for entry in actual])
+
+    def test_03(self):
+        '''project'''
+        actual = libtodosqlite.query_tasks(self.conn, project="p1")
+        self.assertEqual([1, 2, 3], [entry["nr"] for entry in actual])
+
+    def test_04(self):
+        '''context and priority'''
+        actual = libtodosqlite.query_tasks(self.conn, context="c1")
+        self.assertEqual([("future.txt", 1), ("todo.txt", 1)],
+                [(entry["file"], entry["nr"]) for entry in actual])
+        actual = libtodosqlite.query_tasks(self.conn, context="c1",
+                priority="A")
+        self.assertEqual([("todo.txt", 1)],
+                [(entry["file"], entry["nr"]) for entry in actual])
+
+
+if __name__ == '__main__':
+    unittest.main()
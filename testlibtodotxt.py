@@ -27,12 +27,22 @@
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 # SOFTWARE.
 
+import bz2
 import datetime
 import filecmp
+import gzip
+import heapq
+import itertools
 import os
 import unittest
 import shutil
 import tempfile
+import threading
+import time
+try:
+    from StringIO import StringIO
+except ImportError:
+    from io import StringIO
 import libtodotxt
 
 
@@ -124,6 +134,183 @@ class TestReadTodoTxt(unittest.TestCase):
         self.assertTrue(check_agenda_data_equal(agenda_data, expected))
 
 
+class TestReadTodoTxtParallel(unittest.TestCase):
+    '''unit tests for function readtodotxt_parallel()'''
+    def setUp(self):
+        script_dir = os.path.dirname(__file__)
+        self.testdir = os.path.join(script_dir, "testfiles")
+
+    def start_testcase(self, todo_filename):
+        '''Compares the result of readtodotxt_parallel() with readtodotxt()'''
+        expected = libtodotxt.readtodotxt(todo_filename)
+        for processes in [1, 2, 3, 7]:
+            actual = libtodotxt.readtodotxt_parallel(
+                    todo_filename, processes, min_chunk_size=1)
+            self.assertEqual(expected, actual)
+
+    def test_01(self):
+        '''All testfiles, split into tiny chunks'''
+        for nr in range(1, 7):
+            self.start_testcase(
+                    os.path.join(self.testdir, "todo0%d.txt" % nr))
+
+    def test_02(self):
+        '''Bigger file with empty lines'''
+        temp_dir = tempfile.mkdtemp(prefix="tmp_testlibtodotxt")
+        todo_filename = os.path.join(temp_dir, "todo.txt")
+        with open(todo_filename, "w") as file_:
+            for nr in range(1000):
+                if nr % 7 == 0:
+                    file_.write("\n")
+                else:
+                    file_.write("Task%d t:2015-01-%02d\n" % (nr, nr % 28 + 1))
+        self.start_testcase(todo_filename)
+        shutil.rmtree(temp_dir)
+
+    def test_03(self):
+        '''Line endings, trailing and non-ASCII whitespace'''
+        temp_dir = tempfile.mkdtemp(prefix="tmp_testlibtodotxt")
+        todo_filename = os.path.join(temp_dir, "todo.txt")
+        with open(todo_filename, "wb") as file_:
+            for nr in range(200):
+                file_.write(b"Task%d \xc3\xa4 t:2015-01-%02d%s" % (nr,
+                    nr % 28 + 1, [b"\n", b"\r\n", b"\r", b" \t\n",
+                        b"\xe2\x80\x83\n"][nr % 5]))
+        self.start_testcase(todo_filename)
+        shutil.rmtree(temp_dir)
+
+    def test_04(self):
+        '''The workers pass back the positions, not the lines'''
+        todo_filename = os.path.join(self.testdir, "todo04.txt")
+        (positions, nr_of_lines) = libtodotxt._readtodotxt_chunk(
+                (todo_filename, 0, os.path.getsize(todo_filename)))
+        agenda_data = libtodotxt.readtodotxt(todo_filename)
+        self.assertEqual(sorted(agenda_data, key=str),
+                sorted(positions, key=str))
+        for threshold in positions:
+            self.assertEqual([entry["nr"] for entry
+                in agenda_data[threshold]],
+                list(positions[threshold][::3]))
+        with open(todo_filename, "rb") as file_:
+            self.assertEqual(len(file_.readlines()), nr_of_lines)
+
+
+class TestSelectAgenda(unittest.TestCase):
+    '''unit tests for the functions itertodotxt() and select_agenda()'''
+    def setUp(self):
+        script_dir = os.path.dirname(__file__)
+        self.testdir = os.path.join(script_dir, "testfiles")
+        self.now = datetime.date(2015, 1, 1)
+
+    def get_expected(self, todo_filename, limit, max_days):
+        '''Selects the entries from the fully sorted agenda'''
+        agenda_data = libtodotxt.readtodotxt(todo_filename)
+        libtodotxt.add_threshold_to_empty(agenda_data, self.now)
+        dates = sorted(agenda_data)
+        if max_days is not None:
+            dates = dates[:max_days]
+        entries = []
+        for date in dates:
+            for entry in sorted(agenda_data[date],
+                    key=lambda entry: (entry["line"], entry["nr"])):
+                entries.append((date, entry))
+        if limit is not None:
+            entries = entries[:limit]
+        expected = {}
+        for (date, entry) in entries:
+            expected.setdefault(date, []).append(entry)
+        return expected
+
+    def test_01(self):
+        '''itertodotxt() yields the same entries as readtodotxt()'''
+        todo_filename = os.path.join(self.testdir, "todo04.txt")
+        expected = libtodotxt.readtodotxt(todo_filename)
+        actual = {}
+        for (threshold, line_nr, line) in libtodotxt.itertodotxt(
+                todo_filename):
+            actual.setdefault(threshold, []).append(
+                    {"line": line, "nr": line_nr})
+        self.assertEqual(expected, actual)
+
+    def test_02(self):
+        '''All combinations of limit and max_days'''
+        for nr in range(1, 7):
+            todo_filename = os.path.join(self.testdir, "todo0%d.txt" % nr)
+            for limit in [None, 0, 1, 2, 3, 100]:
+                for max_days in [None, 0, 1, 2, 3, 100]:
+                    actual = libtodotxt.select_agenda(
+                            libtodotxt.itertodotxt(todo_filename), self.now,
+                            limit, max_days)
+                    expected = self.get_expected(todo_filename, limit,
+                            max_days)
+                    for date in actual:
+                        actual[date].sort(key=lambda entry:
+                                (entry["line"], entry["nr"]))
+                    self.assertEqual(expected, actual)
+
+
+class TestIterRecur(unittest.TestCase):
+    '''unit tests for the function iter_recur()'''
+    def setUp(self):
+        script_dir = os.path.dirname(__file__)
+        self.testdir = os.path.join(script_dir, "testfiles")
+
+    def test_01(self):
+        '''Same lines as add_recur() in the add_recur testcases'''
+        for testcase in ["01", "02", "03", "04", "05", "06", "07", "08",
+                "10"]:
+            dirname = os.path.join(self.testdir, "add_recur", testcase)
+            with open(os.path.join(dirname, "max_threshold.txt")) as file_:
+                max_threshold = file_.readline().strip()
+            from_filename = os.path.join(dirname, "from_before.txt")
+            expected = libtodotxt.add_recur(
+                    from_filename, None, max_threshold, True)["to"]
+            actual = libtodotxt.iter_recur(from_filename,
+                    datetime.datetime.strptime(max_threshold,
+                        "%Y-%m-%d").date())
+            self.assertEqual(expected,
+                    [line.encode("utf-8") for (_, _, line) in actual])
+
+
+class TestForecastRecur(unittest.TestCase):
+    '''unit tests for the function forecast_recur()'''
+    def setUp(self):
+        script_dir = os.path.dirname(__file__)
+        self.testdir = os.path.join(script_dir, "testfiles")
+
+    def test_01(self):
+        '''Same occurrences as iter_recur(), sorted by date'''
+        from_filename = os.path.join(self.testdir, "add_recur", "08",
+                "from_before.txt")
+        max_threshold = datetime.date(2015, 6, 1)
+        expected = sorted(libtodotxt.iter_recur(from_filename, max_threshold))
+        actual = list(libtodotxt.forecast_recur(from_filename, max_threshold))
+        self.assertEqual(expected, actual)
+
+
+class TestIterSortedAgenda(unittest.TestCase):
+    '''unit tests for the function iter_sorted_agenda()'''
+
+    def test_01(self):
+        '''Merge of two sources'''
+        now = datetime.date(2015, 1, 2)
+        entries1 = [(datetime.date(2015, 1, 3), 1, "B"), (None, 2, "A"),
+                (datetime.date(2015, 2, 1), 3, "C")]
+        entries2 = [(datetime.date(2015, 1, 3), 1, "A"),
+                (datetime.date(2015, 1, 1), 2, "D")]
+        actual = list(heapq.merge(
+            libtodotxt.iter_sorted_agenda(entries1, "todo.txt", now),
+            libtodotxt.iter_sorted_agenda(entries2, "future.txt", now,
+                datetime.date(2015, 1, 3))))
+        expected = [
+                (datetime.date(2015, 1, 1), "D", "future.txt", 2),
+                (datetime.date(2015, 1, 2), "A", "todo.txt", 2),
+                (datetime.date(2015, 1, 3), "A", "future.txt", 1),
+                (datetime.date(2015, 1, 3), "B", "todo.txt", 1),
+                (datetime.date(2015, 2, 1), "C", "todo.txt", 3)]
+        self.assertEqual(expected, actual)
+
+
 class TestAddThresholdToEmpty(unittest.TestCase):
     '''unittests for function add_threshold_to_empty()'''
     def setUp(self):
@@ -333,6 +520,20 @@ class TestMoveLines(unittest.TestCase):
             to_filename, to_after_filename, shallow=False))
         shutil.rmtree(temp_dir)
 
+        # Moved lines returned and appended afterwards
+        temp_dir = tempfile.mkdtemp(prefix="tmp_testlibtodotxt")
+        from_filename = os.path.join(temp_dir, "from.txt")
+        to_filename = os.path.join(temp_dir, "to.txt")
+        shutil.copyfile(from_before_filename, from_filename)
+        shutil.copyfile(to_before_filename, to_filename)
+        lines = libtodotxt.move_lines(from_filename, None, line_nrs, False)
+        libtodotxt.append_lines(to_filename, lines)
+        self.assertTrue(filecmp.cmp(
+            from_filename, from_after_filename, shallow=False))
+        self.assertTrue(filecmp.cmp(
+            to_filename, to_after_filename, shallow=False))
+        shutil.rmtree(temp_dir)
+
     def test_01(self):
         '''Empty to file'''
         self.start_testcase("01")
@@ -349,6 +550,38 @@ class TestMoveLines(unittest.TestCase):
         '''Empty lines'''
         self.start_testcase("04")
 
+    def test_05(self):
+        '''Lines spanning several chunks'''
+        temp_dir = tempfile.mkdtemp(prefix="tmp_testlibtodotxt")
+        from_filename = os.path.join(temp_dir, "from.txt")
+        to_filename = os.path.join(temp_dir, "to.txt")
+        lines = [b"Line %d %s\n" % (nr, b"x" * (nr % 13))
+                for nr in range(1, 60)]
+        lines.append(b"Last line without newline")
+        io_buffer_size = libtodotxt.IO_BUFFER_SIZE
+        try:
+            for buffer_size in [1, 2, 7, 64, 1000]:
+                libtodotxt.IO_BUFFER_SIZE = buffer_size
+                for line_nrs in [[1], [60], [61], [2, 3, 4, 30, 60],
+                        list(range(1, 61, 3)), [59, 5, 5]]:
+                    with open(from_filename, "wb") as file_:
+                        file_.write(b"".join(lines))
+                    with open(to_filename, "wb") as file_:
+                        file_.write(b"To\n")
+                    libtodotxt.move_lines(from_filename, to_filename,
+                            line_nrs, False)
+                    with open(from_filename, "rb") as file_:
+                        self.assertEqual(b"".join([line for nr, line
+                            in enumerate(lines, start=1)
+                            if nr not in line_nrs]), file_.read())
+                    with open(to_filename, "rb") as file_:
+                        self.assertEqual(b"To\n" + b"".join([line
+                            for nr, line in enumerate(lines, start=1)
+                            if nr in line_nrs]), file_.read())
+        finally:
+            libtodotxt.IO_BUFFER_SIZE = io_buffer_size
+        shutil.rmtree(temp_dir)
+
 
 class TestGetKey(unittest.TestCase):
     '''unit tests for the function get_key()'''
@@ -455,6 +688,122 @@ class TestSetKey(unittest.TestCase):
         expected = "blah key:value2 y:value3"
         self.assertEqual(expected, actual)
 
+    def test_09(self):
+        '''bytes line with non UTF-8 content'''
+        line = b"\xff\xfe task t:2015-01-01 rec:1d"
+        actual = libtodotxt.set_key(line, "t", b"2015-01-02")
+        actual = libtodotxt.set_key(actual, "rec", None)
+        expected = b"\xff\xfe task t:2015-01-02"
+        self.assertEqual(expected, actual)
+        self.assertEqual(b"2015-01-02", libtodotxt.get_key(actual, "t"))
+
+    def test_10(self):
+        '''key at line start'''
+        actual = libtodotxt.set_key("t:2015-01-01 Task", "t", "2015-01-02")
+        self.assertEqual("t:2015-01-02 Task", actual)
+
+
+class TestSetKeys(unittest.TestCase):
+    '''unit tests for the function set_keys()'''
+
+    def check_same_as_set_key(self, line, edits):
+        '''set_keys() must return the same as multiple set_key() calls'''
+        expected = line
+        for (key, value) in edits:
+            expected = libtodotxt.set_key(expected, key, value)
+        actual = libtodotxt.set_keys(line, edits)
+        self.assertEqual(expected, actual)
+
+    def test_01(self):
+        '''No edits'''
+        self.assertEqual("abc k:v", libtodotxt.set_keys("abc k:v", []))
+
+    def test_02(self):
+        '''Empty line, set two keys'''
+        self.check_same_as_set_key("", [("k1", "v1"), ("k2", "v2")])
+
+    def test_03(self):
+        '''Delete and change, as used by add_recur()'''
+        self.check_same_as_set_key("Task t:2015-01-01 rec:1w",
+                [("rec", None), ("t", "2015-01-08")])
+
+    def test_04(self):
+        '''Duplicate key, new key'''
+        self.check_same_as_set_key("abc t:2015-01-01 t:2016-01-01 rec:1d X",
+                [("t", "2015-02-01"), ("rec", None), ("due", "2015-03-01")])
+
+    def test_05(self):
+        '''Key which is substring of another one'''
+        self.check_same_as_set_key("blah key:value2 y:value1",
+                [("y", "value3"), ("key", None)])
+
+    def test_06(self):
+        '''Same key twice, last value wins'''
+        self.check_same_as_set_key("abc", [("k", "v1"), ("k", "v2")])
+
+    def test_07(self):
+        '''dict and bytes line'''
+        actual = libtodotxt.set_keys(b"\xff t:2015-01-01", {"t": None})
+        self.assertEqual(b"\xff", actual)
+
+    def test_08(self):
+        '''Keys at line start'''
+        actual = libtodotxt.set_keys("t:2015-01-01 rec:1d abc",
+                [("rec", None), ("t", "2015-02-01")])
+        self.assertEqual("t:2015-02-01 abc", actual)
+
+    def test_09(self):
+        '''Added key after the removed keys leave an empty line'''
+        self.check_same_as_set_key("t:2015-01-01 rec:1d",
+                [("t", None), ("due", "2015-01-02"), ("rec", None)])
+        self.check_same_as_set_key("t:2015-01-01",
+                [("due", "2015-01-02"), ("t", None)])
+
+    def test_10(self):
+        '''Keys with special characters of regular expressions'''
+        self.assertEqual("Task duetx:1 due.x:2 a(:3",
+                libtodotxt.set_keys("Task duetx:1 due.x:1",
+                    [("due.x", "2"), ("a(", "3")]))
+        self.assertEqual(b"Task duetx:1 due.x:2",
+                libtodotxt.set_key(b"Task duetx:1 due.x:1", "due.x", "2"))
+
+    def test_11(self):
+        '''Repeated key, e.g. bulkedit due=2016-01-01 due='''
+        self.check_same_as_set_key("Task due:2015-01-01 t:2015-01-01",
+                [("due", "2016-01-01"), ("t", None), ("due", None)])
+        self.check_same_as_set_key("Task t:2015-01-01",
+                [("due", None), ("t", "2015-02-01"), ("due", "2016-01-01"),
+                    ("t", None)])
+        self.check_same_as_set_key("rec:1d Task",
+                [("rec", None), ("due", "2016-01-01"), ("rec", "2d")])
+
+
+class TestGetProjectsContexts(unittest.TestCase):
+    '''unit tests for the functions get_projects() and get_contexts()'''
+
+    def test_01(self):
+        '''projects'''
+        actual = libtodotxt.get_projects("+p1 Task a+b +p2 @c1")
+        self.assertEqual(["p1", "p2"], actual)
+
+    def test_02(self):
+        '''contexts'''
+        actual = libtodotxt.get_contexts(b"@c1 Task a@b +p2 @c2")
+        self.assertEqual([b"c1", b"c2"], actual)
+
+
+class TestGetPriority(unittest.TestCase):
+    '''unit tests for the function get_priority()'''
+
+    def test_01(self):
+        '''priority'''
+        self.assertEqual("A", libtodotxt.get_priority("(A) Task (B) "))
+
+    def test_02(self):
+        '''no priority'''
+        self.assertEqual(None, libtodotxt.get_priority("Task (A) "))
+        self.assertEqual(None, libtodotxt.get_priority("(A)Task"))
+
 
 class TestAddIntervalSetKey(unittest.TestCase):
     '''unit tests for the function add_interval()'''
@@ -524,6 +873,143 @@ class TestAddIntervalSetKey(unittest.TestCase):
         self.assertEqual(expected, actual)
 
 
+    def test_09(self):
+        '''3 business days over a weekend'''
+        start = "2015-03-05"
+        interval = "3b"
+        actual = libtodotxt.add_interval(start, interval)
+        expected = "2015-03-10"
+        self.assertEqual(expected, actual)
+
+
+class TestParseRecurrence(unittest.TestCase):
+    '''unit tests for the function parse_recurrence()'''
+
+    def test_01(self):
+        '''Strict and from completion rules'''
+        self.assertEqual((2, "w", False), libtodotxt.parse_recurrence("2w"))
+        self.assertEqual((1, "b", True), libtodotxt.parse_recurrence(b"+1b"))
+
+    def test_02(self):
+        '''Invalid rules'''
+        self.assertEqual(None, libtodotxt.parse_recurrence("2x"))
+        self.assertEqual(None, libtodotxt.parse_recurrence("w"))
+
+
+class TestNextRecurrence(unittest.TestCase):
+    '''unit tests for the function next_recurrence()'''
+
+    def check(self, start, rule, expected, calendar_months=False):
+        '''Compares next_recurrence() for ISO 8601 dates'''
+        actual = libtodotxt.next_recurrence(libtodotxt.parse_date(start),
+                libtodotxt.parse_recurrence(rule), calendar_months)
+        self.assertEqual(expected, actual.strftime("%Y-%m-%d"))
+
+    def test_01(self):
+        '''Business days'''
+        self.check("2015-03-06", "1b", "2015-03-09")
+        self.check("2015-03-07", "1b", "2015-03-09")
+        self.check("2015-03-08", "5b", "2015-03-13")
+        self.check("2015-03-04", "7b", "2015-03-13")
+
+    def test_02(self):
+        '''Calendar months, the day is clamped'''
+        self.check("2015-01-31", "1m", "2015-02-28", True)
+        self.check("2015-11-15", "3m", "2016-02-15", True)
+        self.check("2016-02-29", "1y", "2017-02-28", True)
+
+    def test_03(self):
+        '''Fixed month length without calendar_months'''
+        self.check("2015-01-31", "1m", "2015-03-02")
+
+
+class TestIterRecurrence(unittest.TestCase):
+    '''unit tests for the functions iter_recurrence() and
+    get_next_threshold()'''
+
+    def test_01(self):
+        '''Strict rule yields all occurrences up to max_threshold'''
+        rule = libtodotxt.parse_recurrence("1w")
+        start = datetime.date(2015, 1, 1)
+        max_threshold = datetime.date(2015, 1, 15)
+        self.assertEqual([datetime.date(2015, 1, 1),
+            datetime.date(2015, 1, 8), datetime.date(2015, 1, 15)],
+            list(libtodotxt.iter_recurrence(start, rule, max_threshold)))
+        self.assertEqual(datetime.date(2015, 1, 22),
+                libtodotxt.get_next_threshold(start, rule, max_threshold))
+
+    def test_02(self):
+        '''From completion rule yields only the next occurrence'''
+        rule = libtodotxt.parse_recurrence("+1w")
+        start = datetime.date(2015, 1, 1)
+        max_threshold = datetime.date(2015, 1, 15)
+        self.assertEqual([start],
+            list(libtodotxt.iter_recurrence(start, rule, max_threshold)))
+        self.assertEqual(datetime.date(2015, 1, 22),
+                libtodotxt.get_next_threshold(start, rule, max_threshold))
+
+    def test_03(self):
+        '''Occurrences are generated lazily'''
+        rule = libtodotxt.parse_recurrence("1d")
+        occurrences = libtodotxt.iter_recurrence(datetime.date(2015, 1, 1),
+                rule, datetime.date(9999, 1, 1))
+        self.assertEqual(datetime.date(2015, 1, 3), next(itertools.islice(
+            occurrences, 2, None)))
+
+    def test_04(self):
+        '''Zero interval yields nothing'''
+        rule = libtodotxt.parse_recurrence("0d")
+        self.assertEqual([], list(libtodotxt.iter_recurrence(
+            datetime.date(2015, 1, 1), rule, datetime.date(2015, 2, 1))))
+
+
+class TestSkipRecurrences(unittest.TestCase):
+    '''unit tests for the functions parse_catchup() and skip_recurrences()'''
+
+    def test_01(self):
+        '''parse_catchup()'''
+        self.assertEqual(None, libtodotxt.parse_catchup("all"))
+        self.assertEqual(1, libtodotxt.parse_catchup(b"latest"))
+        self.assertEqual(3, libtodotxt.parse_catchup("3"))
+        self.assertRaises(ValueError, libtodotxt.parse_catchup, "-1")
+        self.assertRaises(ValueError, libtodotxt.parse_catchup, "max")
+
+    def test_02(self):
+        '''Same result as enumerating the occurrences'''
+        threshold = datetime.date(2015, 1, 31)
+        for rec in ["1d", "3d", "2w", "1m", "1y", "1b", "3b", "7b"]:
+            rule = libtodotxt.parse_recurrence(rec)
+            for calendar_months in [False, True]:
+                for days in [0, 1, 2, 30, 100, 1000]:
+                    now = datetime.date(2015, 2, 7) + \
+                            datetime.timedelta(days=days)
+                    occurrences = list(libtodotxt.iter_recurrence(threshold,
+                        rule, now - datetime.timedelta(days=1),
+                        calendar_months))
+                    for max_missed in [0, 1, 2]:
+                        expected = libtodotxt.get_next_threshold(threshold,
+                                rule, now - datetime.timedelta(days=1),
+                                calendar_months)
+                        if max_missed > 0 and \
+                                len(occurrences) >= max_missed:
+                            expected = occurrences[-max_missed]
+                        elif max_missed > 0:
+                            expected = threshold
+                        self.assertEqual(expected,
+                                libtodotxt.skip_recurrences(threshold, rule,
+                                    now, max_missed, calendar_months),
+                                (rec, calendar_months, days, max_missed))
+
+    def test_03(self):
+        '''all and from completion rules are not changed'''
+        threshold = datetime.date(2015, 1, 1)
+        now = datetime.date(2015, 3, 1)
+        self.assertEqual(threshold, libtodotxt.skip_recurrences(threshold,
+            (1, "d", False), now, None))
+        self.assertEqual(threshold, libtodotxt.skip_recurrences(threshold,
+            (1, "d", True), now, 1))
+
+
 class TestAddRecur(unittest.TestCase):
     '''unit tests for the function add_recur()'''
 
@@ -547,12 +1033,12 @@ class TestAddRecur(unittest.TestCase):
             max_threshold = file_.readline().strip()
 
         from_new_expected = []
-        with open(from_new_filename) as file_:
+        with open(from_new_filename, "rb") as file_:
             for line in file_:
                 from_new_expected.append(line.strip())
 
         to_new_expected = []
-        with open(to_new_filename) as file_:
+        with open(to_new_filename, "rb") as file_:
             for line in file_:
                 to_new_expected.append(line.strip())
 
@@ -613,6 +1099,1332 @@ class TestAddRecur(unittest.TestCase):
         '''more realistic example, 10 days threshold'''
         self.start_testcase("08")
 
+    def test_09(self):
+        '''non UTF-8 bytes and CRLF line endings are kept'''
+        self.start_testcase("09")
+
+    def test_10(self):
+        '''record_callback gets the lines instead of the result'''
+        dirname = os.path.join(self.testdir, "add_recur", "08")
+        records = []
+        def record_callback(key, line_nr, threshold, line):
+            '''Collects the records'''
+            records.append((key, line_nr, threshold, line))
+        new_lines = libtodotxt.add_recur(
+                os.path.join(dirname, "from_before.txt"), None,
+                "2015-03-11", True, record_callback)
+        self.assertEqual({"from": [], "to": []}, new_lines)
+        expected = [
+                ("to", 1, b"2015-03-01", b"RecurTask1 t:2015-03-01"),
+                ("from", 1, b"2015-08-28", b"RecurTask1 t:2015-08-28 rec:6m"),
+                ("to", 2, b"2015-03-02", b"RecurTask2 t:2015-03-02"),
+                ("from", 2, b"2015-03-16", b"RecurTask2 t:2015-03-16 rec:2w"),
+                ("to", 3, b"2015-03-04", b"RecurTask3 t:2015-03-04"),
+                ("to", 3, b"2015-03-11", b"RecurTask3 t:2015-03-11"),
+                ("from", 3, b"2015-03-18", b"RecurTask3 t:2015-03-18 rec:7d")]
+        self.assertEqual(expected, records)
+
+    def test_11(self):
+        '''from completion and business day rules, invalid date'''
+        self.start_testcase("10")
+
+    def test_12(self):
+        '''dedup: restored from file adds no duplicates'''
+        dirname = os.path.join(self.testdir, "add_recur", "08")
+        temp_dir = tempfile.mkdtemp(prefix="tmp_testlibtodotxt")
+        from_filename = os.path.join(temp_dir, "from.txt")
+        to_filename = os.path.join(temp_dir, "to.txt")
+        shutil.copyfile(os.path.join(dirname, "from_before.txt"),
+                from_filename)
+        shutil.copyfile(os.path.join(dirname, "to_before.txt"), to_filename)
+        new_lines = libtodotxt.add_recur(from_filename, to_filename,
+                "2015-03-11", False, dedup=True)
+        self.assertEqual([], new_lines["skipped"])
+        self.assertTrue(os.path.isfile(
+            to_filename + libtodotxt.LINE_HASHES_SUFFIX))
+        with open(to_filename, "rb") as file_:
+            to_content = file_.read()
+
+        # recur.txt restored from backup
+        shutil.copyfile(os.path.join(dirname, "from_before.txt"),
+                from_filename)
+        new_lines = libtodotxt.add_recur(from_filename, to_filename,
+                "2015-03-11", False, dedup=True)
+        self.assertEqual([], new_lines["to"])
+        self.assertEqual(4, len(new_lines["skipped"]))
+        with open(to_filename, "rb") as file_:
+            self.assertEqual(to_content, file_.read())
+        self.assertTrue(filecmp.cmp(from_filename,
+            os.path.join(dirname, "from_after.txt"), shallow=False))
+        shutil.rmtree(temp_dir)
+
+    def test_13(self):
+        '''dedup: completed and reformatted tasks count as existing'''
+        temp_dir = tempfile.mkdtemp(prefix="tmp_testlibtodotxt")
+        from_filename = os.path.join(temp_dir, "from.txt")
+        to_filename = os.path.join(temp_dir, "to.txt")
+        with open(from_filename, "wb") as file_:
+            file_.write(b"Task1 t:2015-03-01 rec:1d\n")
+        with open(to_filename, "wb") as file_:
+            file_.write(b"x 2015-03-01 Task1  t:2015-03-01\n")
+        new_lines = libtodotxt.add_recur(from_filename, to_filename,
+                "2015-03-02", True, dedup=True)
+        self.assertEqual([b"Task1 t:2015-03-01"], new_lines["skipped"])
+        self.assertEqual([b"Task1 t:2015-03-02"], new_lines["to"])
+        shutil.rmtree(temp_dir)
+
+    def test_14(self):
+        '''catch-up policy of the tag and the parameter'''
+        temp_dir = tempfile.mkdtemp(prefix="tmp_testlibtodotxt")
+        from_filename = os.path.join(temp_dir, "from.txt")
+        to_filename = os.path.join(temp_dir, "to.txt")
+        with open(from_filename, "wb") as file_:
+            file_.write(b"Task1 t:2015-01-01 rec:1d catchup:latest\n"
+                    b"Task2 t:2015-01-01 rec:1w\n"
+                    b"Task3 t:2015-01-01 rec:1w catchup:all\n"
+                    b"Task4 t:2015-01-01 rec:1w catchup:x\n")
+        with open(to_filename, "wb") as file_:
+            file_.write(b"")
+        new_lines = libtodotxt.add_recur(from_filename, to_filename,
+                "2015-03-03", False, catchup=2,
+                now=datetime.date(2015, 3, 1))
+        self.assertEqual([b"Task1 t:2015-02-28", b"Task1 t:2015-03-01",
+            b"Task1 t:2015-03-02", b"Task1 t:2015-03-03",
+            b"Task2 t:2015-02-19", b"Task2 t:2015-02-26"] +
+            [b"Task3 t:2015-" + date for date in [b"01-01", b"01-08",
+                b"01-15", b"01-22", b"01-29", b"02-05", b"02-12", b"02-19",
+                b"02-26"]] +
+            [b"Task4 t:2015-02-19", b"Task4 t:2015-02-26"], new_lines["to"])
+        with open(from_filename, "rb") as file_:
+            self.assertEqual(b"Task1 t:2015-03-04 rec:1d catchup:latest\n"
+                    b"Task2 t:2015-03-05 rec:1w\n"
+                    b"Task3 t:2015-03-05 rec:1w catchup:all\n"
+                    b"Task4 t:2015-03-05 rec:1w catchup:x\n", file_.read())
+        shutil.rmtree(temp_dir)
+
+
+def double(nr):
+    '''Source function of TestSources.test_02'''
+    return 2 * nr
+
+
+def add_recur_captured(filename):
+    '''Source function of TestSources.test_03'''
+    store = libtodotxt.CaptureStore()
+    result = libtodotxt.add_recur(filename, None, "2015-03-02", False,
+            store=store)
+    return (result, store)
+
+
+def sleep_source(seconds):
+    '''Source function of TestSources.test_04, returns the process id and
+    the start and end time'''
+    start = time.time()
+    time.sleep(seconds)
+    return (os.getpid(), start, time.time())
+
+
+class TestSources(unittest.TestCase):
+    '''unit tests for several sources (get_source_filenames(), map_sources()
+    and CaptureStore)'''
+
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp(prefix="tmp_testlibtodotxt")
+        os.mkdir(os.path.join(self.temp_dir, "recur.d"))
+        for (name, content) in [("a.txt", b"Task1 t:2015-03-01 rec:1d\n"),
+                ("b.txt", b"Task1 t:2015-03-02 rec:1w\nTask2\n"),
+                ("c.bak", b"")]:
+            with open(os.path.join(self.temp_dir, "recur.d", name),
+                    "wb") as file_:
+                file_.write(content)
+        self.todo_filename = os.path.join(self.temp_dir, "todo.txt")
+        with open(self.todo_filename, "wb") as file_:
+            file_.write(b"Task1 t:2015-03-01\n")
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def read_file(self, name):
+        '''Returns the content of the file name in temp_dir'''
+        with open(os.path.join(self.temp_dir, name), "rb") as file_:
+            return file_.read()
+
+    def test_01(self):
+        '''Directory and glob'''
+        expected = [os.path.join(self.temp_dir, "recur.d", name)
+                for name in ["a.txt", "b.txt"]]
+        self.assertEqual(expected,
+                libtodotxt.get_source_filenames(self.temp_dir, "recur.d"))
+        self.assertEqual(expected[1:],
+                libtodotxt.get_source_filenames(self.temp_dir, "recur.d/b*"))
+        self.assertEqual([],
+                libtodotxt.get_source_filenames(self.temp_dir, "none.d"))
+
+    def test_02(self):
+        '''Results in the order of the sources, in a pool and in the
+        current process'''
+        for processes in [4, 1]:
+            self.assertEqual(list(range(0, 40, 2)), list(
+                libtodotxt.map_sources(double, list(range(20)), processes)))
+        self.assertEqual([], list(libtodotxt.map_sources(double, [])))
+
+    def test_03(self):
+        '''add_recur() in the pool changes no file, the captured changes
+        are done by the journal'''
+        filenames = libtodotxt.get_source_filenames(self.temp_dir, "recur.d")
+        results = list(libtodotxt.map_sources(add_recur_captured, filenames,
+            2))
+        self.assertEqual(b"Task1 t:2015-03-01 rec:1d\n",
+                self.read_file("recur.d/a.txt"))
+        store = libtodotxt.JournalStore(os.path.join(self.temp_dir,
+            libtodotxt.JOURNAL_FILENAME))
+        lines = []
+        for (result, source_store) in results:
+            source_store.apply(store)
+            lines.extend(result["append"])
+        libtodotxt.append_lines(self.todo_filename, lines, store)
+        store.commit()
+        self.assertEqual(b"Task1 t:2015-03-01\nTask1 t:2015-03-01\n"
+                b"Task1 t:2015-03-02\nTask1 t:2015-03-02\n",
+                self.read_file("todo.txt"))
+        self.assertEqual(b"Task1 t:2015-03-03 rec:1d\n",
+                self.read_file("recur.d/a.txt"))
+        self.assertEqual(b"Task1 t:2015-03-09 rec:1w\nTask2\n",
+                self.read_file("recur.d/b.txt"))
+
+    def test_04(self):
+        '''The sources are processed at the same time in other processes'''
+        start = time.time()
+        results = list(libtodotxt.map_sources(sleep_source, [0.5] * 4, 4))
+        self.assertEqual(4, len(set([pid for (pid, _, _) in results])))
+        self.assertFalse(os.getpid() in [pid for (pid, _, _) in results])
+        # All sleep at the same time
+        self.assertTrue(max([source_start for (_, source_start, _)
+            in results]) < min([end for (_, _, end) in results]))
+        self.assertTrue(time.time() - start < 2.0)
+
+    def test_05(self):
+        '''CaptureStore: move_lines() with id maps and appends'''
+        from_filename = os.path.join(self.temp_dir, "recur.d", "b.txt")
+        libtodotxt.create_id_map(from_filename)
+        libtodotxt.create_id_map(self.todo_filename)
+        store = libtodotxt.CaptureStore()
+        moved_lines = libtodotxt.move_lines(from_filename, None, [1], False,
+                store)
+        libtodotxt.append_lines(self.todo_filename, moved_lines, store)
+        libtodotxt.append_lines(self.todo_filename, [b"Task3\n"], store)
+        self.assertEqual(b"Task1 t:2015-03-01\n", self.read_file("todo.txt"))
+        self.assertEqual(len(b"Task1 t:2015-03-01\nTask1 t:2015-03-02 "
+            b"rec:1w\nTask3\n"),
+            store.get_append_offset(self.todo_filename))
+        store.apply(libtodotxt.LocalFileStore())
+        self.assertEqual(b"Task2\n", self.read_file("recur.d/b.txt"))
+        self.assertEqual(b"Task1 t:2015-03-01\nTask1 t:2015-03-02 rec:1w\n"
+                b"Task3\n", self.read_file("todo.txt"))
+        for filename in [from_filename, self.todo_filename]:
+            self.assertEqual(libtodotxt.build_id_map(filename),
+                    libtodotxt.read_id_map(filename))
+
+
+class TestStores(unittest.TestCase):
+    '''unit tests for the stores (MemoryStore, MmapStore), same results as
+    with the local files'''
+
+    def setUp(self):
+        script_dir = os.path.dirname(__file__)
+        self.testdir = os.path.join(script_dir, "testfiles")
+
+    def read_file(self, dirname, name):
+        '''Returns the content of a test file'''
+        with open(os.path.join(dirname, name), "rb") as file_:
+            return file_.read()
+
+    def test_01(self):
+        '''add_recur() with MemoryStore'''
+        for testcase in ["01", "03", "06", "09", "10"]:
+            dirname = os.path.join(self.testdir, "add_recur", testcase)
+            store = libtodotxt.MemoryStore({
+                "recur.txt": self.read_file(dirname, "from_before.txt"),
+                "todo.txt": self.read_file(dirname, "to_before.txt")})
+            max_threshold = self.read_file(dirname, "max_threshold.txt")
+            libtodotxt.add_recur("recur.txt", "todo.txt",
+                    max_threshold.strip(), False, store=store)
+            self.assertEqual(self.read_file(dirname, "from_after.txt"),
+                    store.files["recur.txt"])
+            self.assertEqual(self.read_file(dirname, "to_after.txt"),
+                    store.files["todo.txt"])
+
+    def test_02(self):
+        '''move_lines() with MemoryStore'''
+        for testcase in ["01", "02", "03", "04"]:
+            dirname = os.path.join(self.testdir, "move_lines", testcase)
+            line_nrs = [int(line) for line in
+                    self.read_file(dirname, "lines.txt").split()]
+            for (preserve_line_nrs, from_after) in [
+                    (False, "from_after.txt"),
+                    (True, "from_after_preserve.txt")]:
+                store = libtodotxt.MemoryStore({
+                    "future.txt": self.read_file(dirname, "from_before.txt"),
+                    "todo.txt": self.read_file(dirname, "to_before.txt")})
+                libtodotxt.move_lines("future.txt", "todo.txt", line_nrs,
+                        preserve_line_nrs, store)
+                self.assertEqual(self.read_file(dirname, from_after),
+                        store.files["future.txt"])
+                self.assertEqual(self.read_file(dirname, "to_after.txt"),
+                        store.files["todo.txt"])
+
+    def test_03(self):
+        '''add_recur() with MmapStore'''
+        dirname = os.path.join(self.testdir, "add_recur", "08")
+        temp_dir = tempfile.mkdtemp(prefix="tmp_testlibtodotxt")
+        from_filename = os.path.join(temp_dir, "from.txt")
+        to_filename = os.path.join(temp_dir, "to.txt")
+        shutil.copyfile(os.path.join(dirname, "from_before.txt"),
+                from_filename)
+        shutil.copyfile(os.path.join(dirname, "to_before.txt"), to_filename)
+        libtodotxt.add_recur(from_filename, to_filename, "2015-03-11", False,
+                store=libtodotxt.MmapStore())
+        self.assertTrue(filecmp.cmp(from_filename,
+            os.path.join(dirname, "from_after.txt"), shallow=False))
+        self.assertTrue(filecmp.cmp(to_filename,
+            os.path.join(dirname, "to_after.txt"), shallow=False))
+        shutil.rmtree(temp_dir)
+
+    def test_04(self):
+        '''readtodotxt() with MemoryStore, bulk_edit() discards nothing in
+        dry run'''
+        content = self.read_file(self.testdir, "todo04.txt")
+        store = libtodotxt.MemoryStore({"todo.txt": content})
+        self.assertEqual(libtodotxt.readtodotxt(
+            os.path.join(self.testdir, "todo04.txt")),
+            libtodotxt.readtodotxt("todo.txt", store))
+        libtodotxt.bulk_edit("todo.txt", lambda line: True, [("a", "b")],
+                True, store=store)
+        self.assertEqual(content, store.files["todo.txt"])
+
+    def test_05(self):
+        '''Missing file in MemoryStore'''
+        store = libtodotxt.MemoryStore()
+        self.assertRaises(IOError, store.open_read, "todo.txt")
+        self.assertFalse(store.exists("todo.txt"))
+
+    def test_06(self):
+        '''The text readers of MmapStore read through the mapping'''
+        filename = os.path.join(self.testdir, "todo04.txt")
+        mmap_function = libtodotxt.mmap.mmap
+        mapped = []
+        def record_mmap(*args, **kwargs):
+            '''Records the mappings'''
+            mapped.append(mmap_function(*args, **kwargs))
+            return mapped[-1]
+        store = libtodotxt.MmapStore()
+        libtodotxt.mmap.mmap = record_mmap
+        try:
+            agenda_data = libtodotxt.readtodotxt(filename, store)
+            self.assertEqual(1, len(mapped))
+            entries = list(libtodotxt.itertodotxt(filename, store))
+            self.assertEqual(2, len(mapped))
+        finally:
+            libtodotxt.mmap.mmap = mmap_function
+        self.assertEqual(libtodotxt.readtodotxt(filename), agenda_data)
+        self.assertEqual(list(libtodotxt.itertodotxt(filename)), entries)
+
+    def test_07(self):
+        '''shard_todotxt(), archive_done() and the id maps with
+        MemoryStore'''
+        dirname = os.path.join(self.testdir, "shard_todotxt", "01")
+        store = libtodotxt.MemoryStore({
+            "future.txt": self.read_file(dirname, "before.txt")})
+        libtodotxt.shard_todotxt("future.txt", "future.d", False, store)
+        self.assertEqual(b"", store.files.pop("future.txt"))
+        shards_dir = os.path.join(dirname, "shards_after")
+        self.assertEqual(dict([(os.path.join("future.d", name),
+            self.read_file(shards_dir, name))
+            for name in os.listdir(shards_dir)]), store.files)
+
+        dirname = os.path.join(self.testdir, "archive_done", "01")
+        store = libtodotxt.MemoryStore({
+            "todo.txt": self.read_file(dirname, "todo_before.txt")})
+        default_date = self.read_file(dirname, "default_date.txt").strip()
+        libtodotxt.archive_done("todo.txt", "done.d", default_date, False,
+                False, store)
+        self.assertEqual(self.read_file(dirname, "todo_after.txt"),
+                store.files["todo.txt"])
+        done_dir = os.path.join(dirname, "done_after")
+        for name in ["2015-01.txt", "2015-02.txt"]:
+            self.assertEqual(self.read_file(done_dir, name),
+                    store.files[os.path.join("done.d", name)])
+
+        id_map = libtodotxt.build_id_map("todo.txt", store)
+        for (task_id, (line_nr, _)) in id_map["ids"].items():
+            (found_line_nr, line) = libtodotxt.lookup_task("todo.txt",
+                    task_id, id_map, store)
+            self.assertEqual(line_nr, found_line_nr)
+            self.assertEqual(task_id.split(".")[0],
+                    libtodotxt.get_task_id(line))
+
+
+class TestBulkEdit(unittest.TestCase):
+    '''unit tests for the function bulk_edit()'''
+
+    def setUp(self):
+        script_dir = os.path.dirname(__file__)
+        self.testdir = os.path.join(script_dir, "testfiles")
+
+    def test_01(self):
+        '''Select project, shift, delete and add keys'''
+        dirname = os.path.join(self.testdir, "bulk_edit", "01")
+        temp_dir = tempfile.mkdtemp(prefix="tmp_testlibtodotxt")
+        filename = os.path.join(temp_dir, "todo.txt")
+        shutil.copyfile(os.path.join(dirname, "before.txt"), filename)
+
+        def shift(value):
+            '''Shifts date by one week'''
+            if value is None or value == b"abc":
+                return value
+            return libtodotxt.add_interval(value.decode("ascii"), "1w")
+        edits = [("t", shift), ("due", None), ("pri", "x")]
+
+        def line_filter(line):
+            '''Selects +proj'''
+            return b"proj" in libtodotxt.get_projects(line)
+
+        records = []
+        def record_callback(line_nr, line):
+            '''Collects the changed lines'''
+            records.append((line_nr, line))
+
+        actual = libtodotxt.bulk_edit(filename, line_filter, edits, True,
+                record_callback)
+        self.assertEqual(3, actual)
+        self.assertEqual([1, 4, 5], [record[0] for record in records])
+        self.assertTrue(filecmp.cmp(filename,
+            os.path.join(dirname, "before.txt"), shallow=False))
+
+        actual = libtodotxt.bulk_edit(filename, line_filter, edits, False)
+        self.assertEqual(3, actual)
+        self.assertTrue(filecmp.cmp(filename,
+            os.path.join(dirname, "after.txt"), shallow=False))
+        shutil.rmtree(temp_dir)
+
+
+class TestShardTodoTxt(unittest.TestCase):
+    '''unit tests for the functions shard_todotxt() and
+    get_shard_filenames()'''
+
+    def setUp(self):
+        script_dir = os.path.dirname(__file__)
+        self.dirname = os.path.join(script_dir, "testfiles", "shard_todotxt",
+                "01")
+        self.shard_dir = os.path.join(self.dirname, "shards_after")
+
+    def test_01(self):
+        '''Move tasks to shards'''
+        temp_dir = tempfile.mkdtemp(prefix="tmp_testlibtodotxt")
+        todo_filename = os.path.join(temp_dir, "future.txt")
+        shard_dir = os.path.join(temp_dir, "future.d")
+        shutil.copyfile(os.path.join(self.dirname, "before.txt"),
+                todo_filename)
+        expected = {"2015-01.txt": 2, "2015-02.txt": 1, "2016-05.txt": 1,
+                "unscheduled.txt": 1}
+
+        actual = libtodotxt.shard_todotxt(todo_filename, shard_dir, True)
+        self.assertEqual(expected, actual)
+        self.assertFalse(os.path.exists(shard_dir))
+
+        actual = libtodotxt.shard_todotxt(todo_filename, shard_dir, False)
+        self.assertEqual(expected, actual)
+        self.assertEqual(0, os.path.getsize(todo_filename))
+        self.assertEqual(sorted(os.listdir(self.shard_dir)),
+                sorted(os.listdir(shard_dir)))
+        for filename in os.listdir(self.shard_dir):
+            self.assertTrue(filecmp.cmp(os.path.join(shard_dir, filename),
+                os.path.join(self.shard_dir, filename), shallow=False))
+        shutil.rmtree(temp_dir)
+
+    def test_02(self):
+        '''Select shards up to a date'''
+        actual = libtodotxt.get_shard_filenames(self.shard_dir, None,
+                datetime.date(2015, 2, 1))
+        expected = [os.path.join(self.shard_dir, filename) for filename in
+                ["2015-01.txt", "2015-02.txt", "unscheduled.txt"]]
+        self.assertEqual(expected, actual)
+
+    def test_03(self):
+        '''Select shards in a window'''
+        actual = libtodotxt.get_shard_filenames(self.shard_dir,
+                datetime.date(2015, 2, 28), datetime.date(2016, 12, 1))
+        expected = [os.path.join(self.shard_dir, filename) for filename in
+                ["2015-02.txt", "2016-05.txt", "unscheduled.txt"]]
+        self.assertEqual(expected, actual)
+
+
+class TestCompressed(unittest.TestCase):
+    '''unit tests for reading compressed files (open_compressed())'''
+
+    def setUp(self):
+        script_dir = os.path.dirname(__file__)
+        self.todo_filename = os.path.join(script_dir, "testfiles",
+                "todo04.txt")
+        self.temp_dir = tempfile.mkdtemp(prefix="tmp_testlibtodotxt")
+        with open(self.todo_filename, "rb") as file_:
+            self.content = file_.read()
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def compress(self, name, module_open):
+        '''Writes the test file compressed to name in temp_dir'''
+        filename = os.path.join(self.temp_dir, name)
+        compressed_file = module_open(filename, "wb")
+        compressed_file.write(self.content)
+        compressed_file.close()
+        return filename
+
+    def test_01(self):
+        '''gzip and bz2 give the same result as the uncompressed file'''
+        expected = libtodotxt.readtodotxt(self.todo_filename)
+        for filename in [self.compress("todo.txt.gz", gzip.open),
+                self.compress("todo.txt.bz2", bz2.BZ2File)]:
+            self.assertEqual(expected, libtodotxt.readtodotxt(filename))
+            self.assertEqual(expected,
+                    libtodotxt.readtodotxt_parallel(filename, 2, 1))
+            self.assertEqual(list(libtodotxt.itertodotxt(self.todo_filename)),
+                    list(libtodotxt.itertodotxt(filename)))
+
+    def test_02(self):
+        '''xz'''
+        if libtodotxt.lzma is None:
+            self.skipTest("no lzma module")
+        filename = self.compress("todo.txt.xz", libtodotxt.lzma.open)
+        self.assertEqual(libtodotxt.readtodotxt(self.todo_filename),
+                libtodotxt.readtodotxt(filename))
+
+    def test_03(self):
+        '''Compressed shards and done segments are found'''
+        for name in ["2015-01.txt.gz", "2015-02.txt", "2015-02.txt.bz2",
+                "2015-03.txt.xz", "index.txt"]:
+            open(os.path.join(self.temp_dir, name), "wb").close()
+        self.assertEqual([os.path.join(self.temp_dir, name) for name in
+            ["2015-02.txt", "2015-02.txt.bz2"]],
+            libtodotxt.get_shard_filenames(self.temp_dir,
+                datetime.date(2015, 2, 1), datetime.date(2015, 2, 28)))
+        libtodotxt.write_done_index(self.temp_dir, {
+            "2015-01": {"count": 1, "first": "2015-01-01",
+                "last": "2015-01-01"},
+            "2015-02": {"count": 2, "first": "2015-02-01",
+                "last": "2015-02-02"}})
+        self.assertEqual([os.path.join(self.temp_dir, name) for name in
+            ["2015-01.txt.gz", "2015-02.txt", "2015-02.txt.bz2"]],
+            libtodotxt.get_done_segments(self.temp_dir, "2015-01-01",
+                "2015-02-28"))
+
+
+class TestGetRecordWriter(unittest.TestCase):
+    '''unit tests for the functions get_record_writer() and make_record()'''
+
+    def setUp(self):
+        self.records = [
+                libtodotxt.make_record("add", "recur.txt", 3,
+                    b"2015-01-01", b"Task, \"quoted\" t:2015-01-01\n"),
+                libtodotxt.make_record("show", "todo.txt", 12,
+                    datetime.date(2015, 2, 3), "Task2"),
+                libtodotxt.make_record("move", "future.txt", 1, None, "Task3")]
+
+    def test_01(self):
+        '''jsonl'''
+        output = StringIO()
+        write_record = libtodotxt.get_record_writer("jsonl", output)
+        for record in self.records:
+            write_record(record)
+        expected = (
+            '{"date": "2015-01-01", "nr": 3, '
+            '"line": "Task, \\"quoted\\" t:2015-01-01", '
+            '"file": "recur.txt", "action": "add"}\n'
+            '{"date": "2015-02-03", "nr": 12, "line": "Task2", '
+            '"file": "todo.txt", "action": "show"}\n'
+            '{"date": null, "nr": 1, "line": "Task3", '
+            '"file": "future.txt", "action": "move"}\n')
+        self.assertEqual(expected, output.getvalue())
+
+    def test_02(self):
+        '''csv'''
+        output = StringIO()
+        write_record = libtodotxt.get_record_writer("csv", output)
+        for record in self.records:
+            write_record(record)
+        expected = (
+            'date,nr,line,file,action\n'
+            '2015-01-01,3,"Task, ""quoted"" t:2015-01-01",recur.txt,add\n'
+            '2015-02-03,12,Task2,todo.txt,show\n'
+            ',1,Task3,future.txt,move\n')
+        self.assertEqual(expected, output.getvalue())
+
+    def test_03(self):
+        '''unknown format'''
+        self.assertRaises(ValueError, libtodotxt.get_record_writer,
+                "xml", StringIO())
+
+    def test_04(self):
+        '''Line which is not UTF-8'''
+        record = libtodotxt.make_record("add", "recur.txt", 1,
+                b"2015-01-03", b"Task\xff one t:2015-01-03\r\n")
+        output = StringIO()
+        libtodotxt.get_record_writer("jsonl", output)(record)
+        self.assertEqual('{"date": "2015-01-03", "nr": 1, '
+                '"line": "Task\\ufffd one t:2015-01-03", '
+                '"file": "recur.txt", "action": "add"}\n', output.getvalue())
+        output = StringIO()
+        libtodotxt.get_record_writer("csv", output)(record)
+        expected = u"date,nr,line,file,action\n" \
+                u"2015-01-03,1,Task\ufffd one t:2015-01-03,recur.txt,add\n"
+        if not isinstance(output.getvalue(), type(u"")):
+            expected = expected.encode("utf-8")
+        self.assertEqual(expected, output.getvalue())
+
+
+class TestArchiveDone(unittest.TestCase):
+    '''unit tests for the function archive_done()'''
+
+    def setUp(self):
+        script_dir = os.path.dirname(__file__)
+        self.testdir = os.path.join(script_dir, "testfiles")
+
+    def run_archive_done(self, dirname, preserve_line_nrs, todo_after):
+        '''Runs archive_done() on a copy of the testcase files'''
+        with open(os.path.join(dirname, "default_date.txt")) as file_:
+            default_date = file_.readline().strip()
+        temp_dir = tempfile.mkdtemp(prefix="tmp_testlibtodotxt")
+        todo_filename = os.path.join(temp_dir, "todo.txt")
+        done_dir = os.path.join(temp_dir, "done.d")
+        shutil.copyfile(os.path.join(dirname, "todo_before.txt"),
+                todo_filename)
+        if os.path.isdir(os.path.join(dirname, "done_before")):
+            shutil.copytree(os.path.join(dirname, "done_before"), done_dir)
+
+        libtodotxt.archive_done(todo_filename, done_dir, default_date,
+                preserve_line_nrs, False)
+        self.assertTrue(filecmp.cmp(todo_filename,
+            os.path.join(dirname, todo_after), shallow=False))
+        expected_dir = os.path.join(dirname, "done_after")
+        self.assertEqual(sorted(os.listdir(expected_dir)),
+                sorted(os.listdir(done_dir)))
+        for filename in os.listdir(expected_dir):
+            self.assertTrue(filecmp.cmp(os.path.join(done_dir, filename),
+                os.path.join(expected_dir, filename), shallow=False))
+        shutil.rmtree(temp_dir)
+
+    def start_testcase(self, testcase):
+        '''Runs a testcase from the folder testfiles/archive_done'''
+        dirname = os.path.join(self.testdir, "archive_done", testcase)
+        self.run_archive_done(dirname, False, "todo_after.txt")
+        self.run_archive_done(dirname, True, "todo_after_preserve.txt")
+
+    def test_01(self):
+        '''no done dir yet, task without completion date'''
+        self.start_testcase("01")
+
+    def test_02(self):
+        '''existing segment and index'''
+        self.start_testcase("02")
+
+    def test_03(self):
+        '''dry run does not change anything'''
+        dirname = os.path.join(self.testdir, "archive_done", "01")
+        temp_dir = tempfile.mkdtemp(prefix="tmp_testlibtodotxt")
+        todo_filename = os.path.join(temp_dir, "todo.txt")
+        done_dir = os.path.join(temp_dir, "done.d")
+        shutil.copyfile(os.path.join(dirname, "todo_before.txt"),
+                todo_filename)
+        actual = libtodotxt.archive_done(todo_filename, done_dir,
+                "2015-02-10", False, True)
+        self.assertEqual({"2015-01": 2, "2015-02": 2}, actual)
+        self.assertTrue(filecmp.cmp(todo_filename,
+            os.path.join(dirname, "todo_before.txt"), shallow=False))
+        self.assertFalse(os.path.exists(done_dir))
+        shutil.rmtree(temp_dir)
+
+
+class TestGetDoneSegments(unittest.TestCase):
+    '''unit tests for the function get_done_segments()'''
+
+    def setUp(self):
+        script_dir = os.path.dirname(__file__)
+        self.done_dir = os.path.join(script_dir, "testfiles", "archive_done",
+                "02", "done_after")
+
+    def test_01(self):
+        '''range within one segment'''
+        actual = libtodotxt.get_done_segments(
+                self.done_dir, "2015-01-11", "2015-01-20")
+        expected = [os.path.join(self.done_dir, "2015-01.txt")]
+        self.assertEqual(expected, actual)
+
+    def test_02(self):
+        '''range spanning both segments'''
+        actual = libtodotxt.get_done_segments(
+                self.done_dir, "2014-12-24", "2015-01-10")
+        expected = [os.path.join(self.done_dir, "2014-12.txt"),
+                os.path.join(self.done_dir, "2015-01.txt")]
+        self.assertEqual(expected, actual)
+
+    def test_03(self):
+        '''gap between segments'''
+        actual = libtodotxt.get_done_segments(
+                self.done_dir, "2014-12-25", "2015-01-09")
+        self.assertEqual([], actual)
+
+
+class TestIdMap(unittest.TestCase):
+    '''unit tests for the task id map (build_id_map(), lookup_task() and
+    its updates by move_lines() and add_recur())'''
+
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp(prefix="tmp_testlibtodotxt")
+        self.from_filename = os.path.join(self.temp_dir, "from.txt")
+        self.to_filename = os.path.join(self.temp_dir, "to.txt")
+        with open(self.from_filename, "wb") as file_:
+            file_.write(b"Task1\nTask2 t:2015-01-01 rec:1w\n\r\n"
+                    b"Task3\r\nTask4 t:2015-03-01 rec:1d\nTask5\n")
+        with open(self.to_filename, "wb") as file_:
+            file_.write(b"Task0\n")
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def check_id_maps(self):
+        '''The updated id maps are the same as newly built ones'''
+        for filename in [self.from_filename, self.to_filename]:
+            self.assertEqual(libtodotxt.build_id_map(filename),
+                    libtodotxt.read_id_map(filename))
+
+    def test_01(self):
+        '''Duplicates get a suffix, lookup by offset'''
+        with open(self.to_filename, "ab") as file_:
+            file_.write(b"\nTask0\r\n")
+        id_map = libtodotxt.create_id_map(self.to_filename)
+        task_id = libtodotxt.get_task_id("Task0")
+        self.assertEqual({task_id: (1, 0), task_id + ".2": (3, 7)},
+                id_map["ids"])
+        self.assertEqual(3, id_map["lines"])
+        self.assertEqual((3, b"Task0"), libtodotxt.lookup_task(
+            self.to_filename, task_id + ".2"))
+        self.assertEqual(None, libtodotxt.lookup_task(
+            self.to_filename, "0000000000000000"))
+
+    def test_02(self):
+        '''move_lines() updates the id maps'''
+        libtodotxt.create_id_map(self.from_filename)
+        libtodotxt.create_id_map(self.to_filename)
+        libtodotxt.move_lines(self.from_filename, self.to_filename, [2, 4],
+                False)
+        self.check_id_maps()
+        self.assertEqual((3, b"Task3"), libtodotxt.lookup_task(
+            self.to_filename, libtodotxt.get_task_id("Task3")))
+        self.assertEqual((4, b"Task5"), libtodotxt.lookup_task(
+            self.from_filename, libtodotxt.get_task_id("Task5")))
+
+    def test_03(self):
+        '''move_lines() updates the id maps, line numbers preserved'''
+        libtodotxt.create_id_map(self.from_filename)
+        libtodotxt.create_id_map(self.to_filename)
+        libtodotxt.move_lines(self.from_filename, self.to_filename, [1, 4],
+                True)
+        self.check_id_maps()
+        self.assertEqual((6, b"Task5"), libtodotxt.lookup_task(
+            self.from_filename, libtodotxt.get_task_id("Task5")))
+
+    def test_04(self):
+        '''add_recur() updates the id maps'''
+        libtodotxt.create_id_map(self.from_filename)
+        libtodotxt.create_id_map(self.to_filename)
+        libtodotxt.add_recur(self.from_filename, self.to_filename,
+                "2015-01-08", False)
+        self.check_id_maps()
+        self.assertEqual((3, b"Task2 t:2015-01-08"), libtodotxt.lookup_task(
+            self.to_filename, libtodotxt.get_task_id("Task2 t:2015-01-08")))
+
+    def test_05(self):
+        '''Changes by other tools make the id map out of date'''
+        libtodotxt.create_id_map(self.to_filename)
+        with open(self.to_filename, "ab") as file_:
+            file_.write(b"Task6\n")
+        self.assertEqual(None, libtodotxt.read_id_map(self.to_filename))
+        libtodotxt.move_lines(self.from_filename, self.to_filename, [1],
+                False)
+        self.assertEqual(libtodotxt.build_id_map(self.to_filename),
+                libtodotxt.read_id_map(self.to_filename))
+        self.assertFalse(os.path.isfile(
+            self.from_filename + libtodotxt.ID_MAP_SUFFIX))
+
+    def test_06(self):
+        '''Appended empty lines get no id'''
+        libtodotxt.create_id_map(self.from_filename)
+        libtodotxt.create_id_map(self.to_filename)
+        libtodotxt.move_lines(self.from_filename, self.to_filename, [3, 4],
+                True)
+        self.check_id_maps()
+        libtodotxt.append_lines(self.to_filename, [b"\n", b" \n",
+            b"Task6\n"])
+        self.check_id_maps()
+        self.assertEqual((6, b"Task6"), libtodotxt.lookup_task(
+            self.to_filename, libtodotxt.get_task_id("Task6")))
+
+    def test_07(self):
+        '''Appending to a file without newline at the end'''
+        with open(self.to_filename, "wb") as file_:
+            file_.write(b"Task0")
+        libtodotxt.create_id_map(self.from_filename)
+        libtodotxt.create_id_map(self.to_filename)
+        libtodotxt.move_lines(self.from_filename, self.to_filename, [1],
+                False)
+        self.check_id_maps()
+        self.assertEqual(None, libtodotxt.lookup_task(self.to_filename,
+            libtodotxt.get_task_id("Task1")))
+        libtodotxt.append_lines(self.to_filename, [b"Task6", b"Task7\n"])
+        self.check_id_maps()
+        libtodotxt.add_recur(self.from_filename, self.to_filename,
+                "2015-01-08", False)
+        self.check_id_maps()
+        self.assertEqual((4, b"Task2 t:2015-01-08"), libtodotxt.lookup_task(
+            self.to_filename, libtodotxt.get_task_id("Task2 t:2015-01-08")))
+        store = libtodotxt.JournalStore(os.path.join(self.temp_dir,
+            ".journal"))
+        libtodotxt.append_lines(self.to_filename, [b"Task8"], store)
+        libtodotxt.append_lines(self.to_filename, [b"Task9\n"], store)
+        store.commit()
+        self.check_id_maps()
+
+
+class TestJournal(unittest.TestCase):
+    '''unit tests for JournalStore and recover_journal()'''
+
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp(prefix="tmp_testlibtodotxt")
+        self.journal_filename = os.path.join(self.temp_dir,
+                libtodotxt.JOURNAL_FILENAME)
+        self.from_filename = os.path.join(self.temp_dir, "from.txt")
+        self.to_filename = os.path.join(self.temp_dir, "to.txt")
+        self.write(self.from_filename, b"Task1\nTask2\nTask3\n")
+        self.write(self.to_filename, b"Task0\n")
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def write(self, filename, content):
+        '''Writes content to filename'''
+        with open(filename, "wb") as file_:
+            file_.write(content)
+
+    def read(self, filename):
+        '''Returns the content of filename'''
+        with open(filename, "rb") as file_:
+            return file_.read()
+
+    def move(self):
+        '''Moves line 2 of from.txt to to.txt through a JournalStore'''
+        store = libtodotxt.JournalStore(self.journal_filename)
+        libtodotxt.move_lines(self.from_filename, self.to_filename, [2],
+                False, store)
+        self.assertEqual(b"Task1\nTask2\nTask3\n",
+                self.read(self.from_filename))
+        self.assertEqual(b"Task0\n", self.read(self.to_filename))
+        return store
+
+    def check_moved(self):
+        '''Checks the files after move()'''
+        self.assertEqual(b"Task1\nTask3\n", self.read(self.from_filename))
+        self.assertEqual(b"Task0\nTask2\n", self.read(self.to_filename))
+        self.assertEqual(["from.txt", "to.txt"],
+                sorted(os.listdir(self.temp_dir)))
+
+    def test_01(self):
+        '''commit() changes both files'''
+        self.move().commit()
+        self.check_moved()
+        self.assertFalse(libtodotxt.recover_journal(self.journal_filename))
+
+    def test_02(self):
+        '''crash after the journal was written'''
+        self.move().write_journal()
+        self.assertTrue(libtodotxt.recover_journal(self.journal_filename))
+        self.check_moved()
+
+    def test_03(self):
+        '''crash while appending'''
+        store = self.move()
+        store.write_journal()
+        self.write(self.to_filename, b"Task0\nTa")
+        self.assertTrue(libtodotxt.recover_journal(self.journal_filename))
+        self.check_moved()
+
+    def test_04(self):
+        '''crash after the changes, recovery is idempotent'''
+        store = self.move()
+        store.write_journal()
+        with open(self.journal_filename, "rb") as file_:
+            journal = file_.read()
+        store.commit()
+        self.write(self.journal_filename, journal)
+        self.assertTrue(libtodotxt.recover_journal(self.journal_filename))
+        self.check_moved()
+
+    def test_05(self):
+        '''crash while writing the journal, no file is changed'''
+        store = self.move()
+        store.write_journal()
+        with open(self.journal_filename, "rb") as file_:
+            journal = file_.read()
+        self.write(self.journal_filename, journal[:-10])
+        self.assertTrue(libtodotxt.recover_journal(self.journal_filename))
+        self.assertEqual(b"Task1\nTask2\nTask3\n",
+                self.read(self.from_filename))
+        self.assertEqual(b"Task0\n", self.read(self.to_filename))
+        self.assertEqual(["from.txt", "to.txt"],
+                sorted(os.listdir(self.temp_dir)))
+
+    def test_06(self):
+        '''add_recur() and append_lines() in one commit'''
+        self.write(self.from_filename, b"Task1 t:2015-01-01 rec:1d\n")
+        store = libtodotxt.JournalStore(self.journal_filename)
+        result = libtodotxt.add_recur(self.from_filename, None,
+                "2015-01-02", False, store=store)
+        libtodotxt.append_lines(self.to_filename, result["append"], store)
+        self.assertEqual(b"Task0\n", self.read(self.to_filename))
+        store.commit()
+        self.assertEqual(b"Task1 t:2015-01-03 rec:1d\n",
+                self.read(self.from_filename))
+        self.assertEqual(b"Task0\nTask1 t:2015-01-01\nTask1 t:2015-01-02\n",
+                self.read(self.to_filename))
+
+    def test_07(self):
+        '''discard() changes no file'''
+        self.move().discard()
+        self.assertEqual(b"Task1\nTask2\nTask3\n",
+                self.read(self.from_filename))
+        self.assertEqual(["from.txt", "to.txt"],
+                sorted(os.listdir(self.temp_dir)))
+
+    def test_08(self):
+        '''Lines copied by the local path, the id maps are updated by
+        commit() without rescanning the files'''
+        libtodotxt.create_id_map(self.from_filename)
+        libtodotxt.create_id_map(self.to_filename)
+        move_lines_store = libtodotxt._move_lines_store
+        build_id_map = libtodotxt.build_id_map
+        def fail(*args):
+            '''Must not be called'''
+            raise AssertionError("called")
+        libtodotxt._move_lines_store = fail
+        libtodotxt.build_id_map = fail
+        try:
+            store = libtodotxt.JournalStore(self.journal_filename)
+            libtodotxt.move_lines(self.from_filename, None, [2], False, store)
+            libtodotxt.append_lines(self.to_filename, [b"Task2\n"], store)
+            libtodotxt.append_lines(self.to_filename, [b"Task4\n"], store)
+            self.assertEqual(b"Task1\nTask2\nTask3\n",
+                    self.read(self.from_filename))
+            store.commit()
+        finally:
+            libtodotxt._move_lines_store = move_lines_store
+            libtodotxt.build_id_map = build_id_map
+        self.assertEqual(b"Task1\nTask3\n", self.read(self.from_filename))
+        self.assertEqual(b"Task0\nTask2\nTask4\n",
+                self.read(self.to_filename))
+        for filename in [self.from_filename, self.to_filename]:
+            self.assertEqual(libtodotxt.build_id_map(filename),
+                    libtodotxt.read_id_map(filename))
+
+    def test_09(self):
+        '''add_recur() updates the id map on commit()'''
+        self.write(self.from_filename, b"Task1 t:2015-01-01 rec:1d\nTask2\n")
+        libtodotxt.create_id_map(self.from_filename)
+        store = libtodotxt.JournalStore(self.journal_filename)
+        libtodotxt.add_recur(self.from_filename, None, "2015-01-02", False,
+                store=store)
+        self.assertEqual(libtodotxt.build_id_map(self.from_filename),
+                libtodotxt.read_id_map(self.from_filename))
+        store.commit()
+        self.assertEqual(b"Task1 t:2015-01-03 rec:1d\nTask2\n",
+                self.read(self.from_filename))
+        self.assertEqual(libtodotxt.build_id_map(self.from_filename),
+                libtodotxt.read_id_map(self.from_filename))
+
+    def test_10(self):
+        '''An exception while writing leaves no temporary file'''
+        store = libtodotxt.JournalStore(self.journal_filename)
+        def write_and_fail():
+            '''Raises inside the with block of a replace file'''
+            with store.open_replace(self.from_filename) as new_file:
+                new_file.write(b"Task4\n")
+                raise IOError("broken pipe")
+        self.assertRaises(IOError, write_and_fail)
+        store.discard()
+        self.assertEqual(["from.txt", "to.txt"],
+                sorted(os.listdir(self.temp_dir)))
+
+    def test_11(self):
+        '''discard() removes the temporary file of an interrupted
+        add_recur()'''
+        self.write(self.from_filename, b"Task1 t:2015-01-01 rec:1d\n")
+        store = libtodotxt.JournalStore(self.journal_filename)
+        def fail(*args):
+            '''Raises like a broken pipe while writing the records'''
+            raise IOError("broken pipe")
+        self.assertRaises(IOError, libtodotxt.add_recur, self.from_filename,
+                None, "2015-01-02", False, fail, store=store)
+        store.discard()
+        self.assertEqual(b"Task1 t:2015-01-01 rec:1d\n",
+                self.read(self.from_filename))
+        self.assertEqual(["from.txt", "to.txt"],
+                sorted(os.listdir(self.temp_dir)))
+
+
+class TestStats(unittest.TestCase):
+    '''unit tests for add_task_stats() and add_recur_stats()'''
+
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp(prefix="tmp_testlibtodotxt")
+        self.todo_filename = os.path.join(self.temp_dir, "todo.txt")
+        self.now = datetime.date(2015, 1, 10)
+        self.stats = libtodotxt.new_stats(self.now,
+                datetime.date(2015, 1, 20))
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def write(self, content):
+        '''Writes content to todo.txt'''
+        with open(self.todo_filename, "wb") as file_:
+            file_.write(content)
+
+    def test_01(self):
+        '''Counters per day, project and file'''
+        self.write(b"(A) Task1 +p1 t:2015-01-01\n"
+                b"Task2 +p1 +p2 t:2015-01-10\n"
+                b"\n"
+                b"x 2015-01-02 Task3 +p1 t:2015-01-10\n"
+                b"Task4 t:2015-01-10 +p2\n"
+                b"Task5 t:2015-01-20\n"
+                b"Task6 t:2015-01-21\n"
+                b"Task7 a+b\n")
+        libtodotxt.add_task_stats(self.stats, self.todo_filename, "todo.txt")
+        libtodotxt.add_task_stats(self.stats, self.todo_filename, "other.txt")
+        self.assertEqual(12, self.stats["tasks"])
+        self.assertEqual(2, self.stats["done"])
+        self.assertEqual(2, self.stats["unscheduled"])
+        self.assertEqual(2, self.stats["overdue"])
+        self.assertEqual(2, self.stats["later"])
+        self.assertEqual({datetime.date(2015, 1, 10): 4,
+            datetime.date(2015, 1, 20): 2}, self.stats["days"])
+        self.assertEqual({"p1": 4, "p2": 4}, self.stats["projects"])
+        self.assertEqual({"todo.txt": 6, "other.txt": 6},
+                self.stats["files"])
+
+    def test_02(self):
+        '''Same thresholds as getthreshold()'''
+        lines = ["Task t:2015-01-15", "t:2015-01-15 Task",
+                "Task t:2015-01-15 t:2015-01-16", "Task t:2015-1-15"]
+        self.write("\n".join(lines).encode("utf-8"))
+        libtodotxt.add_task_stats(self.stats, self.todo_filename, "todo.txt")
+        days = {}
+        for threshold in [libtodotxt.getthreshold(line) for line in lines]:
+            if threshold is not None:
+                days[threshold] = days.get(threshold, 0) + 1
+        self.assertEqual(days, self.stats["days"])
+        self.assertEqual(2, self.stats["unscheduled"])
+
+    def test_03(self):
+        '''Recurrences from now on and missed ones'''
+        recur_filename = os.path.join(self.temp_dir, "recur.txt")
+        with open(recur_filename, "wb") as file_:
+            file_.write(b"Task1 t:2015-01-03 rec:1w\n"
+                    b"Task2 t:2015-01-10 rec:5d\n")
+        libtodotxt.add_recur_stats(self.stats, libtodotxt.iter_recur(
+            recur_filename, self.stats["last_date"]))
+        self.assertEqual(1, self.stats["missed"])
+        self.assertEqual({datetime.date(2015, 1, 10): 2,
+            datetime.date(2015, 1, 15): 1, datetime.date(2015, 1, 17): 1,
+            datetime.date(2015, 1, 20): 1}, self.stats["recurrences"])
+
+    def test_04(self):
+        '''Invalid threshold dates are counted, not raised'''
+        self.write(b"Task1 +p1 t:2015-13-01\n"
+                b"Task2 t:2015-02-30\n"
+                b"Task3 t:2015-01-10\n")
+        libtodotxt.add_task_stats(self.stats, self.todo_filename, "todo.txt")
+        self.assertEqual(3, self.stats["tasks"])
+        self.assertEqual(2, self.stats["invalid"])
+        self.assertEqual(0, self.stats["unscheduled"])
+        self.assertEqual({datetime.date(2015, 1, 10): 1}, self.stats["days"])
+        self.assertEqual({"p1": 1}, self.stats["projects"])
+
+
+class TestParseCache(unittest.TestCase):
+    '''unit tests for ParseCache'''
+
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp(prefix="tmp_testlibtodotxt")
+        self.filenames = []
+        for i in range(3):
+            self.filenames.append(os.path.join(self.temp_dir,
+                "todo%d.txt" % i))
+            self.write(self.filenames[i], b"Task1 t:2015-01-01\nTask2\n",
+                    1000000000)
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def write(self, filename, content, mtime):
+        '''Writes content to filename with the modification time mtime'''
+        with open(filename, "wb") as file_:
+            file_.write(content)
+        os.utime(filename, (mtime, mtime))
+
+    def check_counters(self, cache, hits, misses, evictions, entries):
+        '''Checks the counters of cache'''
+        counters = cache.get_counters()
+        self.assertEqual((hits, misses, evictions, entries),
+                (counters["hits"], counters["misses"], counters["evictions"],
+                    counters["entries"]))
+
+    def test_01(self):
+        '''Hit for an unchanged file, the cached data is not changed by the
+        caller'''
+        cache = libtodotxt.ParseCache()
+        expected = libtodotxt.readtodotxt(self.filenames[0])
+        agenda_data = cache.readtodotxt(self.filenames[0])
+        self.assertEqual(expected, agenda_data)
+        libtodotxt.add_threshold_to_empty(agenda_data,
+                datetime.date(2015, 1, 1))
+        self.assertEqual(expected, cache.readtodotxt(self.filenames[0]))
+        self.check_counters(cache, 1, 1, 0, 1)
+        self.assertTrue(cache.get_counters()["bytes"] > 0)
+
+    def test_02(self):
+        '''Changed size, modification time or inode'''
+        cache = libtodotxt.ParseCache()
+        cache.readtodotxt(self.filenames[0])
+        self.write(self.filenames[0], b"Task1 t:2015-01-02\nTask2\n",
+                1000000001)
+        self.assertEqual([datetime.date(2015, 1, 2), None],
+                sorted(cache.readtodotxt(self.filenames[0]),
+                    key=lambda date: date is None))
+        os.rename(self.filenames[1], self.filenames[0])
+        cache.readtodotxt(self.filenames[0])
+        self.write(self.filenames[0], b"Task3\n", 1000000001)
+        self.assertEqual({None: [{"line": "Task3", "nr": 1}]},
+                cache.readtodotxt(self.filenames[0]))
+        self.check_counters(cache, 0, 4, 0, 1)
+
+    def test_03(self):
+        '''Least recently used file is evicted'''
+        cache = libtodotxt.ParseCache(max_entries=2)
+        cache.readtodotxt(self.filenames[0])
+        cache.readtodotxt(self.filenames[1])
+        cache.readtodotxt(self.filenames[0])
+        cache.readtodotxt(self.filenames[2])
+        self.check_counters(cache, 1, 3, 1, 2)
+        cache.readtodotxt(self.filenames[0])
+        cache.readtodotxt(self.filenames[1])
+        self.check_counters(cache, 2, 4, 2, 2)
+
+    def test_04(self):
+        '''Bound by bytes'''
+        size = libtodotxt.get_agenda_data_size(
+                libtodotxt.readtodotxt(self.filenames[0]))
+        cache = libtodotxt.ParseCache(max_bytes=2 * size)
+        for filename in self.filenames:
+            cache.readtodotxt(filename)
+        self.check_counters(cache, 0, 3, 1, 2)
+        self.assertEqual(2 * size, cache.get_counters()["bytes"])
+        cache = libtodotxt.ParseCache(max_bytes=size - 1)
+        cache.readtodotxt(self.filenames[0])
+        cache.readtodotxt(self.filenames[0])
+        self.check_counters(cache, 0, 2, 0, 0)
+
+    def test_05(self):
+        '''Recently changed files are not cached'''
+        cache = libtodotxt.ParseCache()
+        self.write(self.filenames[0], b"Task1\n", time.time())
+        cache.readtodotxt(self.filenames[0])
+        cache.readtodotxt(self.filenames[0])
+        self.check_counters(cache, 0, 2, 0, 0)
+
+    def test_06(self):
+        '''Concurrent calls for the same file parse it once'''
+        cache = libtodotxt.ParseCache()
+        readtodotxt = libtodotxt.readtodotxt
+        calls = []
+
+        def slow_readtodotxt(todo_filename, store=None, metrics=None):
+            '''Counts the calls and gives the other threads time'''
+            calls.append(todo_filename)
+            time.sleep(0.1)
+            return readtodotxt(todo_filename, store, metrics)
+
+        results = []
+        threads = [threading.Thread(target=lambda: results.append(
+            cache.readtodotxt(self.filenames[0]))) for i in range(8)]
+        libtodotxt.readtodotxt = slow_readtodotxt
+        try:
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        finally:
+            libtodotxt.readtodotxt = readtodotxt
+        self.assertEqual(1, len(calls))
+        self.assertEqual([readtodotxt(self.filenames[0])] * 8, results)
+        self.check_counters(cache, 7, 1, 0, 1)
+        self.assertEqual({}, cache.path_locks)
+
+
+class TestOutputCache(unittest.TestCase):
+    '''unit tests for the output cache functions'''
+
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp(prefix="tmp_testlibtodotxt")
+        self.cache_dir = os.path.join(self.temp_dir, "cache")
+        self.todo_filename = os.path.join(self.temp_dir, "todo.txt")
+        self.write_todo(b"Task1\n", 1000000000)
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def write_todo(self, content, mtime):
+        '''Writes todo.txt with the modification time mtime'''
+        with open(self.todo_filename, "wb") as file_:
+            file_.write(content)
+        os.utime(self.todo_filename, (mtime, mtime))
+
+    def get_key(self, options):
+        '''Returns the cache key for todo.txt'''
+        return libtodotxt.get_output_cache_key([self.todo_filename], options)
+
+    def test_01(self):
+        '''hit for the same files and options'''
+        key = self.get_key(["2015-01-01", "text"])
+        self.assertEqual(None, key[1])
+        self.assertEqual(None, libtodotxt.read_output_cache(self.cache_dir,
+            key, [self.todo_filename]))
+        libtodotxt.write_output_cache(self.cache_dir, key, b"output\n")
+        self.assertEqual(b"output\n", libtodotxt.read_output_cache(
+            self.cache_dir, self.get_key(["2015-01-01", "text"]),
+            [self.todo_filename]))
+        for key in [self.get_key(["2015-01-02", "text"]),
+                self.get_key(["2015-01-01", "jsonl"])]:
+            self.assertEqual(None, libtodotxt.read_output_cache(
+                self.cache_dir, key, [self.todo_filename]))
+        self.write_todo(b"Task2\n", 1000000001)
+        self.assertEqual(None, libtodotxt.read_output_cache(self.cache_dir,
+            self.get_key(["2015-01-01", "text"]), [self.todo_filename]))
+
+    def test_02(self):
+        '''recently changed files are compared by content'''
+        mtime = int(time.time())
+        self.write_todo(b"Task1\n", mtime)
+        key = self.get_key([])
+        self.assertNotEqual(None, key[1])
+        libtodotxt.write_output_cache(self.cache_dir, key, b"output\n")
+        self.assertEqual(b"output\n", libtodotxt.read_output_cache(
+            self.cache_dir, self.get_key([]), [self.todo_filename]))
+        # Same size and mtime, but another content
+        self.write_todo(b"Task2\n", mtime)
+        self.assertEqual(key[0], self.get_key([])[0])
+        self.assertEqual(None, libtodotxt.read_output_cache(self.cache_dir,
+            self.get_key([]), [self.todo_filename]))
+        # Still checked after the time for racy changes
+        self.write_todo(b"Task2\n", 1000000000)
+        self.assertEqual(None, libtodotxt.read_output_cache(self.cache_dir,
+            (key[0], None), [self.todo_filename]))
+
+    def test_03(self):
+        '''eviction by count and age'''
+        for nr in range(5):
+            libtodotxt.write_output_cache(self.cache_dir,
+                    self.get_key([str(nr)]), b"output", max_entries=3)
+        self.assertEqual(3, len(os.listdir(self.cache_dir)))
+        for name in os.listdir(self.cache_dir):
+            os.utime(os.path.join(self.cache_dir, name), (0, 0))
+        key = self.get_key(["new"])
+        libtodotxt.write_output_cache(self.cache_dir, key, b"output")
+        self.assertEqual([key[0]], os.listdir(self.cache_dir))
+
+
+class TestMetrics(unittest.TestCase):
+    '''unit tests for the run metrics'''
+
+    def setUp(self):
+        script_dir = os.path.dirname(__file__)
+        self.testdir = os.path.join(script_dir, "testfiles")
+        self.temp_dir = tempfile.mkdtemp(prefix="tmp_testlibtodotxt")
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def test_01(self):
+        '''add_recur() counts lines, steps and bytes'''
+        dirname = os.path.join(self.testdir, "add_recur", "02")
+        from_filename = os.path.join(self.temp_dir, "from.txt")
+        to_filename = os.path.join(self.temp_dir, "to.txt")
+        shutil.copyfile(os.path.join(dirname, "from_before.txt"),
+                from_filename)
+        shutil.copyfile(os.path.join(dirname, "to_before.txt"), to_filename)
+        metrics = {}
+        libtodotxt.add_recur(from_filename, to_filename, "2015-01-03", False,
+                metrics=metrics)
+        self.assertEqual({"lines_scanned": 1, "lines_added": 3,
+            "lines_skipped": 0, "recurrence_steps": 4, "bytes_read": 26,
+            "bytes_written": 3 * 19 + 26}, metrics)
+
+    def test_02(self):
+        '''move_lines() and append_lines() add to the metrics'''
+        from_filename = os.path.join(self.temp_dir, "from.txt")
+        to_filename = os.path.join(self.temp_dir, "to.txt")
+        with open(from_filename, "wb") as file_:
+            file_.write(b"Task1\nTask2\nTask3\n")
+        with open(to_filename, "wb") as file_:
+            file_.write(b"")
+        metrics = {}
+        moved_lines = libtodotxt.move_lines(from_filename, None, [1, 3],
+                False, metrics=metrics)
+        libtodotxt.append_lines(to_filename, moved_lines, metrics=metrics)
+        self.assertEqual({"lines_moved": 2, "bytes_read": 18,
+            "bytes_written": 18}, metrics)
+        libtodotxt.readtodotxt(to_filename, metrics=metrics)
+        self.assertEqual(2, metrics["lines_scanned"])
+        self.assertEqual(30, metrics["bytes_read"])
+
+    def test_03(self):
+        '''Prometheus text format'''
+        metrics = {"lines_added": 3, "phase:recur": 0.5}
+        text = libtodotxt.format_metrics(metrics,
+                [("plugin", 'a"b\\c')], 100.0, 102.0)
+        lines = text.splitlines()
+        self.assertIn("# TYPE todotxt_lines_added gauge", lines)
+        self.assertIn('todotxt_lines_added{plugin="a\\"b\\\\c"} 3.0', lines)
+        self.assertIn('todotxt_lines_moved{plugin="a\\"b\\\\c"} 0.0', lines)
+        self.assertIn('todotxt_phase_duration_seconds{plugin="a\\"b\\\\c",'
+                'phase="recur"} 0.5', lines)
+        self.assertIn('todotxt_run_duration_seconds{plugin="a\\"b\\\\c"} 2.0',
+                lines)
+        self.assertIn('todotxt_last_run_timestamp_seconds{plugin="a\\"b\\\\c"} '
+                '102.0', lines)
+        self.assertTrue(text.endswith("\n"))
+
+    def test_04(self):
+        '''write_metrics() replaces the file'''
+        filename = os.path.join(self.temp_dir, "todotxt.prom")
+        with open(filename, "w") as file_:
+            file_.write("old")
+        libtodotxt.write_metrics(filename, {"lines_added": 1},
+                [("plugin", "addrecurtasks")], 0.0)
+        with open(filename, "r") as file_:
+            self.assertIn('todotxt_lines_added{plugin="addrecurtasks"} 1.0\n',
+                    file_.read())
+        self.assertEqual(["todotxt.prom"], os.listdir(self.temp_dir))
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,255 @@
+#!/usr/bin/env python
+# vim: set fileencoding=utf-8 :
+"""
+    testmemory.py
+
+    Memory budget tests and benchmark for libtodotxt.py and agenda.py
+"""
+# The MIT License (MIT)
+#
+# Copyright (c) 2015 Georg Lutz <georg@georglutz.de>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+from __future__ import print_function
+import datetime
+import os
+import unittest
+import shutil
+import sys
+import tempfile
+import time
+try:
+    import resource
+except ImportError:
+    resource = None
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+import addrecurtasks
+import agenda
+import libtodotxt
+
+# Number of lines of the generated files, e.g. 5000000 for a larger run or
+# 20000 for a quick one: TODOTXT_MEMORY_TEST_LINES=5000000 ./testmemory.py
+NR_OF_LINES = int(os.environ.get("TODOTXT_MEMORY_TEST_LINES", "1000000"))
+
+# Memory allowed independent of the number of lines (bytes), e.g. for the
+# read and write buffers
+BASE_BUDGET = 4 * libtodotxt.IO_BUFFER_SIZE
+
+# Memory allowed per line of the file (bytes) for the paths which keep all
+# lines in memory
+READ_BUDGET_PER_LINE = 400
+MERGED_AGENDA_BUDGET_PER_LINE = 300
+
+# Memory allowed per moved line (bytes) for move_lines()
+MOVE_BUDGET_PER_LINE = 400
+
+
+def write_todo_file(filename, nr_of_lines):
+    '''Writes a todo.txt file with nr_of_lines tasks scheduled in 2015'''
+    with open(filename, "w") as file_:
+        for line_nr in range(nr_of_lines):
+            file_.write("(B) 2015-01-01 Task %d +project @context "
+                    "t:2015-%02d-%02d\n" % (line_nr, line_nr % 12 + 1,
+                        line_nr % 28 + 1))
+
+
+def write_recur_file(filename, nr_of_lines):
+    '''Writes a recur.txt file with nr_of_lines tasks recurring after 2099,
+    so add_recur() neither adds nor changes a line'''
+    with open(filename, "w") as file_:
+        for line_nr in range(nr_of_lines):
+            file_.write("Recurring task %d +project t:2099-01-01 rec:1w\n" %
+                    line_nr)
+
+
+def measure_traced(function):
+    '''Calls function and returns the tuple (peak, seconds) with the peak of
+    the memory allocated meanwhile (bytes) and the duration.'''
+    stdout = sys.stdout
+    devnull = open(os.devnull, "w")
+    sys.stdout = devnull
+    start_time = time.time()
+    tracemalloc.start()
+    try:
+        function()
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+        sys.stdout = stdout
+        devnull.close()
+    return (peak, time.time() - start_time)
+
+
+def measure_rss(function):
+    '''Calls function in a child process and returns the tuple (peak,
+    seconds) with the growth of the maximum resident set size of the child
+    (bytes) and the duration. The memory freed before by the parent may be
+    reused, so the peak is a lower bound.'''
+    (read_fd, write_fd) = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        os.close(read_fd)
+        status = 1
+        try:
+            sys.stdout = open(os.devnull, "w")
+            start_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+            start_time = time.time()
+            function()
+            sys.stdout.flush()
+            rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+            os.write(write_fd, ("%d %f" % (rss - start_rss,
+                time.time() - start_time)).encode("ascii"))
+            status = 0
+        finally:
+            os._exit(status)
+    os.close(write_fd)
+    with os.fdopen(read_fd, "rb") as result_file:
+        result = result_file.read().decode("ascii")
+    (_, status) = os.waitpid(pid, 0)
+    if status != 0:
+        raise RuntimeError("memory measurement failed")
+    (rss, seconds) = result.split()
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    scale = 1 if sys.platform == "darwin" else 1024
+    return (int(rss) * scale, float(seconds))
+
+
+def measure(function):
+    '''Returns the tuple (peak, seconds) of measure_rss() or, without
+    os.fork() and resource (Windows), of the slower measure_traced(). Raises
+    RuntimeError if neither works, a skipped budget would hide a
+    regression.'''
+    if resource is not None and hasattr(os, "fork"):
+        return measure_rss(function)
+    if tracemalloc is not None:
+        return measure_traced(function)
+    raise RuntimeError("no memory measurement, needs resource.getrusage() "
+            "or tracemalloc")
+
+
+class TestMemoryBudget(unittest.TestCase):
+    '''Peak memory of the parse and move paths for NR_OF_LINES lines'''
+
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp(prefix="tmp_testmemory")
+        self.todo_filename = os.path.join(self.temp_dir, "todo.txt")
+        self.now = datetime.date(2015, 1, 1)
+        write_todo_file(self.todo_filename, NR_OF_LINES)
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def check_budget(self, function, budget_per_line, nr_of_lines):
+        '''Asserts that the peak memory of function stays below BASE_BUDGET
+        plus budget_per_line for each of nr_of_lines lines'''
+        peak = measure(function)[0]
+        budget = BASE_BUDGET + budget_per_line * nr_of_lines
+        self.assertLessEqual(peak, budget,
+                "peak memory %d bytes (%.1f per line) exceeds budget %d" %
+                (peak, float(peak) / NR_OF_LINES, budget))
+
+    def test_01(self):
+        '''readtodotxt() keeps every line'''
+        self.check_budget(lambda: libtodotxt.readtodotxt(self.todo_filename),
+                READ_BUDGET_PER_LINE, NR_OF_LINES)
+
+    def test_02(self):
+        '''agenda --limit keeps only the selected lines'''
+        self.check_budget(lambda: agenda.print_short(libtodotxt.select_agenda(
+            libtodotxt.itertodotxt(self.todo_filename), self.now, 20)),
+            0, NR_OF_LINES)
+
+    def test_03(self):
+        '''agenda --all sorts the lines of todo.txt'''
+        self.check_budget(lambda: agenda.print_merged(
+            agenda.get_merged_entries(self.temp_dir, "todo.txt", self.now,
+                self.now + datetime.timedelta(days=10)), "text", None, None),
+            MERGED_AGENDA_BUDGET_PER_LINE, NR_OF_LINES)
+
+    def test_04(self):
+        '''add_recur() streams the lines'''
+        recur_filename = os.path.join(self.temp_dir, "recur.txt")
+        write_recur_file(recur_filename, NR_OF_LINES)
+        self.check_budget(lambda: libtodotxt.add_recur(recur_filename,
+            self.todo_filename, "2015-01-10", False), 0, NR_OF_LINES)
+
+    def test_05(self):
+        '''move_lines() keeps only the moved lines'''
+        line_nrs = list(range(1, NR_OF_LINES + 1, 100))
+        to_filename = os.path.join(self.temp_dir, "to.txt")
+        self.check_budget(lambda: libtodotxt.move_lines(self.todo_filename,
+            to_filename, line_nrs, False), MOVE_BUDGET_PER_LINE,
+            len(line_nrs))
+
+
+def benchmark():
+    '''Prints the peak memory and duration of the paths for NR_OF_LINES
+    lines'''
+    temp_dir = tempfile.mkdtemp(prefix="tmp_testmemory")
+    todo_filename = os.path.join(temp_dir, "todo.txt")
+    recur_filename = os.path.join(temp_dir, "recur.txt")
+    now = datetime.date(2015, 1, 1)
+    write_todo_file(todo_filename, NR_OF_LINES)
+    write_recur_file(recur_filename, NR_OF_LINES)
+    # The same lines in four sources, processed one after another and by a
+    # pool of four processes (faster with several CPUs only)
+    os.mkdir(os.path.join(temp_dir, "recur.d"))
+    source_tasks = []
+    for nr in range(4):
+        source_name = os.path.join("recur.d", "%d.txt" % nr)
+        write_recur_file(os.path.join(temp_dir, source_name),
+                NR_OF_LINES // 4)
+        source_tasks.append((temp_dir, source_name, now,
+            "2015-01-10", False, False, None))
+    paths = [
+        ("readtodotxt", lambda: libtodotxt.readtodotxt(todo_filename)),
+        ("readtodotxt -j4", lambda: libtodotxt.readtodotxt_parallel(
+            todo_filename, 4, min_chunk_size=1)),
+        ("agenda --limit", lambda: agenda.print_short(
+            libtodotxt.select_agenda(libtodotxt.itertodotxt(todo_filename),
+                now, 20))),
+        ("agenda --all", lambda: agenda.print_merged(
+            agenda.get_merged_entries(temp_dir, "todo.txt", now,
+                now + datetime.timedelta(days=10)), "text", None, None)),
+        ("add_recur", lambda: libtodotxt.add_recur(recur_filename,
+            todo_filename, "2015-01-10", False)),
+        ("add_recur 4 sources", lambda: list(libtodotxt.map_sources(
+            addrecurtasks.add_recur_source, source_tasks, 1))),
+        ("add_recur 4 sources -j4", lambda: list(libtodotxt.map_sources(
+            addrecurtasks.add_recur_source, source_tasks, 4))),
+        ("move_lines", lambda: libtodotxt.move_lines(todo_filename, None,
+            list(range(1, NR_OF_LINES + 1, 100)), False)),
+    ]
+    print("%d lines:" % NR_OF_LINES)
+    for (name, function) in paths:
+        (peak, seconds) = measure(function)
+        print("  %-25s %12d bytes %8.1f bytes/line %8.2f s" % (name, peak,
+            float(peak) / NR_OF_LINES, seconds))
+    shutil.rmtree(temp_dir)
+
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1 and sys.argv[1] == "benchmark":
+        benchmark()
+    else:
+        unittest.main()
@@ -0,0 +1,128 @@
+#!/usr/bin/env python
+# vim: set fileencoding=utf-8 :
+"""
+    todosql.py
+
+    Queries tasks of all todo files via a SQLite mirror (plugin for todo.sh)
+"""
+# The MIT License (MIT)
+#
+# Copyright (c) 2015 Georg Lutz <georg@georglutz.de>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+from __future__ import print_function
+import argparse
+import datetime
+import os
+import sys
+import libtodotxt
+import libtodosqlite
+
+# Name of the plugin (shell wrapper script)
+PLUGIN_NAME = "todosql"
+
+# Name of the mirror database in TODO_DIR
+DB_FILENAME = ".todo.sqlite"
+
+def usage(args):
+    '''Usage message for todo.sh plugin system'''
+    print("    " + PLUGIN_NAME + " [--agenda DAYS] [--project P] " +
+            "[--context C] [--priority A] [--sql QUERY]")
+    print("      Queries todo.txt, future.txt, recur.txt and the done files")
+    print("      via a SQLite mirror in TODO_DIR")
+
+
+def get_todo_names(todo_dir):
+    '''Returns the names of all todo files in todo_dir'''
+    names = ["todo.txt", "future.txt", "recur.txt", "done.txt"]
+    for dirname in ["future.d", "done.d"]:
+        if os.path.isdir(os.path.join(todo_dir, dirname)):
+            for filename in sorted(os.listdir(
+                    os.path.join(todo_dir, dirname))):
+                if filename.endswith(".txt") and \
+                        filename != libtodotxt.DONE_INDEX_FILENAME:
+                    names.append(dirname + "/" + filename)
+    return names
+
+
+def plugin(args):
+    '''Plugin main logic'''
+
+    todo_dir = os.environ.get("TODO_DIR")
+    if todo_dir == None:
+        print("Env variable TODO_DIR not set! Exit.", file=sys.stderr)
+        sys.exit(1)
+
+    conn = libtodosqlite.open_mirror(os.path.join(todo_dir, DB_FILENAME))
+    libtodosqlite.sync_dir(conn, todo_dir, get_todo_names(todo_dir))
+
+    if args.sql is not None:
+        for row in conn.execute(args.sql):
+            print("|".join(["%s" % (value,) for value in row]))
+        conn.close()
+        return
+
+    if args.agenda is not None:
+        now = datetime.date.today()
+        entries = libtodosqlite.query_agenda(conn, None,
+                now + datetime.timedelta(days=args.agenda))
+    else:
+        entries = libtodosqlite.query_tasks(conn, args.project, args.context,
+                args.priority)
+    conn.close()
+
+    if args.format != "text":
+        write_record = libtodotxt.get_record_writer(args.format, sys.stdout)
+        for entry in entries:
+            write_record(libtodotxt.make_record("show", entry["file"],
+                entry["nr"], entry["threshold"], entry["line"]))
+        return
+
+    for entry in entries:
+        print("%s:%02d %s" % (entry["file"], entry["nr"], entry["line"]))
+
+
+def main():
+    '''main function'''
+    parser = argparse.ArgumentParser(prog=PLUGIN_NAME)
+    subparsers = parser.add_subparsers()
+    parser_usage = subparsers.add_parser('usage',
+            help='show usage message')
+    parser_usage.set_defaults(func=usage)
+    parser_plugin = subparsers.add_parser(PLUGIN_NAME,
+            help='plugin main command')
+    parser_plugin.add_argument("--agenda", type=int, metavar="DAYS",
+            help="Tasks with threshold date up to DAYS days from now")
+    parser_plugin.add_argument("--project",
+            help="Only tasks with this project (without +)")
+    parser_plugin.add_argument("--context",
+            help="Only tasks with this context (without @)")
+    parser_plugin.add_argument("--priority",
+            help="Only tasks with this priority")
+    parser_plugin.add_argument("--sql",
+            help="Run SQL query on the mirror (tables files, tasks, tags)")
+    parser_plugin.add_argument("--format", default="text",
+            choices=["text", "jsonl", "csv"],
+            help="Output format, jsonl and csv write one record per line.")
+    parser_plugin.set_defaults(func=plugin)
+    args = parser.parse_args()
+    args.func(args)
+
+if __name__ == "__main__":
+    main()